@@ -0,0 +1,134 @@
+import json
+import time
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from pathlib import Path
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+
+from main import run
+from src import run_simulation
+
+
+def run_plan_on_cluster(cluster_config_path: str, plan_path: str) -> dict:
+    """在独立的worker进程里执行一个计划，进程内的全局状态（节点映射、history等）只属于这个计划"""
+    begin = time.time()
+    result = {"plan": plan_path, "cluster": cluster_config_path, "bug_found": False, "error": None,
+              "started_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(begin))}
+    try:
+        if cluster_config_path == "simulation":
+            with open(plan_path, "r", encoding="utf-8") as file:
+                summary = run_simulation(json.load(file))
+            result["bug_found"] = summary["bug_found"]
+        else:
+            result["bug_found"] = bool(asyncio.run(run("direct", Path(cluster_config_path), Path(plan_path))))
+    except Exception as e:
+        logging.error(f"Plan {plan_path} on {cluster_config_path} failed: {e}")
+        result["error"] = str(e)
+    result["elapsed"] = time.time() - begin
+    return result
+
+
+class Campaign:
+    """把一批计划调度到一组集群上执行：每个集群同一时间只跑一个计划，每个计划都在新的进程里执行"""
+    plan_paths: list[Path]
+    cluster_config_paths: list[str]
+    stop_on_bug: bool
+
+    def __init__(self, plan_paths: list[Path], cluster_config_paths: list[str], stop_on_bug: bool = False):
+        self.plan_paths = plan_paths
+        self.cluster_config_paths = cluster_config_paths
+        self.stop_on_bug = stop_on_bug
+        self.results: list[dict] = []
+        self.stopped = False
+
+    async def run(self) -> list[dict]:
+        loop = asyncio.get_running_loop()
+        free_clusters: asyncio.Queue[str] = asyncio.Queue()
+        for cluster_config_path in self.cluster_config_paths:
+            free_clusters.put_nowait(cluster_config_path)
+
+        # spawn + max_tasks_per_child=1：每个计划都从干净的解释器开始，互不共享全局变量
+        with ProcessPoolExecutor(max_workers=len(self.cluster_config_paths), max_tasks_per_child=1,
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+
+            async def run_one(plan_path: Path):
+                cluster_config_path = await free_clusters.get()
+                try:
+                    if self.stopped:
+                        self.results.append({"plan": str(plan_path), "cluster": None, "bug_found": False,
+                                             "error": None, "skipped": True})
+                        return
+                    logging.info(f"Running {plan_path} on {cluster_config_path}...")
+                    result = await loop.run_in_executor(pool, run_plan_on_cluster, cluster_config_path, str(plan_path))
+                    self.results.append(result)
+                    if result["bug_found"]:
+                        logging.info(f"BUG FOUND by {plan_path} on {cluster_config_path}!")
+                        if self.stop_on_bug:
+                            self.stopped = True
+                finally:
+                    free_clusters.put_nowait(cluster_config_path)
+
+            await asyncio.gather(*(run_one(plan_path) for plan_path in self.plan_paths))
+        return self.results
+
+    def summary(self) -> dict:
+        executed = [result for result in self.results if not result.get("skipped")]
+        return {
+            "plans": len(self.plan_paths),
+            "executed": len(executed),
+            "bugs_found": sum(1 for result in executed if result["bug_found"]),
+            "errors": sum(1 for result in executed if result["error"]),
+            "results": sorted(self.results, key=lambda result: result["plan"]),
+        }
+
+
+def collect_plans(patterns: list[str]) -> list[Path]:
+    plan_paths: list[Path] = []
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            plan_paths.extend(sorted(path.glob("*.json")))
+        elif path.exists():
+            plan_paths.append(path)
+        else:
+            plan_paths.extend(sorted(Path().glob(pattern)))
+    return plan_paths
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Run many plans concurrently across a pool of clusters.")
+    parser.add_argument("plans", nargs="+", help="plan files, directories or glob patterns, e.g. plan/*.json")
+    parser.add_argument("-c", "--cluster", action="append", default=[],
+                        help="cluster config yaml, repeat for every cluster in the pool")
+    parser.add_argument("--simulate", type=int, default=0,
+                        help="run the plans on N simulated clusters instead of real ones")
+    parser.add_argument("--stop-on-bug", action="store_true", help="do not start new plans after the first bug")
+    parser.add_argument("--summary", default=None, help="where to write the summary json")
+    args = parser.parse_args(argv)
+
+    plan_paths = collect_plans(args.plans)
+    cluster_config_paths = ["simulation"] * args.simulate if args.simulate > 0 else args.cluster
+    if not plan_paths:
+        parser.error("no plan found")
+    if not cluster_config_paths:
+        parser.error("at least one --cluster (or --simulate N) is required")
+
+    campaign = Campaign(plan_paths, cluster_config_paths, args.stop_on_bug)
+    begin = time.time()
+    asyncio.run(campaign.run())
+    summary = campaign.summary()
+    summary["elapsed"] = time.time() - begin
+    summary_path = Path(args.summary or f"history/campaign_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    summary_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(summary_path, "w", encoding="utf-8") as file:
+        json.dump(summary, file, ensure_ascii=False, indent=4)
+    logging.info(f"Campaign finished: {summary['executed']}/{summary['plans']} plans executed, "
+                 f"{summary['bugs_found']} bugs found, {summary['errors']} errors in {summary['elapsed']:.1f}s. "
+                 f"Summary is written to {summary_path}.")
+
+
+if __name__ == "__main__":
+    main()
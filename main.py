@@ -1,3 +1,4 @@
+import time
 from pathlib import Path
 
 from src import *
@@ -15,35 +16,42 @@ def init_mapping(yaml_parser: YamlParser):
         alias_injector_dict[node_name] = injector
         
 
-def init_databases_and_injectors():
-    for node_name, db in alias_database_dict.items():
-        db.setupDB()
-    for node_name, injector in alias_injector_dict.items():
-        injector.connect()
-        
-
-def close_databases_and_injectors():
-    for node_name, db in alias_database_dict.items():
-        try:
-            db.teardownDB()
-        except Exception as e:
-            logging.error(f"Error occured when tearing down db: {str(e)}")
-    for node_name, injector in alias_injector_dict.items():
-        try:
-            injector.close()
-        except Exception as e:
-            logging.error(f"Error occured when close injector's connection: {str(e)}")   
+def write_metrics_summary(path: Path):
+    """按阶段（故障前/故障中/恢复后）汇总延迟、吞吐和错误数"""
+    summary = metrics.phase_summary()
+    for phase, phase_summary in summary.items():
+        for name, latency in phase_summary["latency"].items():
+            if name.startswith("http_request"):
+                logging.info(f"[{phase}] {name}: {latency['count']} requests, p50 {latency['p50'] * 1000:.2f}ms, "
+                             f"p99 {latency['p99'] * 1000:.2f}ms, max {latency['max'] * 1000:.2f}ms")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(summary, file, indent=4)
+    logging.info(f"Metrics summary is written to {path}.")
         
         
 async def run(mode: str, cluster_config_path: Path, direct_json_path: Path = None):
     yaml_parser = YamlParser(cluster_config_path)
+    plan_name = Path(direct_json_path).stem if direct_json_path else "plan"
+    history_path = Path(yaml_parser.history_dir) / f"{plan_name}_{time.strftime('%Y%m%d_%H%M%S')}.jsonl"
+    # 本次运行的日志都带上run_id（和history文件同名）
+    configure_logging(yaml_parser.log_level, history_path.with_suffix(".log.jsonl") if yaml_parser.log_json else None,
+                      history_path.stem, yaml_parser.log_rate_limit, yaml_parser.log_burst)
+    ssh_pool.max_channels = yaml_parser.ssh_max_channels
+    ssh_pool.keepalive = yaml_parser.ssh_keepalive
     init_mapping(yaml_parser)
     
-    close_databases_and_injectors()
-    
-    init_databases_and_injectors()
-    await asyncio.sleep(1)
-    await list(alias_database_dict.values())[0].init_table_tc()
+    await connect_injectors(yaml_parser)
+    # 先尝试逻辑重置，健康检查不通过才逐级升级到快照恢复和重启rqlite
+    await ClusterReset(yaml_parser).run()
+    cluster_topology.ttl = yaml_parser.topology_ttl
+    cluster_topology.refresh_interval = yaml_parser.topology_refresh_interval
+    cluster_topology.start()
+    leader_router.retry_policy = RetryPolicy(yaml_parser.query_retry_count, yaml_parser.retry_base_delay,
+                                             yaml_parser.retry_max_delay, yaml_parser.retry_deadline)
+    telemetry_sampler.interval = yaml_parser.telemetry_interval
+    telemetry_sampler.capacity = yaml_parser.telemetry_capacity
+    telemetry_sampler.expvar_interval = yaml_parser.telemetry_expvar_interval
+    telemetry_sampler.expvar_fields = tuple(yaml_parser.telemetry_expvar_fields)
     
     if mode == "direct":
         with open(direct_json_path, "r", encoding="utf-8") as file:
@@ -53,22 +61,40 @@ async def run(mode: str, cluster_config_path: Path, direct_json_path: Path = Non
     
     plan_parser = PlanParser(plan_data)
     total_time: int = plan_parser.total_time
+    history.open(history_path)
+    metrics.reset()
+    await worker_pool.start(cluster_config_path, yaml_parser.workload_processes, history_path.stem)
+    metrics_server = MetricsServer(yaml_parser.metrics_host, yaml_parser.metrics_port)
+    if yaml_parser.metrics_port:
+        await metrics_server.start()
+    telemetry_sampler.start()
     try:
-        for event in plan_parser.event_list:
-            if isinstance(event, Nemesis):
-                asyncio.create_task(event.inject())
-            elif isinstance(event, Workload):
-                asyncio.create_task(event.start())
-            elif isinstance(event, Check):
-                # 这个地方的await还是有点问题，需要调整
-                task = asyncio.create_task(event.start())
-                result = await task
-                if result == True:
-                    logging.info("BUG FOUND!")
-                    return
-        await asyncio.sleep(total_time)
+        # 按计划的绝对时间点分派事件，所有事件结束或发现bug时提前结束，total_time是上限
+        scheduler = TimelineScheduler(plan_parser.event_list, total_time)
+        bug_found = await scheduler.run()
+        if bug_found:
+            logging.info("BUG FOUND!")
+        return bug_found
     finally:
-        close_databases_and_injectors()
+        await fault_registry.recover_all()
+        await telemetry_sampler.stop()
+        await cluster_topology.stop()
+        worker_pool.stop()
+        await close_injectors(yaml_parser)
+        # 默认让rqlite继续运行，下一个计划开始时重置就行，不必重启
+        if yaml_parser.teardown_after_run:
+            await stop_databases(yaml_parser)
+        for db in alias_database_dict.values():
+            await db.close()
+        ssh_pool.close_all()
+        history.close()
+        await metrics_server.stop()
+        write_metrics_summary(history_path.with_suffix(".metrics.json"))
+        if telemetry_sampler.buffers:
+            telemetry_summary = telemetry_sampler.export(history_path.with_suffix(".telemetry.json"), history_path)
+            logging.info(f"Telemetry: {telemetry_summary['elections']} elections, "
+                         f"{telemetry_summary['leader_changes']} leader changes, max replication lag "
+                         f"{telemetry_summary['max_replication_lag']}.")
     
 
 if __name__ == "__main__":
@@ -77,4 +103,9 @@ if __name__ == "__main__":
     direct_json_path: Path = "E:/Confucius/plan.json"
     cluster_config_path: Path = "/home/centos/Confucius/cluster_config/rqlite_cluster.yaml"
     direct_json_path: Path = "/home/centos/Confucius/plan/final_plan_test.json"
-    asyncio.run(run(mode, cluster_config_path, direct_json_path))
\ No newline at end of file
+    if mode == "simulate":
+        # 在虚拟时钟和进程内模拟的集群上执行计划，用来在占用真实集群之前快速筛选计划
+        with open(direct_json_path, "r", encoding="utf-8") as file:
+            run_simulation(json.load(file), history_path=Path("history") / f"{Path(direct_json_path).stem}_simulation.jsonl")
+    else:
+        asyncio.run(run(mode, cluster_config_path, direct_json_path))
\ No newline at end of file
@@ -1,9 +1,28 @@
+from .agent import *
+from .batcher import *
 from .checker import *
 from .config import *
 from .db import *
 from .fault_injector import *
+from .fault_registry import *
+from .generator import *
+from .history import *
+from .http_client import *
+from .integrity import *
+from .linearizability import *
+from .list_append import *
+from .load_generator import *
 from .logging_config import *
+from .metrics import *
 from .nemesis import *
 from .parser import *
+from .reset import *
+from .retry import *
+from .router import *
+from .scheduler import *
 from .scope_calculator import *
+from .simulation import *
+from .ssh_pool import *
+from .telemetry import *
+from .worker_pool import *
 from .workload import *
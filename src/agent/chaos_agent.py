@@ -0,0 +1,64 @@
+"""在节点上常驻的故障注入代理，由AgentClient通过SSH上传并启动
+
+从stdin逐行读取JSON请求{"id": n, "command": "...", "timeout": 秒或null}，每条命令在单独的线程里执行，
+结果按完成顺序逐行写回stdout：{"id": n, "stdout": ..., "stderr": ..., "exit_status": n, "elapsed": 秒}，
+执行出错时带error字段。启动后先输出{"id": 0, "ready": true, "version": VERSION}。
+stdin关闭（SSH channel关闭）后等正在执行的命令结束再退出。只依赖标准库，兼容Python 3.6。
+"""
+import sys
+import json
+import time
+import threading
+import subprocess
+
+VERSION = 1
+
+write_lock = threading.Lock()
+
+
+def send(message):
+    line = json.dumps(message) + "\n"
+    with write_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def execute(request):
+    response = {"id": request.get("id")}
+    begin = time.time()
+    try:
+        process = subprocess.Popen(request["command"], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = process.communicate(timeout=request.get("timeout"))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise Exception("command timed out after {}s".format(request.get("timeout")))
+        response["stdout"] = stdout.decode("utf-8", "replace")
+        response["stderr"] = stderr.decode("utf-8", "replace")
+        response["exit_status"] = process.returncode
+    except Exception as e:
+        response["error"] = str(e)
+    response["elapsed"] = time.time() - begin
+    send(response)
+
+
+def main():
+    send({"id": 0, "ready": True, "version": VERSION})
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            send({"id": None, "error": "bad frame: {}".format(e)})
+            continue
+        threading.Thread(target=execute, args=(request,)).start()
+
+
+if __name__ == "__main__":
+    main()
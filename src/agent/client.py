@@ -0,0 +1,143 @@
+import json
+import time
+import logging
+import itertools
+import threading
+import paramiko
+from pathlib import Path
+from typing import Optional
+from concurrent.futures import Future
+
+from ..ssh_pool import CommandResult, SSHSession
+
+AGENT_SCRIPT = Path(__file__).with_name("chaos_agent.py")
+# 和chaos_agent.py里的VERSION一致，远端文件名带上版本号，升级后不会用到旧的脚本
+AGENT_VERSION = 1
+AGENT_REMOTE_PATH = f"/tmp/confucius_chaos_agent_v{AGENT_VERSION}.py"
+
+
+class AgentClient:
+    """节点上常驻的故障注入代理的客户端
+
+    start()通过已有的SSH连接把chaos_agent.py上传到节点并在一个长期打开的channel里启动它，之后所有命令
+    都以一行JSON的形式写进这个channel，不再为每条命令开channel、起shell。命令带id，多条命令可以同时在途，
+    后台线程按id把结果交给对应的调用方。接口和SSHSession.run一致，FaultInjector可以随时退回到SSH exec。
+    """
+    session: SSHSession
+    python: str
+
+    def __init__(self, session: SSHSession, python: str = "python3"):
+        self.session = session
+        self.python = python
+        self.channel: Optional[paramiko.Channel] = None
+        self.reader: Optional[threading.Thread] = None
+        self.pending: dict[int, Future] = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        """上传并启动代理，等到它回复ready才返回"""
+        transport = self.session.get_transport()
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        try:
+            sftp.put(str(AGENT_SCRIPT), AGENT_REMOTE_PATH)
+        finally:
+            sftp.close()
+        channel = transport.open_session(timeout=self.session.timeout)
+        try:
+            channel.settimeout(self.session.timeout)
+            channel.exec_command(f"{self.python} -u {AGENT_REMOTE_PATH}")
+            stdout = channel.makefile("rb")
+            line = stdout.readline()
+            if not line:
+                stderr = channel.makefile_stderr("rb").read().decode(errors="replace").strip()
+                raise Exception(f"chaos agent exited before ready: {stderr or 'no output'}")
+            frame = json.loads(line)
+            if not frame.get("ready") or frame.get("version") != AGENT_VERSION:
+                raise Exception(f"unexpected frame from chaos agent: {frame}")
+            # 之后读结果的线程一直阻塞在这个channel上
+            channel.settimeout(None)
+        except Exception:
+            channel.close()
+            raise
+        self.channel = channel
+        self.reader = threading.Thread(target=self.read_responses, args=(stdout,), daemon=True,
+                                       name=f"chaos_agent_{self.session.host}")
+        self.reader.start()
+        logging.info(f"Chaos agent on {self.session.host} is ready.")
+
+    def read_responses(self, stdout):
+        try:
+            for line in stdout:
+                try:
+                    frame = json.loads(line)
+                except ValueError:
+                    logging.warning(f"Bad frame from chaos agent on {self.session.host}: {line[:200]!r}")
+                    continue
+                with self.lock:
+                    future = self.pending.pop(frame.get("id"), None)
+                if future is None:
+                    logging.warning(f"Chaos agent on {self.session.host} replied to unknown command: {frame}")
+                    continue
+                future.set_result(frame)
+        except Exception as e:
+            logging.warning(f"Reading from chaos agent on {self.session.host} failed: {e}")
+        # channel断了，在途的命令不会再有结果，这些命令是否已经执行是不确定的
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.set_exception(ConnectionError(f"Chaos agent on {self.session.host} is disconnected."))
+
+    def is_alive(self) -> bool:
+        return self.channel is not None and not self.closed and not self.channel.closed \
+            and self.session.is_alive()
+
+    def run(self, command: str, barrier: Optional[threading.Barrier] = None,
+            timeout: Optional[float] = None) -> CommandResult:
+        """让代理执行命令并等待结果，timeout是命令在节点上执行的最长时间
+
+        传入barrier时，会在发出命令之前等待barrier。
+        """
+        future: Future = Future()
+        with self.lock:
+            if self.closed or self.channel is None:
+                if barrier is not None:
+                    barrier.abort()
+                raise ConnectionError(f"Chaos agent on {self.session.host} is not running.")
+            command_id = next(self.ids)
+            self.pending[command_id] = future
+        frame = (json.dumps({"id": command_id, "command": command, "timeout": timeout}) + "\n").encode()
+        if barrier is not None:
+            try:
+                barrier.wait(timeout=self.session.timeout)
+            except threading.BrokenBarrierError:
+                logging.warning(f"Barrier broken before executing {command} on {self.session.host}, sending without sync.")
+        try:
+            # 多个线程共用一个channel，一帧要完整地写进去
+            with self.send_lock:
+                sent_at = time.monotonic()
+                self.channel.sendall(frame)
+        except Exception:
+            with self.lock:
+                self.pending.pop(command_id, None)
+            raise
+        response = future.result()
+        if "error" in response:
+            raise Exception(response["error"])
+        return CommandResult(response["stdout"], response["stderr"], response["exit_status"], sent_at)
+
+    def close(self):
+        """关闭stdin，代理等正在执行的命令结束后自己退出"""
+        channel, self.channel = self.channel, None
+        if channel is None:
+            return
+        try:
+            channel.shutdown_write()
+        except Exception:
+            pass
+        channel.close()
+        logging.info(f"Chaos agent on {self.session.host} is stopped.")
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from typing import Optional, Union
+
+from .db import Database, StatementError
+from .router import LeaderRouter
+
+WRITE_MODES = ("none", "transaction", "queue")
+
+
+class WriteBatcher:
+    """单个节点（或者经由LeaderRouter发给当前leader）的攒批写管道
+
+    submit的语句先进入待发送队列，攒够batch_size条或者等待linger秒后合并成一次/db/execute请求发出，
+    每条语句的结果再分别交还给各自的调用者。write_mode为transaction时整批在一个事务里执行，
+    任意一条失败则整批失败；为queue时使用rqlite的队列写，返回即表示已被接受。
+    """
+    database: Union[Database, LeaderRouter]
+    batch_size: int
+    linger: float
+    write_mode: str
+
+    def __init__(self, database: Union[Database, LeaderRouter], batch_size: int = 100, linger: float = 0.005, write_mode: str = "none"):
+        if write_mode not in WRITE_MODES:
+            raise ValueError(f"Unknown write mode: {write_mode}")
+        self.database = database
+        self.batch_size = batch_size
+        self.linger = linger
+        self.write_mode = write_mode
+        self.pending: list[tuple[list, asyncio.Future]] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.sending: set[asyncio.Task] = set()
+
+    async def submit(self, statement: list) -> dict:
+        """提交一条语句，例如 ["INSERT INTO tc VALUES(?, ?)", "client1", 1]，返回这条语句的执行结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((statement, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.linger, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self.send(batch))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def send(self, batch: list[tuple[list, asyncio.Future]]):
+        try:
+            results = await self.database.execute_batch([statement for statement, _ in batch],
+                                                        transaction=self.write_mode == "transaction",
+                                                        queue=self.write_mode == "queue")
+        except Exception as e:
+            # 请求本身失败时不知道哪些语句已经生效
+            logging.warning(f"Batch of {len(batch)} statements to {self.database.name} failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        errors = [result.get("error") for result in results if result.get("error")]
+        for i, (statement, future) in enumerate(batch):
+            if future.done():
+                continue
+            if self.write_mode == "transaction" and errors:
+                # 事务被整体回滚
+                future.set_exception(StatementError(f"Transaction rolled back: {errors[0]}"))
+            elif i >= len(results):
+                future.set_exception(StatementError("Statement was not executed because an earlier one failed."))
+            elif error := results[i].get("error"):
+                future.set_exception(StatementError(error))
+            else:
+                future.set_result(results[i])
+
+    async def close(self):
+        self.flush()
+        if self.sending:
+            await asyncio.gather(*self.sending, return_exceptions=True)
@@ -1,11 +1,17 @@
 import json
 import logging
 import asyncio
+import multiprocessing
 from typing import Type
+from concurrent.futures import ProcessPoolExecutor
 from abc import ABC, abstractmethod
 
 from .db import Database, alias_database_dict
 from .tools import time_string_to_seconds
+from .history import history
+from .linearizability import check_linearizability
+from .list_append import check_list_append
+from .integrity import IntegrityReport, scan_integrity, diff_reports
 
 class Check(ABC):
     """所有检查的基类"""
@@ -29,24 +35,98 @@ class Check(ABC):
     
 
 class IntegrityCheck(Check):
-    def __init__(self, start_time):
+    """检查tc表的count列是否连续、无重复；nodes为"all"时并行检查每个副本并比较它们的差异"""
+    def __init__(self, start_time, page_size: int = 10000, nodes: str = "one", expected_start: int = 1):
         super().__init__("Integrity Check", start_time)
+        self.page_size = page_size
+        self.nodes = nodes
+        self.expected_start = expected_start
+        self.reports: list[IntegrityReport] = []
+        self.differences: list[str] = []
     
     async def start(self) -> bool:
-        await asyncio.sleep(self.start_time)
-        sql = [f"select * from tc order by count"]
-        output = await self.query_sql(sql)
-        print(output)
-        values = (output[0]).get("values")
-        if values is None:
-            return True
-        for i in range(len(values) - 1):
-            if values[i][1] + 1 != values[i+1][1]:
-                return True
-        logging.info("Integrity check passed!")
-        return False
+        if self.nodes == "all":
+            # level=none读的是各节点本地的数据，这样才能看到副本之间的差异
+            self.reports = list(await asyncio.gather(*(scan_integrity(database, self.page_size, "none", self.expected_start)
+                                                       for database in alias_database_dict.values())))
+        else:
+            database = list(alias_database_dict.values())[0]
+            self.reports = [await scan_integrity(database, self.page_size, expected_start=self.expected_start)]
+        self.differences = diff_reports(self.reports)
+
+        bug_found = False
+        for report in self.reports:
+            if report.has_anomaly:
+                bug_found = True
+                logging.error(f"Integrity check failed on {report.node}: {json.dumps(report.to_dict())}")
+        for difference in self.differences:
+            bug_found = True
+            logging.error(f"Replicas diverge: {difference}")
+        if not bug_found:
+            logging.info(f"Integrity check passed on {len(self.reports)} node(s)!")
+        return bug_found
+        
+        
+class LinearizabilityCheck(Check):
+    """检查本次运行记录的寄存器/CAS历史是否线性一致"""
+    def __init__(self, start_time, time_limit: str = "60s", max_states: int = 1_000_000, workers: int = None,
+                 shrink_limit: int = 2000):
+        super().__init__("Linearizability Check", start_time)
+        self.time_limit = time_string_to_seconds(time_limit)
+        self.max_states = max_states
+        self.workers = workers
+        self.shrink_limit = shrink_limit
+        self.results: list[dict] = []
+
+    async def start(self) -> bool:
+        if history.path is None:
+            logging.warning("History is not recorded, skip linearizability check.")
+            return False
+        history.flush()
+        self.results = await check_linearizability(history.path, self.time_limit, self.max_states,
+                                                   self.workers, self.shrink_limit)
+        bug_found = False
+        for result in self.results:
+            if result["valid"] is False:
+                bug_found = True
+                logging.error(f"Key {result['key']} is not linearizable, operation {result['failed_op']} "
+                              f"cannot be linearized. Counterexample: {json.dumps(result['counterexample'])}")
+            elif result["valid"] is None:
+                logging.warning(f"Linearizability of key {result['key']} is unknown: "
+                                f"time or state budget exhausted after {result['elapsed']:.2f}s.")
+        if not bug_found:
+            logging.info(f"Linearizability check passed on {len(self.results)} keys!")
+        return bug_found
         
         
+class ListAppendCheck(Check):
+    """从本次运行记录的list-append事务历史里找事务隔离异常（G0、G1a/b/c、G-single、G2等）"""
+    def __init__(self, start_time, max_reports: int = 20):
+        super().__init__("List Append Check", start_time)
+        self.max_reports = max_reports
+        self.result: dict = {}
+
+    async def start(self) -> bool:
+        if history.path is None:
+            logging.warning("History is not recorded, skip list append check.")
+            return False
+        history.flush()
+        loop = asyncio.get_running_loop()
+        # 分析是CPU密集的，放到子进程里，不阻塞事件循环；和其他进程池一样用spawn启动
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            self.result = await loop.run_in_executor(pool, check_list_append, history.path, self.max_reports)
+        if self.result["valid"]:
+            logging.info(f"List append check passed on {self.result['transactions']} transactions "
+                         f"({self.result['edges']} dependencies) in {self.result['elapsed']:.2f}s!")
+            return False
+        logging.error(f"List append check found anomalies: {json.dumps(self.result['anomaly_counts'])}")
+        for anomaly in self.result["anomalies"]:
+            logging.error(f"{anomaly['type']}: {anomaly['explanation']}")
+        return True
+
+
 CHECK_MAPPING: dict[str, Type[Check]] = {
-    "integrity_check": IntegrityCheck
+    "integrity_check": IntegrityCheck,
+    "linearizability_check": LinearizabilityCheck,
+    "list_append_check": ListAppendCheck
 }
\ No newline at end of file
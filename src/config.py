@@ -7,9 +7,19 @@ class DatabaseConfig:
     db_password: str
     retry_count: int
     timeout: int
+    max_connections: int
+    max_inflight: int
+    retry_base_delay: float
+    retry_max_delay: float
+    retry_deadline: float
+    breaker_threshold: int
+    breaker_reset_timeout: float
     
     def __init__(self, name: str, host: str, api_port: int, ssh_port: int = 22, db_username: str = "centos", 
-                 db_password: str = "password", retry_count: int = 5, timeout: int = 3):
+                 db_password: str = "password", retry_count: int = 5, timeout: int = 3,
+                 max_connections: int = 32, max_inflight: int = 64, retry_base_delay: float = 0.1,
+                 retry_max_delay: float = 2.0, retry_deadline: float = 10.0, breaker_threshold: int = 5,
+                 breaker_reset_timeout: float = 5.0):
         self.name = name
         self.host = host
         self.api_port = api_port
@@ -18,6 +28,13 @@ class DatabaseConfig:
         self.db_password = db_password
         self.retry_count = retry_count
         self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_inflight = max_inflight
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.retry_deadline = retry_deadline
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
 
     def __str__(self):
         return (f"Database_Config({self.name}: host={str(self.host)}, ssh_port={self.ssh_port}, "
@@ -32,9 +49,15 @@ class ChaosConfig:
     chaos_password: str
     retry_count: int
     timeout: int
+    retry_base_delay: float
+    retry_max_delay: float
+    use_agent: bool
+    agent_python: str
     
     def __init__(self, name: str, host: str, ssh_port: int = 22, chaos_username: str = "root",
-                 chaos_password: str = "password", retry_count: int = 3, timeout: int = 3):
+                 chaos_password: str = "password", retry_count: int = 3, timeout: int = 3,
+                 retry_base_delay: float = 0.1, retry_max_delay: float = 2.0, use_agent: bool = True,
+                 agent_python: str = "python3"):
         self.name = name
         self.host = host
         self.ssh_port = ssh_port
@@ -42,6 +65,10 @@ class ChaosConfig:
         self.chaos_password = chaos_password
         self.retry_count = retry_count
         self.timeout = timeout
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.use_agent = use_agent
+        self.agent_python = agent_python
 
     def __str__(self):
         return (f"Chaos_Config({self.name}: host={self.host}, ssh_port={self.ssh_port}, chaos_username={self.chaos_username}")
@@ -49,4 +76,5 @@ class ChaosConfig:
 
 alias_host_dict: dict[str, str] = {}
 host_alias_dict: dict[str, str] = {}
-injected_host_list: list[str] = []
\ No newline at end of file
+# 当前还有故障生效的节点，由FaultRegistry维护
+injected_host_list: set[str] = set()
\ No newline at end of file
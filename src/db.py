@@ -1,32 +1,93 @@
 import json
-import asyncio
-import requests
-import paramiko
 import logging
 from threading import Thread
+from typing import Callable, Optional
+
+import aiohttp
 
 from .config import DatabaseConfig
+from .http_client import HttpClient, HttpResponse
+from .ssh_pool import SSHSession, ssh_pool
+from .logging_config import log_context
+from .retry import RetryPolicy, CircuitBreaker, DefiniteError
+
+# workload用到的表和各自的建表语句，重置集群时整体删掉重建
+WORKLOAD_TABLES: dict[str, list[str]] = {
+    "tc": ["CREATE TABLE IF NOT EXISTS tc (name TEXT, count int);",
+           "CREATE INDEX IF NOT EXISTS tc_count ON tc (count);"],
+    "registers": ["CREATE TABLE IF NOT EXISTS registers (id INTEGER PRIMARY KEY, value INTEGER);"],
+    "lists": ["CREATE TABLE IF NOT EXISTS lists (id INTEGER PRIMARY KEY, value TEXT);"],
+}
+
+# 写请求被重定向或者集群暂时没有leader时会通知这些回调（例如让拓扑缓存失效）
+topology_listeners: list[Callable[[], None]] = []
+
+
+def notify_topology_change():
+    for listener in topology_listeners:
+        listener()
+
+
+class StatementError(DefiniteError):
+    """rqlite明确返回了某条语句的错误，说明这条语句确定没有生效"""
+    retryable = False
+
+
+class NotLeaderError(DefiniteError):
+    """请求被重定向到leader，这个节点没有执行它；location是rqlite给出的leader地址
+
+    重试同一个节点没有意义，由LeaderRouter跟随重定向。
+    """
+    retryable = False
+
+    def __init__(self, message: str, location: Optional[str] = None):
+        super().__init__(message)
+        self.location = location
+
+
+class NodeUnreachableError(DefiniteError):
+    """连接没有建立起来，请求没有发出"""
+    node_failure = True
+
+
+def check_write_response(response: HttpResponse):
+    """把/db/execute的非200回复转换成相应的异常"""
+    if response.status in (301, 302, 307, 308):
+        notify_topology_change()
+        raise NotLeaderError(f"Status_code: {response.status}, leader may have changed: {response.text}",
+                             response.headers.get("Location"))
+    if response.status == 503:
+        notify_topology_change()
+        raise Exception(f"Status_code: {response.status}, leader may have changed: {response.text}")
+    if response.status != 200:
+        raise Exception(f"Status_code: {response.status}, error: {response.text}")
 
 
 class Database:
     def __init__(self, config: DatabaseConfig):
         self.config = config
-        self.ssh_client = None
-        self.api_url_base = f"http://{config.host}:{self.config.api_port}/db"
+        self.http_client = HttpClient(f"http://{config.host}:{config.api_port}", config.max_connections,
+                                      config.max_inflight, config.timeout, name=config.name)
+        self.retry_policy = RetryPolicy(config.retry_count, config.retry_base_delay, config.retry_max_delay,
+                                        config.retry_deadline)
+        self.breaker = CircuitBreaker(config.name, config.breaker_threshold, config.breaker_reset_timeout)
+
+    @property
+    def name(self) -> str:
+        return self.config.name
+
+    def get_session(self) -> SSHSession:
+        return ssh_pool.get_session(self.config.host, self.config.ssh_port, self.config.db_username,
+                                    self.config.db_password, self.config.timeout)
 
     def setupDB(self):
         logging.debug(f"Connecting to rqlite database at {self.config.host}...")
         
         try:
-            self.ssh_client = paramiko.SSHClient()
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # 自动接受主机密钥
-            self.ssh_client.connect(self.config.host, port=self.config.ssh_port,
-                                    username=self.config.db_username, password=self.config.db_password)
             start_db_command = "bash /home/centos/start_db.sh"
-            stdin, stdout, stderr = self.ssh_client.exec_command(start_db_command)
-            error = stderr.read().decode()
-            if error:
-                raise Exception(error)
+            result = self.get_session().run(start_db_command)
+            if result.stderr:
+                raise Exception(result.stderr)
             logging.info(f"SSH connection to {self.config.host} has established. Database is activated.")
         except Exception as e:
             logging.error(f"[ERROR] Failed to execute start_db command: {e}")
@@ -34,74 +95,179 @@ class Database:
     async def init_table_tc(self):
         try:
             # 此处的语句可以做一些调整，甚至不必一定要用这一套方法来init
-            create_table_sql = [
-                "CREATE TABLE IF NOT EXISTS tc (name TEXT, count int);", 
-                "DELETE FROM tc;"
-            ]
+            create_table_sql = WORKLOAD_TABLES["tc"] + ["DELETE FROM tc;"]
             await self.execute(create_table_sql)
             logging.info(f"Init database and create table tc successfully.")
         except Exception as e:
             logging.error(f"Failed to connect to SSH or setup database: {e}")
             raise
 
+    async def init_table_registers(self):
+        """寄存器/CAS workload使用的表，每个key一行，没有行表示寄存器还没有被写过（读到None）"""
+        try:
+            create_table_sql = WORKLOAD_TABLES["registers"] + ["DELETE FROM registers;"]
+            await self.execute(create_table_sql)
+            logging.info(f"Init database and create table registers successfully.")
+        except Exception as e:
+            logging.error(f"Failed to create table registers: {e}")
+            raise
+
+    async def init_table_lists(self):
+        """list-append workload使用的表，每个key一行，value是逗号分隔的追加值"""
+        try:
+            create_table_sql = WORKLOAD_TABLES["lists"] + ["DELETE FROM lists;"]
+            await self.execute(create_table_sql)
+            logging.info(f"Init database and create table lists successfully.")
+        except Exception as e:
+            logging.error(f"Failed to create table lists: {e}")
+            raise
+
     def teardownDB(self):
-        if self.ssh_client is None:
-            self.ssh_client = paramiko.SSHClient()
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # 自动接受主机密钥
-            self.ssh_client.connect(self.config.host, port=self.config.ssh_port,
-                                    username=self.config.db_username, password=self.config.db_password)
-            
+        # SSH连接由ssh_pool复用，这里不再单独建立或关闭连接
         try:
             close_db_command = "bash /home/centos/kill_old_db_connect.sh"
-            stdin, stdout, stderr = self.ssh_client.exec_command(close_db_command)
-            error = stderr.read().decode()
-            if error:
-                raise Exception(error)
-            self.ssh_client.close()
-            logging.info(f"SSH connection to database node {self.config.host} has already closed. SSH connection is closed.")
+            result = self.get_session().run(close_db_command)
+            if result.stderr:
+                raise Exception(result.stderr)
+            logging.info(f"Database on node {self.config.host} has already stopped.")
         except Exception as e:
             logging.error(f"Error closing database at {self.config.host}: {e}")
         
 
-    async def execute(self, sql: list[str]) -> bool:
-        for i in range(self.config.retry_count):
-            try:
-                logging.debug(f"Executing SQL query: {sql}")
-                url = f"{self.api_url_base}/execute?pretty&timings"
-                response = requests.post(url, json=sql, headers={"Content-Type": "application/json"}, timeout=self.config.timeout)
-                if response.status_code == 200:
-                    if error_message := (response.json()).get("error"):
-                        raise Exception(error_message)
-                    results = (response.json()).get("results")
-                    # 如果这里包含多语句的话，是不是还需要有一些rollback？
-                    print(response.status_code)
-                    print(response.text)
-                    logging.info(f"Query {sql} executed successfully.")
-                    return True
-                else:
-                    raise Exception(f"Status_code: {response.status_code}, error: {response.text}")
-            except Exception as e:
-                logging.warning(f"Retrying to execute {sql}: {e} for {i+1}/{self.config.retry_count}....")
-            await asyncio.sleep(1)
-        logging.error(f"[ERROR] Failed to execute {sql} for {self.config.retry_count} times")    
-        raise Exception(f"[ERROR] Failed to execute {sql} for {self.config.retry_count} times")
-        
-    async def query(self, sql: list[str]):
-        for i in range(self.config.retry_count):
-            try:
-                logging.debug(f"Querying SQL query: {sql}")
-                url = f"{self.api_url_base}/query?pretty&timings"
-                response = requests.post(url, json=sql, headers={"Content-Type": "application/json"}, timeout=self.config.timeout)
-                if response.status_code == 200:
-                    logging.info(f"Query {sql} successfully.")
-                    return (response.json()).get("results")
-                else:
-                    raise Exception(f"Status_code: {response.status_code}, error: {response.text}")
-            except Exception as e:
-                logging.warning(f"Retrying to query {sql} for {i+1}/{self.config.retry_count}....")
-            await asyncio.sleep(0.5)
-        logging.error(f"[ERROR] Failed to query {sql} for {self.config.retry_count} times")    
-        raise Exception(f"[ERROR] Failed to query {sql} for {self.config.retry_count} times")
+    async def post(self, path: str, payload: list, timeout: float) -> HttpResponse:
+        try:
+            return await self.http_client.post(path, payload, min(timeout, self.config.timeout))
+        except aiohttp.ClientConnectorError as e:
+            raise NodeUnreachableError(f"Connect to {self.config.host} failed: {e}") from e
+
+    @staticmethod
+    def with_redirect(path: str, redirect: bool) -> str:
+        # 带上redirect时follower不再替我们转发给leader，而是返回301和leader的地址
+        return f"{path}&redirect" if redirect else path
+
+    async def execute_once(self, sql: list, timeout: float, redirect: bool = False) -> list[dict]:
+        """发送一次/db/execute请求，返回每条语句各自的结果，不重试，也不经过熔断器
+
+        任何一条语句被拒绝都抛出StatementError，调用方不会把没有生效的写入当成成功。
+        """
+        logging.debug("Executing SQL query: %s", sql)
+        response = await self.post(self.with_redirect("/db/execute?timings", redirect), sql, timeout)
+        check_write_response(response)
+        body = response.json()
+        if error_message := body.get("error"):
+            raise StatementError(error_message)
+        results = body.get("results", [])
+        # 如果这里包含多语句的话，是不是还需要有一些rollback？
+        for result in results:
+            if error_message := result.get("error"):
+                raise StatementError(error_message)
+        logging.debug("Query %s executed successfully: %s", sql, response.text)
+        return results
+
+    async def execute(self, sql: list[str], idempotent: bool = True) -> list[dict]:
+        """idempotent为False时，结果不确定的请求不会被重发"""
+        with log_context(node=self.config.name):
+            return await self.retry_policy.run(lambda timeout: self.execute_once(sql, timeout), "execute",
+                                               self.config.name, self.breaker, f"execute {sql}", idempotent)
+
+    async def send_batch(self, statements: list, timeout: float, transaction: bool = False, queue: bool = False,
+                         redirect: bool = False) -> list[dict]:
+        """发送一次多语句的/db/execute请求，不重试，也不经过熔断器"""
+        path = "/db/execute?timings"
+        if transaction:
+            path += "&transaction"
+        if queue:
+            path += "&queue"
+        logging.debug("Executing %d statements in one request.", len(statements))
+        response = await self.post(self.with_redirect(path, redirect), statements, timeout)
+        check_write_response(response)
+        body = response.json()
+        if error_message := body.get("error"):
+            raise Exception(error_message)
+        if queue:
+            return [{"sequence_number": body.get("sequence_number")} for _ in statements]
+        return body.get("results", [])
+
+    async def execute_batch(self, statements: list, transaction: bool = False, queue: bool = False) -> list[dict]:
+        """一次/db/execute请求执行多条（可以是带参数的）语句，返回每条语句各自的结果
+
+        不做重试：一批写入重发可能导致重复写。queue模式下rqlite只返回sequence_number，
+        每条语句的结果都是{"sequence_number": n}。
+        """
+        # 不重试，但同样受熔断器保护
+        return await self.breaker.call(self.send_batch, statements, self.config.timeout, transaction, queue)
+
+    async def query_once(self, sql: list, timeout: float, level: str = None, redirect: bool = False):
+        """发送一次/db/query请求，不重试，也不经过熔断器"""
+        path = "/db/query?timings" if level is None else f"/db/query?timings&level={level}"
+        logging.debug("Querying SQL query: %s", sql)
+        response = await self.post(self.with_redirect(path, redirect), sql, timeout)
+        if response.status in (301, 302, 307, 308):
+            raise NotLeaderError(f"Status_code: {response.status}, error: {response.text}",
+                                 response.headers.get("Location"))
+        if response.status != 200:
+            raise Exception(f"Status_code: {response.status}, error: {response.text}")
+        logging.debug("Query %s successfully.", sql)
+        return (response.json()).get("results")
+
+    async def query(self, sql: list, level: str = None):
+        """level为rqlite的读一致性级别（none/weak/strong），为None时使用rqlite默认的weak"""
+        with log_context(node=self.config.name):
+            return await self.retry_policy.run(lambda timeout: self.query_once(sql, timeout, level), "query",
+                                               self.config.name, self.breaker, f"query {sql}")
+
+    async def request_once(self, statements: list, timeout: float, transaction: bool = False, level: str = None,
+                           redirect: bool = False) -> list[dict]:
+        """发送一次/db/request请求（读写可以混在同一个事务里），不重试，也不经过熔断器"""
+        path = "/db/request?timings"
+        if transaction:
+            path += "&transaction"
+        if level is not None:
+            path += f"&level={level}"
+        logging.debug("Requesting %d statements in one request.", len(statements))
+        response = await self.post(self.with_redirect(path, redirect), statements, timeout)
+        check_write_response(response)
+        body = response.json()
+        if error_message := body.get("error"):
+            raise StatementError(error_message)
+        return body.get("results", [])
+
+    async def request(self, statements: list, transaction: bool = False, level: str = None,
+                      idempotent: bool = True) -> list[dict]:
+        with log_context(node=self.config.name):
+            return await self.retry_policy.run(
+                lambda timeout: self.request_once(statements, timeout, transaction, level), "request",
+                self.config.name, self.breaker, f"request {statements}", idempotent)
+
+    async def status(self, timeout: float = None) -> dict:
+        response = await self.http_client.get("/status", timeout)
+        if response.status != 200:
+            raise Exception(f"Status_code: {response.status}, error: {response.text}")
+        return response.json()
+
+    async def debug_vars(self, timeout: float = None) -> dict:
+        """rqlite通过/debug/vars导出的expvar变量"""
+        response = await self.http_client.get("/debug/vars", timeout)
+        if response.status != 200:
+            raise Exception(f"Status_code: {response.status}, error: {response.text}")
+        return response.json()
+
+    async def backup(self, timeout: float = None) -> bytes:
+        """通过/db/backup下载整个SQLite数据库文件，需要发给leader"""
+        response = await self.http_client.request("GET", "/db/backup", timeout=timeout, binary=True)
+        check_write_response(response)
+        return response.body
+
+    async def load(self, data: bytes, timeout: float = None):
+        """通过/db/load用SQLite数据库文件整体替换集群里的数据，需要发给leader"""
+        response = await self.http_client.request("POST", "/db/load", timeout=timeout, data=data,
+                                                  content_type="application/octet-stream")
+        check_write_response(response)
+        if response.text and (error_message := response.json().get("error")):
+            raise StatementError(error_message)
+
+    async def close(self):
+        await self.http_client.close()
         
 
 alias_database_dict: dict[str, Database] = {}
\ No newline at end of file
@@ -1,47 +1,131 @@
+import time
+import asyncio
 import logging
-import paramiko
+import threading
+import contextvars
+from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
 
+from .agent import AgentClient
 from .config import ChaosConfig
+from .ssh_pool import SSHSession, ssh_pool
+from .metrics import metrics
+from .logging_config import log_context
+from .retry import RetryPolicy
+
+# paramiko是阻塞的，所有SSH命令都放到这个线程池里执行，避免卡住事件循环。
+# 线程数要大于集群规模，否则带barrier的并发注入会互相等待
+fault_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="fault_injector")
+# 代理启动失败后先用SSH exec执行命令，过这么久（秒）再尝试启动代理
+AGENT_RETRY_INTERVAL = 30
 
 class FaultInjector:
     def __init__(self, config: ChaosConfig):
         self.config = config
-        self.connection = None
-        self.ssh_client = None
+        self.session: Optional[SSHSession] = None
+        self.retry_policy = RetryPolicy(config.retry_count, config.retry_base_delay, config.retry_max_delay)
+        self.agent: Optional[AgentClient] = None
+        self.agent_lock = threading.Lock()
+        self.agent_failed_at: Optional[float] = None
 
     def connect(self):
-        logging.debug(f"Connecting to root at {self.config.host}...")
-        
         try:
-            self.ssh_client = paramiko.SSHClient()
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # 自动接受主机密钥
-            self.ssh_client.connect(self.config.host, port=self.config.ssh_port,
-                                    username=self.config.chaos_username, password=self.config.chaos_password)
-            logging.info(f"SSH connection to {self.config.host} has already established.")
-
+            self.session = ssh_pool.get_session(self.config.host, self.config.ssh_port, self.config.chaos_username,
+                                                self.config.chaos_password, self.config.timeout)
+            self.session.get_transport()
         except Exception as e:
             logging.error(f"Failed to connect to SSH: {e}")
             raise
+        if self.config.use_agent:
+            self.start_agent()
 
-    def execute_command(self, command):
-        for i in range(self.config.retry_count):
+    def start_agent(self) -> Optional[AgentClient]:
+        """返回正在运行的代理，没有就启动一个；启动失败返回None，AGENT_RETRY_INTERVAL秒内不再尝试"""
+        with self.agent_lock:
+            if self.agent is not None and self.agent.is_alive():
+                return self.agent
+            if self.agent_failed_at is not None and time.monotonic() - self.agent_failed_at < AGENT_RETRY_INTERVAL:
+                return None
+            if self.agent is not None:
+                logging.warning(f"Chaos agent on {self.config.host} is down, restarting it...")
+                self.agent.close()
+                self.agent = None
+            agent = AgentClient(self.session, self.config.agent_python)
             try:
-                # 需要保证这个指令不是持续的（如果是，那就需要使用nohup）
-                stdin, stdout, stderr = self.ssh_client.exec_command(command)
-                output = stdout.read().decode()
-                error = stderr.read().decode()
-                if error:
-                    raise Exception(error)
-                return output
+                agent.start()
             except Exception as e:
-                logging.warning(f"Retrying to execute {command}: {e} for {i+1}/{self.config.retry_count}....")
-        logging.error(f"[ERROR] Failed to execute {command} for {self.config.retry_count} times")    
-        raise Exception(f"[ERROR] Failed to execute {command} for {self.config.retry_count} times")
+                self.agent_failed_at = time.monotonic()
+                logging.warning(f"Failed to start chaos agent on {self.config.host}, falling back to SSH exec: {e}")
+                return None
+            self.agent = agent
+            self.agent_failed_at = None
+            return agent
+
+    def get_runner(self) -> Union[AgentClient, SSHSession]:
+        """优先把命令交给节点上的代理，代理不可用时每条命令单独开SSH channel执行"""
+        if self.config.use_agent:
+            agent = self.start_agent()
+            if agent is not None:
+                return agent
+        return self.session
+
+    def execute_command(self, command):
+        output, _ = self.execute_command_timed(command)
+        return output
+
+    def execute_command_timed(self, command, barrier: Optional[threading.Barrier] = None) -> tuple[str, float]:
+        """执行命令，返回输出以及命令真正发出的时刻（time.monotonic）
+
+        传入barrier时，会先把channel准备好，等所有节点都到达barrier后再同时发出命令。
+        """
+        with log_context(node=self.config.name):
+            if self.session is None:
+                self.connect()
+            command_name = " ".join(command.split()[:2])
+            for i in range(self.config.retry_count):
+                begin = time.perf_counter()
+                runner = self.get_runner()
+                transport = "agent" if runner is self.agent else "exec"
+                try:
+                    # 需要保证这个指令不是持续的（如果是，那就需要使用nohup）
+                    # 只有第一次尝试参与barrier，重试时其他节点早已经发出命令了
+                    result = runner.run(command, barrier if i == 0 else None)
+                    if result.stderr:
+                        raise Exception(result.stderr)
+                    # 从命令真正发出开始计时，不算在barrier处等待其他节点的时间
+                    metrics.record_operation("ssh_command", time.monotonic() - result.sent_at, "ok",
+                                             node=self.config.name, command=command_name, transport=transport)
+                    return result.stdout, result.sent_at
+                except Exception as e:
+                    metrics.record_operation("ssh_command", time.perf_counter() - begin, "error",
+                                             node=self.config.name, command=command_name, transport=transport)
+                    if not self.session.is_alive():
+                        logging.warning(f"SSH transport to {self.config.host} is down, it will be re-established on retry.")
+                    if i + 1 < self.config.retry_count:
+                        # 运行在fault_executor的线程里，可以直接阻塞等待
+                        delay = self.retry_policy.backoff(i + 1)
+                        metrics.increment("retry_total", op=command_name, node=self.config.name)
+                        logging.warning(f"Retrying to execute {command} in {delay:.2f}s: {e} for {i+1}/{self.config.retry_count}....")
+                        time.sleep(delay)
+            metrics.increment("retry_give_up_total", op=command_name, node=self.config.name, outcome="indeterminate")
+            logging.error(f"[ERROR] Failed to execute {command} for {self.config.retry_count} times")    
+            raise Exception(f"[ERROR] Failed to execute {command} for {self.config.retry_count} times")
+
+    async def execute_command_async(self, command, barrier: Optional[threading.Barrier] = None) -> tuple[str, float]:
+        loop = asyncio.get_running_loop()
+        # 和asyncio.to_thread一样把当前上下文带进线程，日志里才有event_id
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(fault_executor, context.run, self.execute_command_timed, command, barrier)
 
     def close(self):
-        if self.ssh_client:
-            self.ssh_client.close()
-            logging.info(f"[INFO] Connection to {self.config.host} has already closed.")
+        with self.agent_lock:
+            if self.agent is not None:
+                self.agent.close()
+                self.agent = None
+        # 连接归ssh_pool所有，这里只是放弃引用，真正关闭在ssh_pool.close_all()
+        if self.session is not None:
+            self.session = None
+            logging.info(f"[INFO] Injector of {self.config.host} has released its SSH session.")
         
         
-alias_injector_dict: dict[str, FaultInjector] = {}
\ No newline at end of file
+alias_injector_dict: dict[str, FaultInjector] = {}
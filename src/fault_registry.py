@@ -0,0 +1,198 @@
+import json
+import asyncio
+import logging
+from typing import Callable, Iterable, Optional
+
+from .config import injected_host_list
+from .fault_injector import FaultInjector
+from .history import history, INFO, NEMESIS_PROCESS
+from .metrics import metrics
+
+
+def parse_blade_outputs(output: str) -> list[dict]:
+    """解析一次SSH执行里多条blade命令依次输出的JSON对象"""
+    decoder = json.JSONDecoder()
+    results: list[dict] = []
+    position = 0
+    output = output.strip()
+    while position < len(output):
+        result, end = decoder.raw_decode(output, position)
+        results.append(result)
+        position = end
+        while position < len(output) and output[position] in " \t\r\n;":
+            position += 1
+    return results
+
+
+def blade_succeeded(result: Optional[dict]) -> bool:
+    return bool(result) and result.get("code", 0) == 200 and result.get("success", False)
+
+
+def experiment_gone(result: Optional[dict]) -> bool:
+    """blade找不到这个实验，说明它已经被--timeout或者别的进程销毁了"""
+    return bool(result) and "not found" in str(result.get("error", ""))
+
+
+class ActiveFault:
+    """一个正在生效的blade实验"""
+    __slots__ = ("uid", "injector", "nemesis", "metrics_id")
+
+    def __init__(self, uid: str, injector: FaultInjector, nemesis: str, metrics_id: int):
+        self.uid = uid
+        self.injector = injector
+        self.nemesis = nemesis
+        self.metrics_id = metrics_id
+
+
+class FaultRegistry:
+    """记录所有生效中的故障，负责按时恢复、批量销毁以及退出时的统一清理
+
+    到期的故障先进入待销毁队列，同一时刻到期的、同一节点上的多个故障合并成一次SSH往返；
+    injected_host_list始终等于当前还有故障的节点集合。
+    """
+
+    def __init__(self):
+        self.faults: dict[str, ActiveFault] = {}
+        self.recover_handles: dict[str, asyncio.TimerHandle] = {}
+        self.pending: dict[FaultInjector, set[str]] = {}
+        self.flush_handle: Optional[asyncio.Handle] = None
+        self.destroying: set[asyncio.Task] = set()
+        # injected_host_list变化时通知这些回调（例如同步给分片的工作进程）
+        self.listeners: list[Callable[[set[str]], None]] = []
+
+    def notify(self):
+        for listener in self.listeners:
+            listener(injected_host_list)
+
+    def register(self, injector: FaultInjector, uid: str, nemesis: str, duration: float):
+        """登记一个注入成功的故障，duration秒后自动恢复"""
+        self.faults[uid] = ActiveFault(uid, injector, nemesis, metrics.fault_started())
+        injected_host_list.add(injector.config.host)
+        self.notify()
+        if duration > 0:
+            loop = asyncio.get_running_loop()
+            self.recover_handles[uid] = loop.call_later(duration, self.schedule_destroy, uid)
+
+    def schedule_destroy(self, uid: str):
+        fault = self.faults.get(uid)
+        if fault is None:
+            return
+        self.pending.setdefault(fault.injector, set()).add(uid)
+        if self.flush_handle is None:
+            # 等这一轮回调都执行完，把同时到期的故障攒在一起
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        pending, self.pending = self.pending, {}
+        for injector, uids in pending.items():
+            task = asyncio.create_task(self.destroy(injector, sorted(uids)))
+            self.destroying.add(task)
+            task.add_done_callback(self.destroying.discard)
+
+    def forget(self, uid: str):
+        fault = self.faults.pop(uid, None)
+        if handle := self.recover_handles.pop(uid, None):
+            handle.cancel()
+        if fault is None:
+            return
+        metrics.fault_recovered(fault.metrics_id)
+        host = fault.injector.config.host
+        if not any(other.injector.config.host == host for other in self.faults.values()):
+            injected_host_list.discard(host)
+            self.notify()
+
+    async def destroy(self, injector: FaultInjector, uids: list[str]) -> bool:
+        """在一个节点上用一次SSH往返销毁多个实验，只有确认已经销毁的实验才从登记表里去掉
+
+        销毁失败的实验继续留在登记表里，节点仍然算作有故障，退出时recover_all会再销毁一次。
+        """
+        if not uids:
+            return True
+        command = "; ".join(f"blade destroy {uid}" for uid in uids)
+        try:
+            output, _ = await injector.execute_command_async(command)
+            results = parse_blade_outputs(output)
+        except Exception as e:
+            logging.error(f"Destroy {len(uids)} experiments on {injector.config.host} failed: {e}")
+            results = []
+        destroyed: list[str] = []
+        for i, uid in enumerate(uids):
+            result = results[i] if i < len(results) else None
+            if blade_succeeded(result) or experiment_gone(result):
+                destroyed.append(uid)
+            else:
+                logging.warning(f"Destroy experiment {uid} on {injector.config.host} failed: {result}")
+        if destroyed:
+            nemeses = sorted({self.faults[uid].nemesis for uid in destroyed if uid in self.faults})
+            for uid in destroyed:
+                self.forget(uid)
+            history.record(INFO, NEMESIS_PROCESS, "recover", nemeses, [injector.config.host])
+            logging.info(f"Recovered {len(destroyed)} fault(s) of {nemeses} on {injector.config.host}.")
+        return len(destroyed) == len(uids)
+
+    async def recover(self, uids: Optional[Iterable[str]] = None) -> bool:
+        """立即销毁指定的（默认是全部的）故障，每个节点一次SSH往返"""
+        if uids is None:
+            uids = list(self.faults)
+        grouped: dict[FaultInjector, list[str]] = {}
+        for uid in uids:
+            if fault := self.faults.get(uid):
+                grouped.setdefault(fault.injector, []).append(uid)
+                if handle := self.recover_handles.pop(uid, None):
+                    handle.cancel()
+        for injector, pending_uids in self.pending.items():
+            pending_uids.difference_update(grouped.get(injector, ()))
+        results = await asyncio.gather(*(self.destroy(injector, injector_uids)
+                                         for injector, injector_uids in grouped.items()))
+        return all(results)
+
+    async def recover_all(self):
+        """退出（包括出错退出）时调用：等正在进行的销毁完成，再清掉所有剩下的故障"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush()
+        if self.destroying:
+            await asyncio.gather(*self.destroying, return_exceptions=True)
+        if self.faults:
+            logging.info(f"Sweeping {len(self.faults)} remaining fault(s)...")
+            await self.recover()
+
+    async def sweep_stale(self, injectors: Iterable[FaultInjector]):
+        """清理之前的运行遗留在节点上的实验，避免它们影响这次运行"""
+
+        async def sweep(injector: FaultInjector):
+            try:
+                output, _ = await injector.execute_command_async("blade status --type create")
+                results = parse_blade_outputs(output)
+            except Exception as e:
+                logging.warning(f"Query blade status on {injector.config.host} failed: {e}")
+                return
+            experiments = results[0].get("result") if results and blade_succeeded(results[0]) else None
+            stale = [experiment["Uid"] for experiment in experiments or []
+                     if experiment.get("Status") == "Success" and experiment.get("Uid") not in self.faults]
+            if not stale:
+                return
+            logging.warning(f"Found {len(stale)} stale experiment(s) on {injector.config.host}, destroying them.")
+            command = "; ".join(f"blade destroy {uid}" for uid in stale)
+            try:
+                await injector.execute_command_async(command)
+            except Exception as e:
+                logging.error(f"Destroy stale experiments on {injector.config.host} failed: {e}")
+
+        await asyncio.gather(*(sweep(injector) for injector in injectors))
+
+    def reset(self):
+        """丢弃所有记录（不销毁节点上的实验），在新的事件循环里复用之前调用"""
+        for handle in self.recover_handles.values():
+            handle.cancel()
+        self.faults = {}
+        self.recover_handles = {}
+        self.pending = {}
+        self.flush_handle = None
+        self.destroying = set()
+        injected_host_list.clear()
+        self.notify()
+
+
+fault_registry = FaultRegistry()
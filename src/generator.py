@@ -0,0 +1,106 @@
+import random
+import bisect
+import itertools
+from abc import ABC, abstractmethod
+from typing import Any, Iterator, Type
+
+# 一条待执行的操作：(f, key, value)，和history里记录的字段一致
+Op = tuple[str, Any, Any]
+
+
+class KeyDistribution(ABC):
+    """从[0, key_count)里选key的分布"""
+    key_count: int
+
+    def __init__(self, key_count: int, rng: random.Random):
+        if key_count <= 0:
+            raise ValueError(f"Key count must be positive: {key_count}")
+        self.key_count = key_count
+        self.rng = rng
+
+    @abstractmethod
+    def next_key(self) -> int:
+        pass
+
+
+class UniformKeys(KeyDistribution):
+    def next_key(self) -> int:
+        return self.rng.randrange(self.key_count)
+
+
+class ZipfianKeys(KeyDistribution):
+    """第k个key被选中的概率正比于1/(k+1)^exponent，累积分布只在构造时计算一次"""
+
+    def __init__(self, key_count: int, rng: random.Random, exponent: float = 0.99):
+        super().__init__(key_count, rng)
+        self.exponent = exponent
+        self.cdf = list(itertools.accumulate(1 / (k + 1) ** exponent for k in range(key_count)))
+
+    def next_key(self) -> int:
+        return min(bisect.bisect_left(self.cdf, self.rng.random() * self.cdf[-1]), self.key_count - 1)
+
+
+class HotspotKeys(KeyDistribution):
+    """hot_fraction比例的key承担hot_probability比例的访问，其余访问均匀落在剩下的key上"""
+
+    def __init__(self, key_count: int, rng: random.Random, hot_fraction: float = 0.2, hot_probability: float = 0.8):
+        super().__init__(key_count, rng)
+        self.hot_count = min(max(int(key_count * hot_fraction), 1), key_count)
+        self.hot_probability = hot_probability
+
+    def next_key(self) -> int:
+        if self.hot_count == self.key_count or self.rng.random() < self.hot_probability:
+            return self.rng.randrange(self.hot_count)
+        return self.rng.randrange(self.hot_count, self.key_count)
+
+
+KEY_DISTRIBUTIONS: dict[str, Type[KeyDistribution]] = {
+    "uniform": UniformKeys,
+    "zipfian": ZipfianKeys,
+    "hotspot": HotspotKeys
+}
+
+
+def create_key_distribution(name: str, key_count: int, rng: random.Random, **options) -> KeyDistribution:
+    Distribution = KEY_DISTRIBUTIONS.get(name)
+    if Distribution is None:
+        raise ValueError(f"Unknown key distribution: {name}")
+    return Distribution(key_count, rng, **options)
+
+
+def register_ops(keys: KeyDistribution, mix: dict[str, float], value_count: int,
+                 rng: random.Random) -> Iterator[Op]:
+    """按mix中的比例无限地产生寄存器操作：read的value为None，write写入一个值，cas的value为[旧值, 新值]
+
+    值取自[0, value_count)，值域小一些cas才有机会成功。
+    """
+    functions = [f for f, weight in mix.items() if weight > 0]
+    if not functions:
+        raise ValueError(f"Operation mix has no positive weight: {mix}")
+    weights = list(itertools.accumulate(mix[f] for f in functions))
+    while True:
+        f = functions[bisect.bisect_right(weights, rng.random() * weights[-1])]
+        key = keys.next_key()
+        if f == "read":
+            yield f, key, None
+        elif f == "write":
+            yield f, key, rng.randrange(value_count)
+        else:
+            yield f, key, [rng.randrange(value_count), rng.randrange(value_count)]
+
+
+def list_append_txns(keys: KeyDistribution, min_length: int, max_length: int, append_ratio: float,
+                     values: Iterator[int], rng: random.Random) -> Iterator[list[list]]:
+    """无限地产生list-append事务，每个事务是若干个微操作：["append", key, value]或者["r", key, None]
+
+    values提供追加的值，必须保证每个值只用一次，检查时才能从读到的列表反推出写入它的事务。
+    """
+    while True:
+        txn: list[list] = []
+        for _ in range(rng.randint(min_length, max_length)):
+            key = keys.next_key()
+            if rng.random() < append_ratio:
+                txn.append(["append", key, next(values)])
+            else:
+                txn.append(["r", key, None])
+        yield txn
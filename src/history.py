@@ -0,0 +1,182 @@
+import os
+import json
+import asyncio
+import mmap
+import heapq
+import time
+import logging
+import itertools
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional, Union
+
+INVOKE = "invoke"
+OK = "ok"
+FAIL = "fail"
+INFO = "info"  # 结果不确定（超时、连接中断等），也用于nemesis事件
+
+NEMESIS_PROCESS = "nemesis"
+
+
+class Operation:
+    """历史中的一条事件，磁盘上保存为一行JSON数组：[index, time, process, type, f, key, value]"""
+    __slots__ = ("index", "time", "process", "type", "f", "key", "value")
+
+    def __init__(self, index: int, time: int, process: Union[int, str], type: str, f: str,
+                 key: Any = None, value: Any = None):
+        self.index = index
+        self.time = time
+        self.process = process
+        self.type = type
+        self.f = f
+        self.key = key
+        self.value = value
+
+    def to_row(self) -> list:
+        return [self.index, self.time, self.process, self.type, self.f, self.key, self.value]
+
+    @classmethod
+    def from_row(cls, row: list) -> "Operation":
+        return cls(*row)
+
+    def __repr__(self):
+        return f"{{{self.index} {self.time} {self.process} {self.type} {self.f} {self.key} {self.value}}}"
+
+
+class History:
+    """append-only的操作历史
+
+    内存里只保留最多buffer_size条尚未落盘的事件，写满后以JSON lines格式追加到文件，
+    因此长时间运行内存也不会无限增长。time是相对open时刻的单调时钟纳秒数。
+    """
+    buffer_size: int
+    path: Optional[Path]
+
+    def __init__(self, buffer_size: int = 4096, clock: Callable[[], int] = time.monotonic_ns):
+        self.buffer_size = buffer_size
+        self.clock = clock
+        self.buffer: list[Operation] = []
+        self.path = None
+        self.file = None
+        self.origin = clock()
+        self.index = itertools.count()
+        self.process_ids = itertools.count()
+        self.dropped = 0
+        self.merging: Optional[asyncio.Future] = None
+
+    def open(self, path: Union[str, Path], origin: Optional[int] = None):
+        """origin为None时从现在开始计时；分片的工作进程传入协调进程的origin，两边的time才能直接比较"""
+        self.close()
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "w", encoding="utf-8", buffering=1 << 20)
+        self.buffer = []
+        self.origin = self.clock() if origin is None else origin
+        self.index = itertools.count()
+        self.process_ids = itertools.count()
+        self.dropped = 0
+        logging.info(f"Recording history to {self.path}.")
+
+    def next_process(self) -> int:
+        """分配一个新的、在整个历史中唯一的客户端进程号"""
+        return next(self.process_ids)
+
+    def record(self, type: str, process: Union[int, str], f: str, key: Any = None, value: Any = None) -> Operation:
+        op = Operation(next(self.index), self.clock() - self.origin, process, type, f, key, value)
+        self.buffer.append(op)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return op
+
+    def invoke(self, process: Union[int, str], f: str, key: Any = None, value: Any = None) -> Operation:
+        return self.record(INVOKE, process, f, key, value)
+
+    def ok(self, invocation: Operation, value: Any = None) -> Operation:
+        return self.record(OK, invocation.process, invocation.f, invocation.key, value)
+
+    def fail(self, invocation: Operation, value: Any = None) -> Operation:
+        return self.record(FAIL, invocation.process, invocation.f, invocation.key, value)
+
+    def info(self, invocation: Operation, value: Any = None) -> Operation:
+        return self.record(INFO, invocation.process, invocation.f, invocation.key, value)
+
+    def flush(self):
+        if not self.buffer or self.merging is not None:
+            # 归并期间文件正在被替换，新事件先留在buffer里，归并完成后再落盘
+            return
+        if self.file is None:
+            # 没有打开文件时只保留最近一个buffer的事件
+            if self.dropped == 0:
+                logging.warning("History is not opened, old operations will be dropped.")
+            self.dropped += len(self.buffer)
+        else:
+            self.file.write("".join(encode(op) for op in self.buffer))
+            self.file.flush()
+        self.buffer = []
+
+    async def merge(self, paths: list[Union[str, Path]]):
+        """把其他进程（用同一个origin）记录的历史按time归并进本历史，并按归并后的顺序重新编号index
+
+        每个文件内部的time都是单调的，多路归并之后整个文件仍然是一条时间线，检查器可以照常使用。
+        归并在线程里进行，不阻塞事件循环；期间记录的事件time都晚于已有的事件，归并完成后接着编号追加到文件末尾。
+        """
+        while self.merging is not None:
+            # 同一时间只能有一个归并在改写文件
+            await asyncio.wait([self.merging])
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.merging = asyncio.ensure_future(asyncio.to_thread(self.merge_files, paths))
+        self.merging.add_done_callback(self.merged)
+        # 调用方被取消时归并仍然在线程里继续，结束后由merged重新打开文件
+        await asyncio.shield(self.merging)
+
+    def merge_files(self, paths: list[Union[str, Path]]) -> int:
+        """在线程里执行，返回归并后的事件数"""
+        merged_path = self.path.with_name(self.path.name + ".merging")
+        sources = [load_history(self.path)] + [load_history(path) for path in paths if Path(path).exists()]
+        count = 0
+        with open(merged_path, "w", encoding="utf-8", buffering=1 << 20) as file:
+            for op in heapq.merge(*sources, key=lambda op: op.time):
+                op.index = count
+                count += 1
+                file.write(encode(op))
+        os.replace(merged_path, self.path)
+        return count
+
+    def merged(self, future: asyncio.Future):
+        self.merging = None
+        self.file = open(self.path, "a", encoding="utf-8", buffering=1 << 20)
+        if future.cancelled() or future.exception() is not None:
+            return
+        count = future.result()
+        for op in self.buffer:
+            op.index = count
+            count += 1
+        self.index = itertools.count(count)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+            logging.info(f"History has been saved to {self.path}.")
+
+
+def encode(op: Operation) -> str:
+    return json.dumps(op.to_row(), separators=(",", ":"), default=str) + "\n"
+
+
+def load_history(path: Union[str, Path]) -> Iterator[Operation]:
+    """用mmap逐行读取落盘的历史，不会把整个文件读进内存"""
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                yield Operation.from_row(json.loads(line))
+
+
+history = History()
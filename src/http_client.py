@@ -0,0 +1,93 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Optional
+
+import aiohttp
+
+from .metrics import metrics
+
+
+class HttpResponse:
+    """一次HTTP请求的结果（body已完整读出，连接已归还连接池）；按二进制读取时内容在body里，text为空"""
+    __slots__ = ("status", "text", "headers", "body")
+
+    def __init__(self, status: int, text: str, headers: dict[str, str], body: bytes = b""):
+        self.status = status
+        self.text = text
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+
+def response_outcome(status: int) -> str:
+    if status < 300:
+        return "ok"
+    return "redirect" if status < 400 else "error"
+
+
+class HttpClient:
+    """单个节点的异步HTTP客户端：keep-alive连接池 + 在途请求数限制 + 单请求deadline"""
+    base_url: str
+    max_connections: int
+    max_inflight: int
+    timeout: float
+
+    def __init__(self, base_url: str, max_connections: int = 32, max_inflight: int = 64,
+                 timeout: float = 3, keepalive_timeout: float = 30, name: Optional[str] = None):
+        self.base_url = base_url.rstrip("/")
+        self.name = name or self.base_url
+        self.max_connections = max_connections
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.inflight = asyncio.Semaphore(max_inflight)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # session必须在事件循环内创建，所以延迟到第一次请求时再建
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def request(self, method: str, path: str, payload: Any = None, timeout: Optional[float] = None,
+                      data: Optional[bytes] = None, content_type: Optional[str] = None,
+                      binary: bool = False) -> HttpResponse:
+        """payload按JSON发送，data按content_type原样发送；binary为True时成功的回复按二进制读进body"""
+        # deadline覆盖排队等待在途名额的时间，而不仅仅是网络传输
+        begin = time.perf_counter()
+        outcome = "error"
+        try:
+            async with asyncio.timeout(timeout or self.timeout):
+                async with self.inflight:
+                    session = self.get_session()
+                    headers = {"Content-Type": content_type} if content_type else None
+                    async with session.request(method, f"{self.base_url}{path}", json=payload, data=data,
+                                               headers=headers, allow_redirects=False) as response:
+                        outcome = response_outcome(response.status)
+                        if binary and response.status == 200:
+                            return HttpResponse(response.status, "", dict(response.headers), await response.read())
+                        text = await response.text()
+                        return HttpResponse(response.status, text, dict(response.headers))
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            metrics.record_operation("http_request", time.perf_counter() - begin, outcome, node=self.name,
+                                     op=path.split("?")[0])
+
+    async def get(self, path: str, timeout: Optional[float] = None) -> HttpResponse:
+        return await self.request("GET", path, timeout=timeout)
+
+    async def post(self, path: str, payload: Any, timeout: Optional[float] = None) -> HttpResponse:
+        return await self.request("POST", path, payload, timeout)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logging.debug(f"HTTP connection pool to {self.base_url} has closed.")
+        self.session = None
@@ -0,0 +1,151 @@
+import logging
+from typing import Optional
+
+import numpy as np
+
+from .db import Database
+
+# 按(count, rowid)做keyset分页，重复的count也不会在页边界上被跳过
+PAGE_SQL = ("SELECT count, rowid FROM tc WHERE count > ? OR (count = ? AND rowid > ?) "
+            "ORDER BY count, rowid LIMIT ?")
+FIRST_PAGE_SQL = "SELECT count, rowid FROM tc ORDER BY count, rowid LIMIT ?"
+
+Range = tuple[int, int]
+
+
+def merge_ranges(ranges: list[Range]) -> list[Range]:
+    """合并重叠或相邻的闭区间"""
+    merged: list[Range] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_ranges(ranges: list[Range], removed: list[Range]) -> list[Range]:
+    """闭区间集合的差集 ranges - removed（两者都已合并、有序）"""
+    result: list[Range] = []
+    j = 0
+    for start, end in ranges:
+        while j < len(removed) and removed[j][1] < start:
+            j += 1
+        k = j
+        while start <= end:
+            if k >= len(removed) or removed[k][0] > end:
+                result.append((start, end))
+                break
+            if removed[k][0] > start:
+                result.append((start, removed[k][0] - 1))
+            start = max(start, removed[k][1] + 1)
+            k += 1
+    return result
+
+
+class IntegrityReport:
+    """tc表count列的完整性报告：缺失和重复的值都以闭区间表示"""
+    __slots__ = ("node", "rows", "first", "last", "missing", "duplicated", "duplicate_rows")
+
+    def __init__(self, node: str):
+        self.node = node
+        self.rows = 0
+        self.first: Optional[int] = None
+        self.last: Optional[int] = None
+        self.missing: list[Range] = []
+        self.duplicated: list[Range] = []
+        self.duplicate_rows = 0
+
+    @property
+    def has_anomaly(self) -> bool:
+        return self.rows == 0 or bool(self.missing) or bool(self.duplicated)
+
+    def add_page(self, counts: np.ndarray, expected_start: int):
+        """用向量化的差分在一页数据里找缺口和重复，页与页之间用上一页最后一个值衔接"""
+        if counts.size == 0:
+            return
+        if self.last is None:
+            self.first = int(counts[0])
+            if self.first > expected_start:
+                self.missing.append((expected_start, self.first - 1))
+            values = counts
+        else:
+            values = np.concatenate((np.array([self.last], dtype=np.int64), counts))
+        diffs = np.diff(values)
+        gap_positions = np.flatnonzero(diffs > 1)
+        for start, end in zip((values[gap_positions] + 1).tolist(), (values[gap_positions + 1] - 1).tolist()):
+            self.missing.append((start, end))
+        duplicates = values[1:][diffs == 0]
+        if duplicates.size:
+            self.duplicate_rows += int(duplicates.size)
+            unique = np.unique(duplicates)
+            # 把连续的重复值合并成区间
+            breaks = np.flatnonzero(np.diff(unique) != 1)
+            starts = np.concatenate(([0], breaks + 1))
+            ends = np.concatenate((breaks, [unique.size - 1]))
+            self.duplicated.extend(zip(unique[starts].tolist(), unique[ends].tolist()))
+        self.rows += int(counts.size)
+        self.last = int(counts[-1])
+
+    def finish(self):
+        self.missing = merge_ranges(self.missing)
+        self.duplicated = merge_ranges(self.duplicated)
+
+    def to_dict(self) -> dict:
+        return {"node": self.node, "rows": self.rows, "first": self.first, "last": self.last,
+                "missing": self.missing, "duplicated": self.duplicated, "duplicate_rows": self.duplicate_rows}
+
+
+async def scan_integrity(database: Database, page_size: int = 10000, level: str = None,
+                         expected_start: int = 1) -> IntegrityReport:
+    """分页扫描一个节点上的tc表，每一页到达后立即解析、检查，不在内存里保存整张表"""
+    report = IntegrityReport(database.config.name)
+    last_count, last_rowid = None, None
+    while True:
+        if last_count is None:
+            sql = [[FIRST_PAGE_SQL, page_size]]
+        else:
+            sql = [[PAGE_SQL, last_count, last_count, last_rowid, page_size]]
+        results = await database.query(sql, level)
+        result = results[0]
+        if error := result.get("error"):
+            raise Exception(f"Scan tc on {database.config.host} failed: {error}")
+        values = result.get("values") or []
+        if not values:
+            break
+        page = np.array(values, dtype=np.int64)
+        report.add_page(page[:, 0], expected_start)
+        last_count, last_rowid = int(page[-1, 0]), int(page[-1, 1])
+        if len(values) < page_size:
+            break
+    report.finish()
+    logging.debug(f"Scanned {report.rows} rows of tc on {database.config.host}.")
+    return report
+
+
+def diff_reports(reports: list[IntegrityReport]) -> list[str]:
+    """比较各副本的扫描结果，返回可读的差异描述"""
+    differences: list[str] = []
+    if not reports:
+        return differences
+    base = reports[0]
+    for other in reports[1:]:
+        if other.rows != base.rows:
+            differences.append(f"{base.node} has {base.rows} rows while {other.node} has {other.rows} rows")
+        lost_on_other = subtract_ranges(other.missing, base.missing)
+        lost_on_base = subtract_ranges(base.missing, other.missing)
+        # 超出对方扫描范围的尾部不算“对方有”
+        if base.last is not None:
+            lost_on_other = [(start, min(end, base.last)) for start, end in lost_on_other if start <= base.last]
+        if other.last is not None:
+            lost_on_base = [(start, min(end, other.last)) for start, end in lost_on_base if start <= other.last]
+        if lost_on_other:
+            differences.append(f"{other.node} is missing {lost_on_other} which {base.node} has")
+        if lost_on_base:
+            differences.append(f"{base.node} is missing {lost_on_base} which {other.node} has")
+        if other.duplicated != base.duplicated:
+            differences.append(f"duplicated values differ: {base.node} {base.duplicated}, "
+                               f"{other.node} {other.duplicated}")
+        if other.last != base.last:
+            differences.append(f"{base.node} ends at {base.last} while {other.node} ends at {other.last}")
+    return differences
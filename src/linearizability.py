@@ -0,0 +1,236 @@
+import time
+import asyncio
+import logging
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Optional, Union
+
+from .history import Operation, load_history, INVOKE, OK, FAIL, INFO, NEMESIS_PROCESS
+
+# 分区里的一条操作：(invoke序号, 完成序号或None, process, f, 输入值, 输出值)
+# 完成序号为None表示结果不确定（info或者没有完成），它可以在invoke之后的任意时刻生效
+Entry = tuple[int, Optional[int], Any, str, Any, Any]
+
+REGISTER_FUNCTIONS = ("read", "write", "cas")
+INFINITY = float("inf")
+
+
+def step_register(state: Any, f: str, value: Any, output: Any) -> tuple[bool, Any]:
+    """读写寄存器 / CAS寄存器的顺序模型"""
+    if f == "read":
+        return output == state, state
+    if f == "write":
+        return True, value
+    if f == "cas":
+        old, new = value
+        return state == old, new if state == old else state
+    raise ValueError(f"Unknown register function: {f}")
+
+
+def freeze(value: Any) -> Any:
+    # JSON里读回来的cas参数是list，状态缓存需要可哈希的值
+    return tuple(value) if isinstance(value, list) else value
+
+
+def partition_history(ops: Iterable[Operation]) -> dict[Any, list[Entry]]:
+    """按key拆分寄存器历史，并把invoke和它的完成事件配成一条Entry"""
+    partitions: dict[Any, list[Entry]] = defaultdict(list)
+    pending: dict[Any, Operation] = {}
+    for op in ops:
+        if op.process == NEMESIS_PROCESS or op.f not in REGISTER_FUNCTIONS:
+            continue
+        if op.type == INVOKE:
+            pending[op.process] = op
+            continue
+        invocation = pending.pop(op.process, None)
+        if invocation is None or op.type == FAIL:
+            # 确定失败的操作没有生效，直接丢弃
+            continue
+        key = freeze(invocation.key)
+        if op.type == OK:
+            partitions[key].append((invocation.index, op.index, op.process, op.f,
+                                    freeze(invocation.value), freeze(op.value)))
+        elif op.type == INFO and op.f != "read":
+            # 结果未知的读对状态没有影响；写和cas可能在之后任意时刻生效
+            partitions[key].append((invocation.index, None, op.process, op.f, freeze(invocation.value), None))
+    for invocation in pending.values():
+        if invocation.f != "read":
+            partitions[freeze(invocation.key)].append((invocation.index, None, invocation.process, invocation.f,
+                                                       freeze(invocation.value), None))
+    return partitions
+
+
+def search(entries: list[Entry], deadline: float, max_states: int) -> tuple[Optional[bool], Optional[int]]:
+    """Wing-Gong/Lowe风格的线性一致性搜索
+
+    已经线性化的操作集合用一个int作为bitset，(bitset, 状态)访问过就不再重复搜索。
+    返回(是否线性一致, 无法线性化的操作下标)；超出时间或状态数预算时返回(None, None)。
+    无法线性化的操作取搜索最深时卡住的那一个，也就是最长可线性化前缀之后的第一个操作。
+    """
+    events = []
+    for i, (start, end, _, _, _, _) in enumerate(entries):
+        events.append((start, 0, i))
+        events.append((INFINITY if end is None else end, 1, i))
+    events.sort()
+
+    # 用数组实现的双向链表，0号位置是头哨兵，-1表示链表结尾
+    size = len(events)
+    next_pos = list(range(1, size + 2))
+    next_pos[size] = -1
+    prev_pos = list(range(-1, size))
+    is_call = [False] * (size + 1)
+    op_at = [-1] * (size + 1)
+    call_pos = [0] * len(entries)
+    return_pos = [0] * len(entries)
+    for pos, (_, kind, i) in enumerate(events, start=1):
+        is_call[pos] = kind == 0
+        op_at[pos] = i
+        if kind == 0:
+            call_pos[i] = pos
+        else:
+            return_pos[i] = pos
+
+    def lift(i: int):
+        for pos in (call_pos[i], return_pos[i]):
+            next_pos[prev_pos[pos]] = next_pos[pos]
+            if next_pos[pos] != -1:
+                prev_pos[next_pos[pos]] = prev_pos[pos]
+
+    def unlift(i: int):
+        for pos in (return_pos[i], call_pos[i]):
+            next_pos[prev_pos[pos]] = pos
+            if next_pos[pos] != -1:
+                prev_pos[next_pos[pos]] = pos
+
+    state = None
+    linearized = 0
+    cache = {(linearized, state)}
+    stack: list[tuple[int, Any]] = []
+    pos = next_pos[0]
+    steps = 0
+    deepest, culprit = -1, None
+    while next_pos[0] != -1:
+        steps += 1
+        if steps & 0x3FF == 0 and time.time() > deadline:
+            return None, None
+        i = op_at[pos]
+        if is_call[pos]:
+            _, _, _, f, value, output = entries[i]
+            ok, new_state = step_register(state, f, value, output)
+            if ok:
+                new_linearized = linearized | (1 << i)
+                if (new_linearized, new_state) not in cache:
+                    if len(cache) >= max_states:
+                        return None, None
+                    cache.add((new_linearized, new_state))
+                    stack.append((i, state))
+                    state, linearized = new_state, new_linearized
+                    lift(i)
+                    pos = next_pos[0]
+                    continue
+            pos = next_pos[pos]
+        else:
+            if entries[i][1] is None:
+                # 剩下的都是结果不确定的操作，它们也可以从未生效
+                return True, None
+            # 碰到了一个还没线性化的操作的返回点，只能回溯
+            if len(stack) > deepest:
+                deepest, culprit = len(stack), i
+            if not stack:
+                return False, culprit
+            j, state = stack.pop()
+            linearized &= ~(1 << j)
+            unlift(j)
+            pos = next_pos[call_pos[j]]
+    return True, None
+
+
+def written_values(entries: list[Entry]) -> set:
+    written = {None}
+    for _, _, _, f, value, _ in entries:
+        if f == "write":
+            written.add(value)
+        elif f == "cas":
+            written.add(value[1])
+    return written
+
+
+def explained(entries: list[Entry], original_written: set) -> bool:
+    """原历史中有写入来源的读值/cas期望值，缩减后也必须保留它的写入，否则反例会变成误导性的"""
+    written = written_values(entries)
+    for _, _, _, f, value, output in entries:
+        if f == "read" and output in original_written and output not in written:
+            return False
+        if f == "cas" and value[0] in original_written and value[0] not in written:
+            return False
+    return True
+
+
+def shrink(entries: list[Entry], failed: int, deadline: float, max_states: int, limit: int) -> list[Entry]:
+    """用delta debugging把违例历史缩减成（局部）最小的反例：再删掉任何一条操作都不再违例"""
+    failed_end = INFINITY if entries[failed][1] is None else entries[failed][1]
+    # 失败点之后才开始的操作一般不是原因，先试着只保留之前的部分
+    candidate = [entry for entry in entries if entry[0] < failed_end]
+    if search(candidate, deadline, max_states)[0] is not False:
+        candidate = entries
+    if len(candidate) > limit:
+        return candidate
+    original_written = written_values(candidate)
+    culprit = entries[failed]
+
+    def still_fails(trial: list[Entry]) -> bool:
+        # 缩减后必须还是同一个操作无法线性化，否则找到的是另一个（可能是删出来的）违例
+        if culprit not in trial or not explained(trial, original_written):
+            return False
+        valid, index = search(trial, deadline, max_states)
+        return valid is False and trial[index] == culprit
+
+    chunk = max(len(candidate) // 2, 1)
+    while time.time() < deadline:
+        i = 0
+        removed = False
+        while i < len(candidate) and time.time() < deadline:
+            trial = candidate[:i] + candidate[i + chunk:]
+            if still_fails(trial):
+                candidate = trial
+                removed = True
+            else:
+                i += chunk
+        # 逐条删除的一轮里删掉过东西，前面试过的操作可能又变得可删，需要再来一轮
+        if chunk == 1 and not removed:
+            break
+        chunk = max(chunk // 2, 1)
+    return candidate
+
+
+def check_partition(key: Any, entries: list[Entry], deadline: float, max_states: int, shrink_limit: int) -> dict:
+    """在子进程中检查一个key的历史"""
+    begin = time.time()
+    valid, failed = search(entries, deadline, max_states)
+    result = {"key": key, "valid": valid, "operations": len(entries)}
+    if valid is False:
+        counterexample = shrink(entries, failed, deadline, max_states, shrink_limit)
+        result["failed_op"] = describe(entries[failed])
+        result["counterexample"] = [describe(entry) for entry in sorted(counterexample)]
+    result["elapsed"] = time.time() - begin
+    return result
+
+
+def describe(entry: Entry) -> dict:
+    start, end, process, f, value, output = entry
+    return {"invoke": start, "complete": end, "process": process, "f": f, "value": value, "output": output}
+
+
+async def check_linearizability(path: Union[str, Path], time_limit: float = 60, max_states: int = 1_000_000,
+                                workers: Optional[int] = None, shrink_limit: int = 2000) -> list[dict]:
+    """按key拆分历史文件，在进程池里并行检查每个分区"""
+    partitions = partition_history(load_history(path))
+    deadline = time.time() + time_limit
+    loop = asyncio.get_running_loop()
+    # fork会把事件循环、日志线程和SSH连接也复制过去，用spawn启动干净的进程
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [loop.run_in_executor(pool, check_partition, key, entries, deadline, max_states, shrink_limit)
+                   for key, entries in partitions.items()]
+        return list(await asyncio.gather(*futures))
@@ -0,0 +1,381 @@
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Iterable, Optional, Union
+
+import numpy as np
+
+from .history import Operation, load_history, INVOKE, OK, FAIL, NEMESIS_PROCESS
+
+TXN_FUNCTION = "txn"
+
+# 依赖边的类型
+WW = 0  # 同一个key上，前一个版本的追加者 -> 后一个版本的追加者
+WR = 1  # 追加者 -> 读到这次追加的事务
+RW = 2  # 反依赖：读事务 -> 追加了它没读到的下一个版本的事务
+EDGE_NAMES = ("ww", "wr", "rw")
+
+# 一个SCC里最多尝试多少条rw边来寻找只含一条rw边的环（G-single）
+G_SINGLE_ATTEMPTS = 32
+
+# (起点, 终点, 边的类型)
+Edge = tuple[int, int, int]
+# CSR格式的邻接表：offsets[v]到offsets[v+1]之间是v的出边
+Graph = tuple[list[int], list[int], list[int]]
+
+
+class Transaction:
+    """一个ok或者结果不确定（info）的事务；结果不确定的事务只知道它可能追加的值，读到的值未知"""
+    __slots__ = ("id", "process", "index", "ops", "committed")
+
+    def __init__(self, id: int, process: Any, index: int, ops: list, committed: bool):
+        self.id = id
+        self.process = process
+        self.index = index
+        self.ops = ops
+        self.committed = committed
+
+    def reads(self) -> Iterable[tuple[Any, list]]:
+        for f, key, value in self.ops:
+            if f == "r" and value is not None:
+                yield key, value
+
+    def describe(self) -> dict:
+        return {"id": self.id, "process": self.process, "index": self.index,
+                "ops": [[f, key, abbreviate(value)] for f, key, value in self.ops],
+                "committed": self.committed}
+
+
+def abbreviate(value: Any, tail: int = 3) -> Any:
+    """长列表只保留最后几个元素，读到的列表可能非常长"""
+    if isinstance(value, list) and len(value) > tail:
+        return ["..."] + value[-tail:]
+    return value
+
+
+def load_transactions(ops: Iterable[Operation]) -> tuple[list[Transaction], set]:
+    """配对invoke和完成事件，返回ok和结果不确定的事务，以及确定失败的事务追加的(key, value)"""
+    transactions: list[Transaction] = []
+    failed_appends: set = set()
+    pending: dict[Any, Operation] = {}
+    for op in ops:
+        if op.process == NEMESIS_PROCESS or op.f != TXN_FUNCTION:
+            continue
+        if op.type == INVOKE:
+            pending[op.process] = op
+            continue
+        invocation = pending.pop(op.process, None)
+        if invocation is None:
+            continue
+        if op.type == FAIL:
+            failed_appends.update((key, value) for f, key, value in invocation.value if f == "append")
+        elif op.type == OK:
+            transactions.append(Transaction(len(transactions), op.process, invocation.index, op.value, True))
+        else:
+            transactions.append(Transaction(len(transactions), op.process, invocation.index, invocation.value, False))
+    for invocation in pending.values():
+        transactions.append(Transaction(len(transactions), invocation.process, invocation.index,
+                                        invocation.value, False))
+    return transactions, failed_appends
+
+
+def build_graph(count: int, edges: tuple[list[int], list[int], list[int]]) -> Graph:
+    """把边表去重后排成CSR格式"""
+    sources, targets, kinds = (np.asarray(column, dtype=np.int64) for column in edges)
+    if len(sources) == 0:
+        return [0] * (count + 1), [], []
+    codes = np.unique((sources * count + targets) * 3 + kinds)
+    kinds = codes % 3
+    sources, targets = np.divmod(codes // 3, count)
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=count), out=offsets[1:])
+    return offsets.tolist(), targets.tolist(), kinds.tolist()
+
+
+def strongly_connected_components(count: int, graph: Graph) -> list[list[int]]:
+    """迭代版的Tarjan算法，只返回多于一个节点的强连通分量（没有自环）"""
+    offsets, targets, _ = graph
+    index = [-1] * count
+    low = [0] * count
+    on_stack = [False] * count
+    stack: list[int] = []
+    components: list[list[int]] = []
+    counter = 0
+    for root in range(count):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, offsets[root])]
+        while work:
+            v, i = work[-1]
+            end = offsets[v + 1]
+            while i < end:
+                w = targets[i]
+                i += 1
+                if index[w] == -1:
+                    work[-1] = (v, i)
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append((w, offsets[w]))
+                    break
+                if on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if low[v] < low[parent]:
+                        low[parent] = low[v]
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        component.append(w)
+                        if w == v:
+                            break
+                    if len(component) > 1:
+                        components.append(component)
+    return components
+
+
+def subgraph(nodes: list[int], graph: Graph, allowed: tuple[int, ...]) -> Graph:
+    """只保留nodes之间、类型在allowed里的边，节点重新编号为nodes中的下标"""
+    offsets, targets, kinds = graph
+    local = {node: i for i, node in enumerate(nodes)}
+    sub_offsets = [0]
+    sub_targets: list[int] = []
+    sub_kinds: list[int] = []
+    for node in nodes:
+        for e in range(offsets[node], offsets[node + 1]):
+            if kinds[e] in allowed and (w := local.get(targets[e])) is not None:
+                sub_targets.append(w)
+                sub_kinds.append(kinds[e])
+        sub_offsets.append(len(sub_targets))
+    return sub_offsets, sub_targets, sub_kinds
+
+
+def shortest_path(graph: Graph, source: int, target: int) -> Optional[list[Edge]]:
+    """BFS求source到target的最短路径（source == target时求经过它的最短环）"""
+    offsets, targets, kinds = graph
+    parent: dict[int, tuple[int, int]] = {}
+    queue = deque([source])
+    while queue:
+        v = queue.popleft()
+        for e in range(offsets[v], offsets[v + 1]):
+            w = targets[e]
+            if w in parent or (w == source and w != target):
+                continue
+            parent[w] = (v, kinds[e])
+            if w == target:
+                path: list[Edge] = []
+                while True:
+                    u, kind = parent[w]
+                    path.append((u, w, kind))
+                    w = u
+                    if w == source:
+                        return path[::-1]
+            queue.append(w)
+    return None
+
+
+def find_cycle(component: list[int], graph: Graph) -> tuple[str, list[Edge]]:
+    """在一个强连通分量里找一个最能说明问题的环：依次尝试G0、G1c、G-single，最后是G2"""
+    for name, allowed in (("G0", (WW,)), ("G1c", (WW, WR))):
+        local = subgraph(component, graph, allowed)
+        for sub_component in strongly_connected_components(len(component), local):
+            nodes = [component[i] for i in sub_component]
+            cycle = shortest_path(subgraph(nodes, graph, allowed), 0, 0)
+            return name, [(nodes[a], nodes[b], kind) for a, b, kind in cycle]
+
+    # 一条rw边u->v加上一条v到u的、只含ww/wr边的路径
+    full = subgraph(component, graph, (WW, WR, RW))
+    without_rw = subgraph(component, graph, (WW, WR))
+    offsets, targets, kinds = full
+    attempts = 0
+    for u in range(len(component)):
+        for e in range(offsets[u], offsets[u + 1]):
+            if kinds[e] != RW:
+                continue
+            path = shortest_path(without_rw, targets[e], u)
+            if path is not None:
+                return "G-single", [(component[u], component[targets[e]], RW)] + \
+                    [(component[a], component[b], kind) for a, b, kind in path]
+            attempts += 1
+            if attempts >= G_SINGLE_ATTEMPTS:
+                break
+        if attempts >= G_SINGLE_ATTEMPTS:
+            break
+    cycle = shortest_path(full, 0, 0)
+    name = "G-single" if sum(kind == RW for _, _, kind in cycle) == 1 else "G2"
+    return name, [(component[a], component[b], kind) for a, b, kind in cycle]
+
+
+class ListAppendAnalysis:
+    """Elle风格的list-append历史分析
+
+    每个key的版本顺序取所有读结果中最长的那个列表（其它读必须是它的前缀），
+    由此推出事务之间的ww/wr/rw依赖，依赖图里的环就是G0/G1c/G-single/G2异常；
+    另外直接检查读到失败事务的追加（G1a）、读到事务的中间状态（G1b）等不需要环的异常。
+    """
+
+    def __init__(self, transactions: list[Transaction], failed_appends: set, max_reports: int = 20):
+        self.transactions = transactions
+        self.failed_appends = failed_appends
+        self.max_reports = max_reports
+        self.writer: dict[tuple[Any, Any], int] = {}
+        self.last_append: dict[tuple[int, Any], Any] = {}
+        self.versions: dict[Any, list] = {}
+        self.position: dict[Any, dict[Any, int]] = {}
+        self.counts: dict[str, int] = {}
+        self.anomalies: list[dict] = []
+
+    def report(self, name: str, anomaly: dict):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if len(self.anomalies) < self.max_reports:
+            self.anomalies.append({"type": name, **anomaly})
+
+    def index_appends(self):
+        for txn in self.transactions:
+            for f, key, value in txn.ops:
+                if f == "append":
+                    self.writer[(key, value)] = txn.id
+                    self.last_append[(txn.id, key)] = value
+
+    def infer_versions(self) -> set[tuple[int, int]]:
+        """推出每个key的版本顺序，返回和它不兼容（不是前缀）的读，(事务, 微操作下标)"""
+        for txn in self.transactions:
+            for key, value in txn.reads():
+                if len(value) > len(self.versions.get(key, ())):
+                    self.versions[key] = value
+        incompatible: set[tuple[int, int]] = set()
+        for txn in self.transactions:
+            for i, (f, key, value) in enumerate(txn.ops):
+                if f != "r" or value is None:
+                    continue
+                # 只读到过空列表的key没有版本记录
+                longest = self.versions.get(key, [])
+                if value != longest[:len(value)]:
+                    incompatible.add((txn.id, i))
+                    self.report("incompatible-order", {
+                        "key": key, "transaction": txn.describe(),
+                        "explanation": f"T{txn.id} read key {key} = {abbreviate(value)}, which is not a prefix "
+                                       f"of {abbreviate(longest)} read by another transaction"})
+                elif len(set(value)) != len(value):
+                    self.report("duplicate-elements", {
+                        "key": key, "transaction": txn.describe(),
+                        "explanation": f"T{txn.id} read key {key} = {abbreviate(value)}, "
+                                       f"which contains the same append more than once"})
+        self.position = {key: {value: i for i, value in enumerate(versions)}
+                         for key, versions in self.versions.items()}
+        return incompatible
+
+    def check_versions(self):
+        """G1a：读到了确定失败的事务的追加；garbage：读到了没有任何事务追加过的值"""
+        for key, versions in self.versions.items():
+            for value in versions:
+                if (key, value) in self.failed_appends:
+                    self.report("G1a", {"key": key, "value": value,
+                                        "explanation": f"{value} was appended to key {key} by a failed transaction, "
+                                                       f"but later reads observed it"})
+                elif (key, value) not in self.writer:
+                    self.report("garbage-read", {"key": key, "value": value,
+                                                 "explanation": f"{value} was read from key {key}, "
+                                                                f"but no transaction appended it"})
+
+    def check_transaction(self, txn: Transaction, incompatible: set[tuple[int, int]]):
+        """G1b和事务内部的一致性"""
+        own: dict[Any, list] = {}
+        for i, (f, key, value) in enumerate(txn.ops):
+            if f == "append":
+                own.setdefault(key, []).append(value)
+                continue
+            if value is None or (txn.id, i) in incompatible:
+                continue
+            appended = own.get(key)
+            if appended and value[-len(appended):] != appended:
+                self.report("internal", {"key": key, "transaction": txn.describe(),
+                                         "explanation": f"T{txn.id} read key {key} = {abbreviate(value)} "
+                                                        f"after appending {appended} to it itself"})
+            if value and (writer := self.writer.get((key, value[-1]))) is not None and writer != txn.id \
+                    and self.last_append[(writer, key)] != value[-1]:
+                self.report("G1b", {"key": key, "transaction": txn.describe(),
+                                    "writer": self.transactions[writer].describe(),
+                                    "explanation": f"T{txn.id} read key {key} = {abbreviate(value)}, ending with "
+                                                   f"{value[-1]}, an intermediate append of T{writer}"})
+
+    def dependency_edges(self, incompatible: set[tuple[int, int]]) -> tuple[list[int], list[int], list[int]]:
+        sources: list[int] = []
+        targets: list[int] = []
+        kinds: list[int] = []
+
+        def add(source: Optional[int], target: Optional[int], kind: int):
+            if source is not None and target is not None and source != target:
+                sources.append(source)
+                targets.append(target)
+                kinds.append(kind)
+
+        for key, versions in self.versions.items():
+            for previous, value in zip(versions, versions[1:]):
+                add(self.writer.get((key, previous)), self.writer.get((key, value)), WW)
+        for txn in self.transactions:
+            for i, (f, key, value) in enumerate(txn.ops):
+                if f != "r" or value is None or (txn.id, i) in incompatible:
+                    continue
+                if value:
+                    add(self.writer.get((key, value[-1])), txn.id, WR)
+                versions = self.versions.get(key, [])
+                if len(value) < len(versions):
+                    add(txn.id, self.writer.get((key, versions[len(value)])), RW)
+        return sources, targets, kinds
+
+    def explain_edge(self, source: int, target: int, kind: int) -> str:
+        if kind == WW:
+            for f, key, value in self.transactions[target].ops:
+                i = self.position.get(key, {}).get(value) if f == "append" else None
+                if i and self.writer.get((key, self.versions[key][i - 1])) == source:
+                    return (f"T{source} appended {self.versions[key][i - 1]} to key {key}, "
+                            f"then T{target} appended {value} right after it (ww)")
+        elif kind == WR:
+            for key, value in self.transactions[target].reads():
+                if value and self.writer.get((key, value[-1])) == source:
+                    return f"T{target} read key {key} = {abbreviate(value)}, observing T{source}'s append of {value[-1]} (wr)"
+        else:
+            for key, value in self.transactions[source].reads():
+                versions = self.versions.get(key, [])
+                if len(value) < len(versions) and self.writer.get((key, versions[len(value)])) == target:
+                    return (f"T{source} read key {key} = {abbreviate(value)}, missing {versions[len(value)]} "
+                            f"which T{target} appended next (rw)")
+        return f"T{source} -> T{target} ({EDGE_NAMES[kind]})"
+
+    def check_cycles(self, incompatible: set[tuple[int, int]]) -> int:
+        graph = build_graph(len(self.transactions), self.dependency_edges(incompatible))
+        for component in strongly_connected_components(len(self.transactions), graph):
+            name, cycle = find_cycle(component, graph)
+            steps = [self.explain_edge(*edge) for edge in cycle]
+            path = " -> ".join(f"T{source}" for source, _, _ in cycle) + f" -> T{cycle[0][0]}"
+            self.report(name, {"cycle": [self.transactions[source].describe() for source, _, _ in cycle],
+                               "explanation": f"{path}: " + "; ".join(steps)})
+        return len(graph[1])
+
+    def run(self) -> dict:
+        begin = time.time()
+        self.index_appends()
+        incompatible = self.infer_versions()
+        self.check_versions()
+        for txn in self.transactions:
+            self.check_transaction(txn, incompatible)
+        edges = self.check_cycles(incompatible)
+        return {"valid": not self.counts, "transactions": len(self.transactions), "edges": edges,
+                "anomaly_counts": self.counts, "anomalies": self.anomalies, "elapsed": time.time() - begin}
+
+
+def check_list_append(path: Union[str, Path], max_reports: int = 20) -> dict:
+    """分析落盘的list-append历史（在子进程中执行）"""
+    transactions, failed_appends = load_transactions(load_history(path))
+    return ListAppendAnalysis(transactions, failed_appends, max_reports).run()
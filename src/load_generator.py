@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from typing import Optional, TYPE_CHECKING
+
+from .history import history
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    from .workload import Workload
+
+
+class LoadStats:
+    """一次压测的统计结果"""
+    __slots__ = ("issued", "ok", "failed", "dropped", "elapsed")
+
+    def __init__(self):
+        self.issued = 0
+        self.ok = 0
+        self.failed = 0
+        self.dropped = 0
+        self.elapsed = 0.0
+
+    def merge(self, other: "LoadStats"):
+        """合并另一个分片的统计，各分片是同时开始的，elapsed取最长的一个"""
+        self.issued += other.issued
+        self.ok += other.ok
+        self.failed += other.failed
+        self.dropped += other.dropped
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+    @property
+    def throughput(self) -> float:
+        return self.ok / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (f"{self.ok} ok, {self.failed} failed, {self.dropped} dropped of {self.issued} issued "
+                f"in {self.elapsed:.2f}s ({self.throughput:.1f} ops/s)")
+
+
+class LoadGenerator:
+    """以目标ops/sec驱动N个虚拟客户端执行workload.operation，支持开环(open)和闭环(closed)两种模式
+
+    - closed: 每个客户端（一个history进程号）串行地发请求，上一个完成后才发下一个；rate>0时按 rate/clients 的速度限速
+    - open: 请求按固定间隔到达，不等待前面的请求完成；在途请求超过max_outstanding时丢弃并计数
+    结束条件为完成times次操作或者持续duration秒（先到者为准）。
+    """
+    workload: "Workload"
+    stats: LoadStats
+
+    def __init__(self, workload: "Workload"):
+        self.workload = workload
+        self.stats = LoadStats()
+        self.deadline: Optional[float] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def next_seq(self) -> Optional[int]:
+        """分配下一个操作序号，预算耗尽或超时则返回None"""
+        times = self.workload.times
+        if times > 0 and self.stats.issued >= times:
+            return None
+        if self.deadline is not None and self.loop.time() >= self.deadline:
+            return None
+        seq = self.stats.issued
+        self.stats.issued += 1
+        return seq
+
+    def past_deadline(self, planned_time: float) -> bool:
+        return self.deadline is not None and planned_time >= self.deadline
+
+    async def run_operation(self, process: int, seq: int):
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        try:
+            await self.workload.operation(process, seq)
+            self.stats.ok += 1
+            metrics.record_operation("workload_operation", loop.time() - begin, "ok", workload=self.workload.name)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats.failed += 1
+            metrics.record_operation("workload_operation", loop.time() - begin, "error", workload=self.workload.name)
+            logging.warning(f"Operation {seq} of process {process} in {self.workload.name} failed: {e}")
+
+    async def run_closed_client(self, client_id: int, begin: float):
+        interval = self.workload.clients / self.workload.rate if self.workload.rate > 0 else 0
+        next_time = begin + interval * client_id / self.workload.clients  # 错开各客户端的发送时刻
+        process = history.next_process()
+        while not self.past_deadline(next_time) and (seq := self.next_seq()) is not None:
+            if interval:
+                delay = next_time - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_time += interval
+            await self.run_operation(process, seq)
+
+    async def run_open(self, begin: float):
+        interval = 1 / self.workload.rate
+        outstanding: set[asyncio.Task] = set()
+        arrival = 0
+        try:
+            while not self.past_deadline(begin + arrival * interval) and (seq := self.next_seq()) is not None:
+                # 按计划到达时刻发送，而不是按上一个请求的完成时刻，避免coordinated omission
+                delay = begin + arrival * interval - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                arrival += 1
+                if len(outstanding) >= self.workload.max_outstanding:
+                    self.stats.dropped += 1
+                    continue
+                # 开环模式下同一时刻可能有多个在途请求，每个请求用独立的进程号
+                task = asyncio.create_task(self.run_operation(history.next_process(), seq))
+                outstanding.add(task)
+                task.add_done_callback(outstanding.discard)
+            if outstanding:
+                await asyncio.gather(*outstanding)
+        finally:
+            for task in list(outstanding):
+                task.cancel()
+
+    async def run(self) -> LoadStats:
+        self.loop = asyncio.get_running_loop()
+        begin = self.loop.time()
+        if self.workload.duration > 0:
+            self.deadline = begin + self.workload.duration
+        logging.info(f"Starting {self.workload}...")
+        if self.workload.mode == "open" and self.workload.rate > 0:
+            await self.run_open(begin)
+        else:
+            await asyncio.gather(*(self.run_closed_client(client_id, begin)
+                                   for client_id in range(self.workload.clients)))
+        self.stats.elapsed = self.loop.time() - begin
+        logging.info(f"{self.workload.name} finished: {self.stats}")
+        return self.stats
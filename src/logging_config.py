@@ -1,27 +1,174 @@
+import json
+import time
+import queue
+import atexit
 import logging
+import threading
+import contextvars
+import logging.handlers
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Optional, Union
+
 import colorlog
 
+# 当前日志所属的运行、计划事件和节点，由log_context设置，跨await和task自动传递
+run_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("run_id", default=None)
+event_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("event_id", default=None)
+node_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("node", default=None)
+
+CONTEXT_FIELDS = {"run_id": run_id_var, "event_id": event_id_var, "node": node_var}
+
+
+@contextmanager
+def log_context(**fields):
+    """在with块内为日志附加run_id/event_id/node字段"""
+    tokens = [(CONTEXT_FIELDS[name], CONTEXT_FIELDS[name].set(value)) for name, value in fields.items()]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """在打日志的线程里把上下文字段写进record，之后交给后台线程处理时上下文已经不在了"""
+
+    run_id: Optional[str] = None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, var in CONTEXT_FIELDS.items():
+            if getattr(record, name, None) is None:
+                setattr(record, name, var.get())
+        # 线程池里的线程不继承事件循环的上下文，至少带上本次运行的run_id
+        if record.run_id is None:
+            record.run_id = self.run_id
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """按调用位置限速的令牌桶：每个位置每秒最多rate条、最多突发burst条，ERROR及以上不限速
+
+    被丢弃的条数会附在这个位置下一条放行的日志后面。
+    """
+
+    def __init__(self, rate: float = 20, burst: int = 100):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets: dict[tuple[str, int], list[float]] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                # [剩余令牌, 上次补充时刻, 被丢弃的条数]
+                bucket = self.buckets[key] = [float(self.burst), now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+            record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """JSON lines格式，每行一个日志事件"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "run_id": getattr(record, "run_id", None),
+            "event_id": getattr(record, "event_id", None),
+            "node": getattr(record, "node", None),
+        }
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogPipeline:
+    """根logger只挂一个QueueHandler，格式化和I/O都在QueueListener的后台线程里完成"""
+
+    def __init__(self):
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.context_filter = ContextFilter()
+        self.rate_limit_filter = RateLimitFilter()
+        self.queue_handler.addFilter(self.rate_limit_filter)
+        self.queue_handler.addFilter(self.context_filter)
+        self.console_handler = logging.StreamHandler()
+        self.console_handler.setFormatter(colorlog.ColoredFormatter(
+            "%(log_color)s%(asctime)s - %(levelname)s - %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+            log_colors={
+                "DEBUG": "cyan",
+                "INFO": "green",
+                "WARNING": "yellow",
+                "ERROR": "red",
+                "CRITICAL": "bold_red",
+            },
+        ))
+        self.file_handler: Optional[logging.Handler] = None
+        self.listener: Optional[logging.handlers.QueueListener] = None
+
+    def start(self):
+        handlers = [self.console_handler] + ([self.file_handler] if self.file_handler else [])
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """把队列里剩下的日志全部写完"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def configure(self, level: Union[int, str] = logging.INFO, json_path: Optional[Union[str, Path]] = None,
+                  run_id: Optional[str] = None, rate: float = 20, burst: int = 100):
+        self.stop()
+        logging.getLogger().setLevel(level)
+        self.rate_limit_filter.rate = rate
+        self.rate_limit_filter.burst = burst
+        if self.file_handler is not None:
+            self.file_handler.close()
+            self.file_handler = None
+        if json_path is not None:
+            Path(json_path).parent.mkdir(parents=True, exist_ok=True)
+            self.file_handler = logging.FileHandler(json_path, encoding="utf-8")
+            self.file_handler.setFormatter(JsonFormatter())
+        if run_id is not None:
+            self.context_filter.run_id = run_id
+        self.start()
+
+
+log_pipeline = LogPipeline()
+
+
 def setup_logger():
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
-    formatter = colorlog.ColoredFormatter(
-        "%(log_color)s%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        log_colors={
-            "DEBUG": "cyan",
-            "INFO": "green",
-            "WARNING": "yellow",
-            "ERROR": "red",
-            "CRITICAL": "bold_red",
-        },
-    )
-
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-
     if not logger.hasHandlers():
-        logger.addHandler(console_handler)
+        logger.addHandler(log_pipeline.queue_handler)
+        log_pipeline.start()
+        atexit.register(log_pipeline.stop)
+
+
+def configure_logging(level: Union[int, str] = logging.INFO, json_path: Optional[Union[str, Path]] = None,
+                      run_id: Optional[str] = None, rate: float = 20, burst: int = 100):
+    """调整日志级别、JSON lines文件输出和限速；run_id会附在之后的每一条日志上"""
+    log_pipeline.configure(level, json_path, run_id, rate, burst)
 
 
 setup_logger()
@@ -30,4 +177,4 @@ setup_logger()
 # 内部logging等级：
 # debug: 启动某种工序
 # info： 成功执行某种工序
-# error： 执行某种工序发生错误
\ No newline at end of file
+# error： 执行某种工序发生错误
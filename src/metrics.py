@@ -0,0 +1,269 @@
+import time
+import asyncio
+import logging
+import threading
+from array import array
+from typing import Callable, Optional
+
+# 直方图以微秒为单位，每个2的幂区间再分成64个子桶，相对误差不超过1/64
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+MAX_SHIFT = 30  # 最大可记录约 2^36us ≈ 19小时
+BUCKET_COUNT = SUB_BUCKET_HALF * (MAX_SHIFT + 2)
+MAX_VALUE = (1 << (MAX_SHIFT + SUB_BUCKET_BITS)) - 1
+
+# 导出到Prometheus时使用的桶边界（秒）
+EXPORT_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+BEFORE_FAULT = "before_fault"
+DURING_FAULT = "during_fault"
+AFTER_RECOVERY = "after_recovery"
+PHASES = (BEFORE_FAULT, DURING_FAULT, AFTER_RECOVERY)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def bucket_index(value: int) -> int:
+    if value < (1 << SUB_BUCKET_BITS):
+        return value
+    shift = min(value.bit_length() - SUB_BUCKET_BITS, MAX_SHIFT)
+    return min(SUB_BUCKET_HALF * shift + (value >> shift), BUCKET_COUNT - 1)
+
+
+def bucket_bounds(index: int) -> tuple[int, int]:
+    """桶覆盖的闭区间 [lower, upper]（微秒）"""
+    shift = max(index // SUB_BUCKET_HALF - 1, 0)
+    lower = (index - SUB_BUCKET_HALF * shift) << shift
+    return lower, lower + (1 << shift) - 1
+
+
+class LatencyHistogram:
+    """HDR风格的对数-线性直方图：桶数固定，内存占用和记录次数无关"""
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * BUCKET_COUNT))
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        value = min(max(int(seconds * 1_000_000), 0), MAX_VALUE)
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """返回第q百分位（0~100）的延迟，单位秒"""
+        if self.count == 0:
+            return 0.0
+        rank = max(int(self.count * q / 100 + 0.5), 1)
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                lower, upper = bucket_bounds(index)
+                return min((lower + upper) / 2 / 1_000_000, self.max)
+        return self.max
+
+    def count_below(self, seconds: float) -> int:
+        """不超过seconds的记录数（按桶上界近似）"""
+        limit = int(seconds * 1_000_000)
+        total = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and bucket_bounds(index)[1] <= limit:
+                total += bucket_count
+            elif bucket_bounds(index)[0] > limit:
+                break
+        return total
+
+    def merge(self, other: "LatencyHistogram"):
+        for index, bucket_count in enumerate(other.counts):
+            if bucket_count:
+                self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def summary(self) -> dict:
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99),
+                "max": self.max}
+
+
+class Metrics:
+    """进程内的指标注册表：延迟直方图和计数器都按 (名字, 标签, 阶段) 分开统计
+
+    阶段由故障的注入和恢复驱动：第一次注入前是before_fault，有故障生效时是during_fault，
+    所有故障都恢复以后是after_recovery。
+    """
+    clock: Callable[[], float]
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        # SSH命令在fault_executor的线程里执行，也会记录指标
+        self.lock = threading.Lock()
+        # 阶段切换时通知这些回调（例如同步给分片的工作进程）
+        self.phase_listeners: list[Callable[[str], None]] = []
+        self.reset()
+
+    def reset(self):
+        self.histograms: dict[tuple[str, Labels, str], LatencyHistogram] = {}
+        self.counters: dict[tuple[str, Labels, str], float] = {}
+        self.active_faults: set[int] = set()
+        self.fault_ids = 0
+        self.phase = BEFORE_FAULT
+        self.phase_started = self.clock()
+        self.phase_durations: dict[str, float] = {}
+
+    @staticmethod
+    def labels(labels: dict[str, str]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, self.labels(labels), self.phase)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, self.labels(labels), self.phase)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record_operation(self, name: str, seconds: float, outcome: str, **labels):
+        """记录一次操作：延迟进{name}_duration_seconds直方图，按结果计入{name}_total"""
+        self.observe(f"{name}_duration_seconds", seconds, **labels)
+        self.increment(f"{name}_total", outcome=outcome, **labels)
+
+    def merge(self, histograms: dict[tuple[str, Labels, str], LatencyHistogram],
+              counters: dict[tuple[str, Labels, str], float]):
+        """合并另一个进程记录的直方图和计数器（键里已经带着阶段）"""
+        with self.lock:
+            for key, histogram in histograms.items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def switch_phase(self, phase: str):
+        if phase == self.phase:
+            return
+        now = self.clock()
+        self.phase_durations[self.phase] = self.phase_durations.get(self.phase, 0.0) + now - self.phase_started
+        logging.debug(f"Metrics phase changed from {self.phase} to {phase}.")
+        self.phase, self.phase_started = phase, now
+        for listener in self.phase_listeners:
+            listener(phase)
+
+    def fault_started(self) -> int:
+        """记录一个故障开始生效，返回的id在故障恢复时传给fault_recovered"""
+        self.fault_ids += 1
+        self.active_faults.add(self.fault_ids)
+        self.switch_phase(DURING_FAULT)
+        return self.fault_ids
+
+    def fault_recovered(self, fault_id: int):
+        self.active_faults.discard(fault_id)
+        if not self.active_faults and self.phase == DURING_FAULT:
+            self.switch_phase(AFTER_RECOVERY)
+
+    def durations(self) -> dict[str, float]:
+        durations = dict(self.phase_durations)
+        durations[self.phase] = durations.get(self.phase, 0.0) + self.clock() - self.phase_started
+        return durations
+
+    def phase_summary(self) -> dict[str, dict]:
+        """每个阶段里每种操作的延迟分位数、吞吐和错误数"""
+        durations = self.durations()
+        summary: dict[str, dict] = {phase: {"duration": duration, "latency": {}, "counters": {}}
+                                    for phase, duration in durations.items()}
+        for (name, labels, phase), histogram in self.histograms.items():
+            entry = histogram.summary()
+            if durations.get(phase):
+                entry["throughput"] = histogram.count / durations[phase]
+            label_str = ",".join(f"{key}={label}" for key, label in labels)
+            summary[phase]["latency"][f"{name}{{{label_str}}}"] = entry
+        for (name, labels, phase), value in self.counters.items():
+            label_str = ",".join(f"{key}={label}" for key, label in labels)
+            summary[phase]["counters"][f"{name}{{{label_str}}}"] = value
+        return summary
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition格式，阶段作为phase标签导出"""
+        lines: list[str] = []
+        seen_types: set[str] = set()
+        for (name, labels, phase), histogram in sorted(self.histograms.items()):
+            metric = f"confucius_{name}"
+            if metric not in seen_types:
+                seen_types.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            label_str = ",".join(f'{key}="{label}"' for key, label in labels + (("phase", phase),))
+            for bound in EXPORT_BOUNDS:
+                lines.append(f'{metric}_bucket{{{label_str},le="{bound}"}} {histogram.count_below(bound)}')
+            lines.append(f'{metric}_bucket{{{label_str},le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum{{{label_str}}} {histogram.total}")
+            lines.append(f"{metric}_count{{{label_str}}} {histogram.count}")
+        for (name, labels, phase), value in sorted(self.counters.items()):
+            metric = f"confucius_{name}"
+            if metric not in seen_types:
+                seen_types.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            label_str = ",".join(f'{key}="{label}"' for key, label in labels + (("phase", phase),))
+            lines.append(f"{metric}{{{label_str}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """只支持GET /metrics的极简HTTP服务，供Prometheus抓取"""
+    host: str
+    port: int
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9400):
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.Server] = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # 读掉剩下的请求头
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render_prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e:
+            logging.debug(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
+
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+            logging.info(f"Metrics are exposed at http://{self.host}:{self.port}/metrics.")
+        except OSError as e:
+            # 例如同一台机器上同时运行多个计划，端口已经被占用
+            logging.warning(f"Failed to start metrics server on {self.host}:{self.port}: {e}")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+metrics = Metrics()
@@ -1,14 +1,20 @@
 import json
 import asyncio
 import logging
-from typing import Type
+import threading
+from typing import Type, Optional
 from abc import ABC, abstractmethod
 
-from .config import injected_host_list
-from .fault_injector import FaultInjector
+from .history import history, INFO, NEMESIS_PROCESS
+from .metrics import metrics
+from .fault_registry import fault_registry
 from .tools import time_string_to_seconds, seconds_to_time_string
 from .scope_calculator import ScopeCalculator
 
+# blade的--timeout比duration多出的秒数，避免和fault_registry的按时恢复同时触发
+BLADE_TIMEOUT_GRACE = 10
+
+
 class Nemesis(ABC):
     """所有故障注入的基类"""
     name: str
@@ -17,16 +23,26 @@ class Nemesis(ABC):
     target_scope: str
     start_time: int
     duration: int
-    unique_id: dict[FaultInjector, list[str]] = {}
+    barrier: bool
+    inject_skew: Optional[float]
     
-    def __init__(self, name: str, n_type: str, n_subtype: str, scope: str, start_time: str, duration: str):
+    def __init__(self, name: str, n_type: str, n_subtype: str, scope: str, start_time: str, duration: str,
+                 barrier: bool = True):
         self.name = name
         self.type = n_type
         self.subtype = n_subtype
         self.target_scope = scope
         self.start_time = time_string_to_seconds(start_time)
         self.duration = time_string_to_seconds(duration)
+        self.barrier = barrier
+        self.inject_skew = None
+        self.uids: list[str] = []
         
+    @property
+    def blade_timeout(self) -> int:
+        """blade自带的超时只是兜底（例如进程崩溃），正常情况下由fault_registry在duration到期时恢复"""
+        return self.duration + BLADE_TIMEOUT_GRACE
+
     def __str__(self):
         return f"{self.name} on {str(self.target_scope)} starts at {seconds_to_time_string(self.start_time)} for {self.duration}s"
 
@@ -37,31 +53,62 @@ class Nemesis(ABC):
 
     @abstractmethod
     async def recover(self):
-        # @todo: 这里还有问题，应该怎么去除那些injected_host
         """恢复故障"""
         pass
     
-    def dispatch_inject_command(self, command):
-        target_injectors = ScopeCalculator.get_injectors_from_scope(self.target_scope)
-        for injector in target_injectors:
-            output = injector.execute_command(command)
-            output_dict = json.loads(output)
-            if output_dict.get("code", 0) != 200 or not output_dict.get("success", False):
-                logging.error(f"Inject nemesis failed on {injector.config.host}")
-                raise Exception(f"Inject nemesis failed on {injector.config.host}")
-            self.unique_id.setdefault(injector, [])
-            self.unique_id[injector].append(output_dict["result"])
-            injected_host_list.append(injector.config.host)
-            
-    def dispatch_recover_command(self):
-        for injector, uid_list in self.unique_id.items():
-            for uid in uid_list:
-                output = injector.execute_command(f"blade destroy {uid}")
+    async def dispatch_inject_command(self, command):
+        target_injectors = await ScopeCalculator.get_injectors_from_scope(self.target_scope)
+        if not target_injectors:
+            return
+        # inject-start记下尝试注入的节点，注入结束后的inject只记真正注入成功的节点
+        history.record(INFO, NEMESIS_PROCESS, "inject-start", self.name, [injector.config.host for injector in target_injectors])
+        # 所有节点先准备好channel，再在barrier处同时发出命令，尽量让故障同时生效
+        barrier = threading.Barrier(len(target_injectors)) if self.barrier and len(target_injectors) > 1 else None
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        results = await asyncio.gather(*(injector.execute_command_async(command, barrier) for injector in target_injectors),
+                                       return_exceptions=True)
+        inject_latency = loop.time() - begin
+        failed_hosts: list[str] = []
+        injected_hosts: list[str] = []
+        sent_times: list[float] = []
+        for injector, result in zip(target_injectors, results):
+            if isinstance(result, BaseException):
+                logging.error(f"Inject nemesis on {injector.config.host} raised: {result}")
+                failed_hosts.append(injector.config.host)
+                continue
+            output, sent_at = result
+            try:
                 output_dict = json.loads(output)
-                if output_dict.get("code", 0) != 200 or not output_dict.get("success", False):
-                    logging.error(f"Recover nemesis failed on {injector.config.host}")
-                    raise Exception(f"Recover nemesis failed on {injector.config.host}")
-        self.unique_id = {}
+            except ValueError as e:
+                # 一个节点的输出有问题不能影响登记其他节点上已经注入的故障
+                logging.error(f"Unexpected blade output from {injector.config.host}: {output!r}: {e}")
+                failed_hosts.append(injector.config.host)
+                continue
+            if not isinstance(output_dict, dict) or output_dict.get("code", 0) != 200 \
+                    or not output_dict.get("success", False):
+                failed_hosts.append(injector.config.host)
+                continue
+            # 由fault_registry在duration之后按时恢复
+            fault_registry.register(injector, output_dict["result"], self.name, self.duration)
+            self.uids.append(output_dict["result"])
+            injected_hosts.append(injector.config.host)
+            sent_times.append(sent_at)
+        if len(sent_times) > 1:
+            self.inject_skew = max(sent_times) - min(sent_times)
+            logging.info(f"{self.name} reached {len(sent_times)} nodes with skew {self.inject_skew * 1000:.2f}ms.")
+        history.record(INFO, NEMESIS_PROCESS, "inject", self.name, injected_hosts)
+        metrics.record_operation("fault_injection", inject_latency, "error" if failed_hosts else "ok", fault=self.name)
+        if failed_hosts:
+            logging.error(f"Inject nemesis failed on {failed_hosts}")
+            raise Exception(f"Inject nemesis failed on {failed_hosts}")
+            
+    async def dispatch_recover_command(self):
+        """提前恢复这个nemesis注入的所有故障（到期的故障由fault_registry自动恢复）"""
+        uids, self.uids = self.uids, []
+        if not await fault_registry.recover(uids):
+            logging.error(f"Recover nemesis {self.name} failed on some nodes")
+            raise Exception(f"Recover nemesis {self.name} failed on some nodes")
             
     def get_json_str(self):
         info_dict = {
@@ -75,67 +122,63 @@ class Nemesis(ABC):
 
 
 class NetworkLoss(Nemesis):
-    def __init__(self, scope: str, start_time: str, duration: str, percent: int):
-        super().__init__("Packet_Loss", "Network", "Loss", scope, start_time, duration)
+    def __init__(self, scope: str, start_time: str, duration: str, percent: int, barrier: bool = True):
+        super().__init__("Packet_Loss", "Network", "Loss", scope, start_time, duration, barrier)
         self.percent = percent
 
     async def inject(self):
-        await asyncio.sleep(self.start_time)
         logging.info(f"Injecting {self}...")
-        command = f"blade create network loss --interface eth0 --exclude-port 22,4001 --timeout {self.duration} --percent {self.percent}"
-        self.dispatch_inject_command(command)
+        command = f"blade create network loss --interface eth0 --exclude-port 22,4001 --timeout {self.blade_timeout} --percent {self.percent}"
+        await self.dispatch_inject_command(command)
         
     async def recover(self):
         logging.info(f"Recovering {self}...")
-        self.dispatch_recover_command()
+        await self.dispatch_recover_command()
         
 
 class NetworkDelay(Nemesis):
-    def __init__(self, scope: str, start_time: str, duration: str, delay_time: int):
-        super().__init__("Network Delay", "Network", "Delay", scope, start_time, duration)
+    def __init__(self, scope: str, start_time: str, duration: str, delay_time: int, barrier: bool = True):
+        super().__init__("Network Delay", "Network", "Delay", scope, start_time, duration, barrier)
         self.delay_time = delay_time
         
     async def inject(self):
-        await asyncio.sleep(self.start_time)
         logging.info(f"Injecting {self}...")
-        command = f"blade create network delay --interface eth0 --exclude-port 22,4001 --timeout {self.duration} --time {self.delay_time}"
-        self.dispatch_inject_command(command)
+        command = f"blade create network delay --interface eth0 --exclude-port 22,4001 --timeout {self.blade_timeout} --time {self.delay_time}"
+        await self.dispatch_inject_command(command)
 
     async def recover(self):
         logging.info(f"Recovering {self}...")
-        self.dispatch_recover_command()
+        await self.dispatch_recover_command()
         
 
 class NetworkDuplicate(Nemesis):
-    def __init__(self, scope: str, start_time: str, duration: str, percent: int):
-        super().__init__("Packet Duplication", "Network", "Duplicate", scope, start_time, duration)
+    def __init__(self, scope: str, start_time: str, duration: str, percent: int, barrier: bool = True):
+        super().__init__("Packet Duplication", "Network", "Duplicate", scope, start_time, duration, barrier)
         self.percent = percent
 
     async def inject(self):
-        await asyncio.sleep(self.start_time)
         logging.info(f"Injecting {self}...")
-        command = f"blade create network duplicate --interface eth0 --exclude-port 22,4001 --timeout {self.duration} --percent {self.percent}"
-        self.dispatch_inject_command(command)
+        command = f"blade create network duplicate --interface eth0 --exclude-port 22,4001 --timeout {self.blade_timeout} --percent {self.percent}"
+        await self.dispatch_inject_command(command)
 
     async def recover(self):
         logging.info(f"Recovering {self}...")
-        self.dispatch_recover_command()
+        await self.dispatch_recover_command()
         
 
 class NetworkCorrupt(Nemesis):
-    def __init__(self, scope: str, start_time: str, duration: str, percent: int):
-        super().__init__("Packet Corruption", "Network", "Corrupt", scope, start_time, duration)
+    def __init__(self, scope: str, start_time: str, duration: str, percent: int, barrier: bool = True):
+        super().__init__("Packet Corruption", "Network", "Corrupt", scope, start_time, duration, barrier)
         self.percent = percent
 
     async def inject(self):
-        await asyncio.sleep(self.start_time)
         logging.info(f"Injecting {self}...")
-        command = f"blade create network corrupt --interface eth0 --exclude-port 22,4001 --timeout {self.duration} --percent {self.percent}"
-        self.dispatch_inject_command(command)
+        command = f"blade create network corrupt --interface eth0 --exclude-port 22,4001 --timeout {self.blade_timeout} --percent {self.percent}"
+        await self.dispatch_inject_command(command)
 
     async def recover(self):
         logging.info(f"Recovering {self}...")
-        self.dispatch_recover_command()
+        await self.dispatch_recover_command()
         
 
 class NetworkNemesisFactory:
@@ -143,13 +186,15 @@ class NetworkNemesisFactory:
     def create_network_nemesis(cls, data) -> Nemesis:
         title = data.get("title")
         parameters = data.get("parameters", {})
+        barrier = parameters.get("barrier", True)
         if title == "network_loss":
             percent = parameters.get("percent", 100)
             return NetworkLoss(
                 scope=data["scope"],
                 start_time=data["start_time"],
                 duration=data["duration"],
-                percent=percent
+                percent=percent,
+                barrier=barrier
             )
         elif title == "network_delay":
             delay_time = parameters.get("delay_time", 0)
@@ -157,7 +202,8 @@ class NetworkNemesisFactory:
                 scope=data["scope"],
                 start_time=data["start_time"],
                 duration=data["duration"],
-                delay_time=delay_time
+                delay_time=delay_time,
+                barrier=barrier
             )
         elif title == "network_duplicate":
             percent = parameters.get("percent", 100)
@@ -165,7 +211,8 @@ class NetworkNemesisFactory:
                 scope=data["scope"],
                 start_time=data["start_time"],
                 duration=data["duration"],
-                percent=percent
+                percent=percent,
+                barrier=barrier
             )
         elif title == "network_corrupt":
             percent = parameters.get("percent", 100)
@@ -173,7 +220,8 @@ class NetworkNemesisFactory:
                 scope=data["scope"],
                 start_time=data["start_time"],
                 duration=data["duration"],
-                percent=percent
+                percent=percent,
+                barrier=barrier
             )
         else:
             raise ValueError(f"Unknown nemesis type: {title}")
@@ -5,6 +5,8 @@ from .config import DatabaseConfig, ChaosConfig
 from .nemesis import Nemesis, NetworkNemesisFactory
 from .workload import *
 from .checker import *
+from .scope_calculator import MULTI_NODE_SCOPES
+from .telemetry import DEFAULT_EXPVAR_FIELDS
 from .tools import time_string_to_seconds
     
     
@@ -14,6 +16,37 @@ class YamlParser:
     inject_retry_count: int
     query_retry_count: int
     timeout: int
+    max_connections: int
+    max_inflight: int
+    topology_ttl: float
+    topology_refresh_interval: float
+    ssh_max_channels: int
+    ssh_keepalive: int
+    setup_concurrency: int
+    setup_timeout: float
+    ready_timeout: float
+    history_dir: str
+    metrics_host: str
+    metrics_port: int
+    log_level: str
+    log_json: bool
+    log_rate_limit: float
+    log_burst: int
+    retry_base_delay: float
+    retry_max_delay: float
+    retry_deadline: float
+    breaker_threshold: int
+    breaker_reset_timeout: float
+    workload_processes: int
+    telemetry_interval: float
+    telemetry_capacity: int
+    telemetry_expvar_interval: float
+    telemetry_expvar_fields: list[str]
+    chaos_agent: bool
+    chaos_agent_python: str
+    reset_strategies: list[str]
+    reset_snapshot_dir: str
+    teardown_after_run: bool
     
     def __init__(self, yaml_path):
         with open(yaml_path, "r", encoding="utf-8") as file:
@@ -23,6 +56,37 @@ class YamlParser:
             self.inject_retry_count = config["inject_retry_count"]
             self.query_retry_count = config["query_retry_count"]
             self.timeout = config["timeout"]
+            self.max_connections = config.get("max_connections", 32)
+            self.max_inflight = config.get("max_inflight", 64)
+            self.topology_ttl = config.get("topology_ttl", 2.0)
+            self.topology_refresh_interval = config.get("topology_refresh_interval", 0.5)
+            self.ssh_max_channels = config.get("ssh_max_channels", 8)
+            self.ssh_keepalive = config.get("ssh_keepalive", 15)
+            self.setup_concurrency = config.get("setup_concurrency", 16)
+            self.setup_timeout = config.get("setup_timeout", 60)
+            self.ready_timeout = config.get("ready_timeout", 30)
+            self.history_dir = config.get("history_dir", "history")
+            self.metrics_host = config.get("metrics_host", "127.0.0.1")
+            self.metrics_port = config.get("metrics_port", 9400)
+            self.log_level = config.get("log_level", "INFO")
+            self.log_json = config.get("log_json", False)
+            self.log_rate_limit = config.get("log_rate_limit", 20)
+            self.log_burst = config.get("log_burst", 100)
+            self.retry_base_delay = config.get("retry_base_delay", 0.1)
+            self.retry_max_delay = config.get("retry_max_delay", 2.0)
+            self.retry_deadline = config.get("retry_deadline", 10.0)
+            self.breaker_threshold = config.get("breaker_threshold", 5)
+            self.breaker_reset_timeout = config.get("breaker_reset_timeout", 5.0)
+            self.workload_processes = config.get("workload_processes", 1)
+            self.telemetry_interval = config.get("telemetry_interval", 0.2)
+            self.telemetry_capacity = config.get("telemetry_capacity", 9000)
+            self.telemetry_expvar_interval = config.get("telemetry_expvar_interval", 1.0)
+            self.telemetry_expvar_fields = config.get("telemetry_expvar_fields", list(DEFAULT_EXPVAR_FIELDS))
+            self.chaos_agent = config.get("chaos_agent", True)
+            self.chaos_agent_python = config.get("chaos_agent_python", "python3")
+            self.reset_strategies = config.get("reset_strategies", ["logical", "snapshot", "restart"])
+            self.reset_snapshot_dir = config.get("reset_snapshot_dir", self.history_dir)
+            self.teardown_after_run = config.get("teardown_after_run", False)
     
     def get_nodes_name_list(self) -> list[str]:
         return list(self.nodes.keys())
@@ -30,12 +94,17 @@ class YamlParser:
     def get_database_config(self, node_name: str) -> DatabaseConfig:
         node_info = self.nodes[node_name]
         return DatabaseConfig(node_name, node_info["host"], node_info["api_port"], node_info["ssh_port"], node_info["db_username"], 
-                              node_info["db_password"], self.query_retry_count, self.timeout)
+                              node_info["db_password"], self.query_retry_count, self.timeout,
+                              self.max_connections, self.max_inflight, self.retry_base_delay,
+                              self.retry_max_delay, self.retry_deadline, self.breaker_threshold,
+                              self.breaker_reset_timeout)
         
     def get_chaos_config(self, node_name: str) -> ChaosConfig:
         node_info = self.nodes[node_name]
         return ChaosConfig(node_name, node_info["host"], node_info["ssh_port"], node_info["chaos_username"], 
-                           node_info["chaos_password"], self.inject_retry_count, self.timeout)
+                           node_info["chaos_password"], self.inject_retry_count, self.timeout,
+                           self.retry_base_delay, self.retry_max_delay, self.chaos_agent,
+                           self.chaos_agent_python)
         
 
 class PlanParser:
@@ -61,12 +130,19 @@ class PlanParser:
         WorkloadClass = WORKLOAD_MAPPING.get(title)
         if WorkloadClass is None:
             raise ValueError(f"Unknown workload type: {title}")
+        scope = workload_info.get("scope", "none")
+        if WorkloadClass.writes_every_target and scope in MULTI_NODE_SCOPES:
+            raise ValueError(f"Workload {title} writes to every node in its scope, "
+                             f"use a single-node scope instead of {scope}")
         
-        return WorkloadClass(
-            scope=workload_info.get("scope", "none"),
+        workload = WorkloadClass(
+            scope=scope,
             start_time=workload_info.get("start_time", "0s"),
-            times=workload_info.get("times", "0")
+            times=workload_info.get("times", "0"),
+            **workload_info.get("parameters", {})
         )
+        workload.plan_info = workload_info
+        return workload
         
         
     @staticmethod
@@ -77,7 +153,8 @@ class PlanParser:
             raise ValueError(f"Unknown checker type: {title}")
         
         return CheckClass(
-            start_time=check_info.get("start_time", "0s")
+            start_time=check_info.get("start_time", "0s"),
+            **check_info.get("parameters", {})
         )
 
     @staticmethod
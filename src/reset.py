@@ -0,0 +1,235 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Callable, Optional, Type
+
+from .config import host_alias_dict
+from .db import Database, StatementError, WORKLOAD_TABLES, alias_database_dict
+from .fault_injector import alias_injector_dict
+from .fault_registry import fault_registry
+from .parser import YamlParser
+from .scope_calculator import cluster_topology
+
+# 健康检查轮询各节点的间隔（秒）
+HEALTH_CHECK_INTERVAL = 0.2
+
+
+async def run_on_nodes(action: str, jobs: dict[str, Callable[[], Any]], concurrency: int, timeout: float,
+                       raise_on_error: bool = False):
+    """在线程池里并发执行每个节点上的阻塞操作，最多同时concurrency个，每个节点最多等timeout秒"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_job(node_name: str, job: Callable[[], Any]):
+        async with semaphore:
+            try:
+                await asyncio.wait_for(asyncio.to_thread(job), timeout)
+            except asyncio.TimeoutError:
+                logging.error(f"{action} on {node_name} timed out after {timeout}s.")
+                raise Exception(f"{action} on {node_name} timed out after {timeout}s.")
+            except Exception as e:
+                logging.error(f"Error occured when {action} on {node_name}: {str(e)}")
+                raise
+
+    results = await asyncio.gather(*(run_job(node_name, job) for node_name, job in jobs.items()), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors and raise_on_error:
+        raise errors[0]
+
+
+async def connect_injectors(yaml_parser: YamlParser):
+    await run_on_nodes("connecting injector", {node_name: injector.connect for node_name, injector in alias_injector_dict.items()},
+                       yaml_parser.setup_concurrency, yaml_parser.setup_timeout, raise_on_error=True)
+    # 之前的运行如果异常退出，节点上可能还留着故障，不清掉的话重置后的健康检查也过不了
+    await fault_registry.sweep_stale(alias_injector_dict.values())
+
+
+async def close_injectors(yaml_parser: YamlParser):
+    await run_on_nodes("closing injector", {node_name: injector.close for node_name, injector in alias_injector_dict.items()},
+                       yaml_parser.setup_concurrency, yaml_parser.setup_timeout)
+
+
+async def stop_databases(yaml_parser: YamlParser):
+    begin = time.monotonic()
+    await run_on_nodes("tearing down db", {node_name: db.teardownDB for node_name, db in alias_database_dict.items()},
+                       yaml_parser.setup_concurrency, yaml_parser.setup_timeout)
+    logging.info(f"Cluster teardown of {len(alias_database_dict)} nodes finished in {time.monotonic() - begin:.2f}s.")
+
+
+async def start_databases(yaml_parser: YamlParser):
+    begin = time.monotonic()
+    await run_on_nodes("setting up db", {node_name: db.setupDB for node_name, db in alias_database_dict.items()},
+                       yaml_parser.setup_concurrency, yaml_parser.setup_timeout)
+    await cluster_topology.wait_until_ready(yaml_parser.ready_timeout)
+    logging.info(f"Cluster bring-up of {len(alias_database_dict)} nodes finished in {time.monotonic() - begin:.2f}s.")
+
+
+async def get_leader() -> Database:
+    """强制刷新拓扑后返回当前的leader，重置前缓存的leader可能早就不对了"""
+    await cluster_topology.refresh(force=True)
+    return alias_database_dict[host_alias_dict[cluster_topology.leader_hosts[0]]]
+
+
+def reset_statements() -> list[str]:
+    """删掉并重建所有workload表的语句，放在一个事务里执行"""
+    statements = []
+    for table, create_statements in WORKLOAD_TABLES.items():
+        statements.append(f"DROP TABLE IF EXISTS {table};")
+        statements.extend(create_statements)
+    return statements
+
+
+async def check_health(timeout: float):
+    """所有节点都认同同一个leader，并且每个节点本地都已经有空的workload表，否则在timeout秒后抛出异常
+
+    用level=none逐个节点读本地数据，确认重置已经复制到了每个节点，而不只是leader。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    await cluster_topology.wait_until_ready(timeout)
+    sql = [f"SELECT COUNT(*) FROM {table}" for table in WORKLOAD_TABLES]
+
+    async def check_node(database: Database) -> Optional[str]:
+        try:
+            results = await database.query_once(sql, HEALTH_CHECK_INTERVAL * 5, "none")
+        except Exception as e:
+            return f"{database.name}: {e}"
+        for table, result in zip(WORKLOAD_TABLES, results or []):
+            if "error" in result:
+                return f"{database.name}: {result['error']}"
+            if result.get("values") != [[0]]:
+                return f"{database.name}: table {table} is not empty"
+        return None
+
+    while True:
+        problems = [problem for problem in await asyncio.gather(*(check_node(database) for database in alias_database_dict.values()))
+                    if problem is not None]
+        if not problems:
+            return
+        if loop.time() >= deadline:
+            raise Exception(f"Cluster is unhealthy after {timeout}s: {'; '.join(problems)}")
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+
+class ResetStrategy(ABC):
+    """把集群恢复到干净状态的一种方法，执行完之后由ClusterReset做健康检查"""
+    name: str
+
+    def __init__(self, yaml_parser: YamlParser):
+        self.yaml_parser = yaml_parser
+
+    @abstractmethod
+    async def reset(self):
+        pass
+
+
+class LogicalReset(ResetStrategy):
+    """在一个事务里删掉并重建所有workload表，只有一次请求"""
+    name = "logical"
+
+    async def reset(self):
+        leader = await get_leader()
+        results = await leader.send_batch(reset_statements(), self.yaml_parser.timeout, transaction=True)
+        for result in results:
+            if "error" in result:
+                raise StatementError(result["error"])
+
+
+class SnapshotReset(ResetStrategy):
+    """用/db/load把之前保存的干净数据库整体恢复到集群上，能修复表结构被破坏之类逻辑重置处理不了的情况
+
+    第一次重置成功后从leader上用/db/backup保存快照，文件名带上建表语句的摘要，表结构变化后自动换新的快照。
+    """
+    name = "snapshot"
+
+    @property
+    def path(self) -> Path:
+        digest = hashlib.sha1("\n".join(reset_statements()).encode()).hexdigest()[:12]
+        return Path(self.yaml_parser.reset_snapshot_dir) / f"reset_snapshot_{digest}.sqlite"
+
+    async def reset(self):
+        path = self.path
+        if not path.exists():
+            raise Exception(f"No snapshot at {path} yet.")
+        leader = await get_leader()
+        await leader.load(path.read_bytes(), self.yaml_parser.setup_timeout)
+
+    async def save(self):
+        """集群刚通过健康检查时调用，还没有快照时保存一份"""
+        path = self.path
+        if path.exists():
+            return
+        leader = await get_leader()
+        data = await leader.backup(self.yaml_parser.setup_timeout)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 多个集群可能同时运行计划，先写临时文件再替换
+        temporary_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temporary_path.write_bytes(data)
+        os.replace(temporary_path, path)
+        logging.info(f"Saved a {len(data)} bytes reset snapshot to {path}.")
+
+
+class FullRestart(ResetStrategy):
+    """在所有节点上重启rqlite，等选出leader后重建workload表，最慢但能处理节点卡死之类的问题"""
+    name = "restart"
+
+    async def reset(self):
+        await stop_databases(self.yaml_parser)
+        await start_databases(self.yaml_parser)
+        await LogicalReset(self.yaml_parser).reset()
+
+
+RESET_STRATEGIES: dict[str, Type[ResetStrategy]] = {
+    "logical": LogicalReset,
+    "snapshot": SnapshotReset,
+    "restart": FullRestart
+}
+
+
+class ClusterReset:
+    """在每个计划开始前把集群恢复到干净状态
+
+    按配置的顺序（代价从低到高）尝试各个策略，策略执行出错或者之后的健康检查不通过才换下一个，
+    大多数情况下一次逻辑重置就够了，不用每次都重启rqlite。
+    """
+    strategies: list[ResetStrategy]
+
+    def __init__(self, yaml_parser: YamlParser):
+        self.yaml_parser = yaml_parser
+        self.strategies = []
+        for name in yaml_parser.reset_strategies:
+            Strategy = RESET_STRATEGIES.get(name)
+            if Strategy is None:
+                raise ValueError(f"Unknown reset strategy: {name}")
+            self.strategies.append(Strategy(yaml_parser))
+        if not self.strategies:
+            raise ValueError("At least one reset strategy is required.")
+
+    async def run(self) -> str:
+        """返回最终生效的策略名，所有策略都失败时抛出异常"""
+        begin = time.monotonic()
+        errors = []
+        for strategy in self.strategies:
+            strategy_begin = time.monotonic()
+            try:
+                await strategy.reset()
+                await check_health(self.yaml_parser.ready_timeout)
+            except Exception as e:
+                logging.warning(f"Reset by {strategy.name} failed after {time.monotonic() - strategy_begin:.2f}s: {e}")
+                errors.append(f"{strategy.name}: {e}")
+                continue
+            logging.info(f"Cluster is reset by {strategy.name} in {time.monotonic() - begin:.2f}s.")
+            await self.save_snapshot()
+            return strategy.name
+        raise Exception(f"Failed to reset the cluster: {'; '.join(errors)}")
+
+    async def save_snapshot(self):
+        for strategy in self.strategies:
+            if isinstance(strategy, SnapshotReset):
+                try:
+                    await strategy.save()
+                except Exception as e:
+                    logging.warning(f"Failed to save reset snapshot: {e}")
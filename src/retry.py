@@ -0,0 +1,159 @@
+import random
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from .metrics import metrics
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DefiniteError(Exception):
+    """操作确定没有生效（请求没有发出、被拒绝或者被重定向），history里记为fail而不是info
+
+    retryable: 换个时机重试是否可能成功；node_failure: 是否说明节点本身不可用（计入熔断）
+    """
+    retryable = True
+    node_failure = False
+
+
+class CircuitOpenError(DefiniteError):
+    """节点的熔断器处于打开状态，请求根本没有发出"""
+    retryable = False
+
+
+class CircuitBreaker:
+    """单个节点的熔断器：连续失败threshold次后打开，期间的请求直接失败；
+    reset_timeout秒后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+    name: str
+    threshold: int
+    reset_timeout: float
+
+    def __init__(self, name: str, threshold: int = 5, reset_timeout: float = 5.0):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    @staticmethod
+    def now() -> float:
+        # 用事件循环的时间，模拟模式下跟着虚拟时钟走
+        return asyncio.get_running_loop().time()
+
+    def check(self):
+        """请求发出前调用，熔断打开时抛出CircuitOpenError"""
+        if self.threshold <= 0 or self.state == CLOSED:
+            return
+        if self.state == OPEN and self.now() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return
+        metrics.increment("circuit_rejected_total", node=self.name)
+        raise CircuitOpenError(f"Circuit breaker of {self.name} is {self.state}, request is not sent.")
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logging.info(f"Circuit breaker of {self.name} closed.")
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold > 0):
+            self.state = OPEN
+            self.opened_at = self.now()
+            self.probing = False
+            metrics.increment("circuit_open_total", node=self.name)
+            logging.warning(f"Circuit breaker of {self.name} opened after {self.failures} consecutive failures.")
+
+    async def call(self, action: Callable[..., Awaitable[T]], *args) -> T:
+        """经过熔断器执行一次action，根据结果更新熔断状态"""
+        self.check()
+        try:
+            result = await action(*args)
+        except asyncio.CancelledError:
+            # 探测请求被取消了，让下一个请求重新探测
+            self.probing = False
+            raise
+        except Exception as e:
+            if getattr(e, "node_failure", True):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+
+class RetryPolicy:
+    """指数退避（full jitter）的重试策略，同时受最大尝试次数和整个操作的deadline约束"""
+    attempts: int
+    base_delay: float
+    max_delay: float
+    deadline: float
+
+    def __init__(self, attempts: int = 5, base_delay: float = 0.1, max_delay: float = 2.0, deadline: float = 10.0):
+        self.attempts = max(int(attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt: int) -> float:
+        """第attempt次（从1开始）失败之后等待的秒数"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def run(self, action: Callable[[float], Awaitable[T]], op: str, node: str,
+                  breaker: Optional[CircuitBreaker] = None, description: Optional[str] = None,
+                  idempotent: bool = True) -> T:
+        """反复执行action(剩余时间)直到成功
+
+        idempotent为False时（例如CAS），一旦某次尝试的结果不确定就不再重试，否则重复执行可能改变结果。
+
+        放弃时，如果每次尝试都确定没有生效就抛出DefiniteError，否则抛出普通的Exception（结果不确定）。
+        之前的尝试都确定没有生效时，不可重试的DefiniteError（例如语句错误、熔断打开）原样抛出。
+        """
+        description = description or op
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        definite = True
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if breaker is not None:
+                    return await breaker.call(action, deadline - loop.time())
+                return await action(deadline - loop.time())
+            except Exception as e:
+                if isinstance(e, DefiniteError):
+                    retryable = e.retryable
+                else:
+                    retryable = idempotent
+                delay = self.backoff(attempt)
+                if retryable and attempt < self.attempts and loop.time() + delay < deadline:
+                    definite = definite and isinstance(e, DefiniteError)
+                    metrics.increment("retry_total", op=op, node=node)
+                    logging.warning(f"Retrying {description} on {node} in {delay:.2f}s ({attempt}/{self.attempts}): {e}")
+                    await asyncio.sleep(delay)
+                    continue
+                if isinstance(e, DefiniteError) and definite:
+                    if not retryable:
+                        raise
+                    outcome = "definite"
+                else:
+                    # 之前的尝试可能已经生效了，不能因为最后一次被拒绝就记成确定失败
+                    outcome = "indeterminate"
+                metrics.increment("retry_give_up_total", op=op, node=node, outcome=outcome)
+                message = f"Gave up {description} on {node} after {attempt} attempts: {e}"
+                logging.error(message)
+                raise (DefiniteError if outcome == "definite" else Exception)(message) from e
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, TypeVar
+from urllib.parse import urlsplit
+
+from .config import host_alias_dict
+from .db import Database, NotLeaderError, alias_database_dict
+from .retry import RetryPolicy, DefiniteError, CircuitOpenError
+from .scope_calculator import cluster_topology
+from .metrics import metrics
+from .logging_config import log_context
+
+T = TypeVar("T")
+
+# 一次尝试里最多跟随的重定向次数，选举期间leader可能连续变化
+MAX_REDIRECTS = 3
+
+
+class LeaderRouter:
+    """把写请求和需要leader的读请求直接发给缓存的leader，省掉follower转发的一跳
+
+    请求都带上redirect参数：被重定向时从Location里得到新的leader，立即改发过去并更新缓存；
+    leader超时、返回503或者熔断时丢弃缓存，下一次尝试通过集群拓扑重新查找。
+    从发现leader不可用到写入在新leader上成功的时间记在leader_failover_seconds里。
+    """
+    name = "leader"
+    retry_policy: RetryPolicy
+
+    def __init__(self, retry_policy: Optional[RetryPolicy] = None):
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.leader: Optional[Database] = None
+        self.lost_leader: Optional[str] = None
+        self.lost_at: Optional[float] = None
+
+    def reset(self):
+        """清空缓存的leader，在新的事件循环里复用这个全局对象之前调用（例如模拟模式）"""
+        self.leader = None
+        self.lost_leader = None
+        self.lost_at = None
+
+    @staticmethod
+    def now() -> float:
+        return asyncio.get_running_loop().time()
+
+    async def get_leader(self) -> Database:
+        if self.leader is None:
+            try:
+                leader_hosts, _, _ = await cluster_topology.get_view()
+                self.leader = alias_database_dict[host_alias_dict[leader_hosts[0]]]
+            except Exception as e:
+                raise DefiniteError(f"Leader is unknown: {e}") from e
+        return self.leader
+
+    def leader_lost(self, database: Database):
+        if self.leader is database:
+            self.leader = None
+        if self.lost_at is None:
+            self.lost_at = self.now()
+            self.lost_leader = database.name
+        cluster_topology.invalidate()
+
+    def leader_confirmed(self, database: Database):
+        self.leader = database
+        if self.lost_at is None:
+            return
+        if database.name != self.lost_leader:
+            elapsed = self.now() - self.lost_at
+            metrics.observe("leader_failover_seconds", elapsed)
+            metrics.increment("leader_change_total")
+            logging.info(f"Leader moved from {self.lost_leader} to {database.name}, "
+                         f"requests recovered after {elapsed:.3f}s.")
+        self.lost_at = None
+        self.lost_leader = None
+
+    def follow(self, error: NotLeaderError) -> Database:
+        alias = host_alias_dict.get(urlsplit(error.location or "").hostname)
+        if alias is None:
+            raise DefiniteError(f"Redirected to unknown leader {error.location}: {error}")
+        self.leader = alias_database_dict[alias]
+        return self.leader
+
+    async def send(self, op: str, request: Callable[[Database, float], Awaitable[T]], timeout: float) -> T:
+        """把一次请求发给当前leader，必要时跟随重定向"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        database = await self.get_leader()
+        for _ in range(MAX_REDIRECTS + 1):
+            with log_context(node=database.name):
+                try:
+                    result = await database.breaker.call(request, database, deadline - loop.time())
+                except NotLeaderError as e:
+                    metrics.increment("leader_redirect_total", op=op)
+                    self.leader_lost(database)
+                    database = self.follow(e)
+                    continue
+                except CircuitOpenError as e:
+                    # 这个节点已知不可用，换一个leader后可以重试
+                    self.leader_lost(database)
+                    raise DefiniteError(str(e)) from e
+                except Exception as e:
+                    if getattr(e, "node_failure", True):
+                        self.leader_lost(database)
+                    raise
+            self.leader_confirmed(database)
+            return result
+        raise DefiniteError(f"{op} was redirected more than {MAX_REDIRECTS} times.")
+
+    async def execute(self, sql: list, idempotent: bool = True) -> list[dict]:
+        async def attempt(timeout: float) -> list[dict]:
+            return await self.send("execute", lambda database, remaining: database.execute_once(sql, remaining, True),
+                                   timeout)
+
+        return await self.retry_policy.run(attempt, "execute", self.name, description=f"execute {sql}",
+                                           idempotent=idempotent)
+
+    async def execute_batch(self, statements: list, transaction: bool = False, queue: bool = False) -> list[dict]:
+        """和Database.execute_batch一样不重试，但会跟随重定向（被重定向的请求确定没有执行）"""
+        return await self.send("execute_batch",
+                               lambda database, remaining: database.send_batch(statements, remaining, transaction,
+                                                                               queue, True),
+                               self.retry_policy.deadline)
+
+    async def request(self, statements: list, transaction: bool = False, level: str = None,
+                      idempotent: bool = True) -> list[dict]:
+        async def attempt(timeout: float) -> list[dict]:
+            return await self.send("request",
+                                   lambda database, remaining: database.request_once(statements, remaining, transaction,
+                                                                                     level, True),
+                                   timeout)
+
+        return await self.retry_policy.run(attempt, "request", self.name, description=f"request {statements}",
+                                           idempotent=idempotent)
+
+    async def query(self, sql: list, level: str = None):
+        """在leader上查询，strong/linearizable读本来就要由leader处理"""
+        async def attempt(timeout: float):
+            return await self.send("query", lambda database, remaining: database.query_once(sql, remaining, level, True),
+                                   timeout)
+
+        return await self.retry_policy.run(attempt, "query", self.name, description=f"query {sql}")
+
+
+leader_router = LeaderRouter()
@@ -0,0 +1,134 @@
+import heapq
+import asyncio
+import logging
+from typing import Any, Optional
+
+from .nemesis import Nemesis
+from .checker import Check
+from .workload import Workload
+from .worker_pool import worker_pool
+from .history import history, INFO
+from .logging_config import log_context
+
+SCHEDULER_PROCESS = "scheduler"
+
+
+class EventTiming:
+    """一个事件计划和实际的开始时间（相对计划开始时刻的秒数）"""
+    __slots__ = ("name", "planned", "actual", "finished", "result")
+
+    def __init__(self, name: str, planned: float):
+        self.name = name
+        self.planned = planned
+        self.actual: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.result: Any = None
+
+    @property
+    def drift(self) -> Optional[float]:
+        return None if self.actual is None else self.actual - self.planned
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "planned": self.planned, "actual": self.actual, "drift": self.drift,
+                "finished": self.finished}
+
+
+class TimelineScheduler:
+    """按绝对的单调时钟deadline调度计划中的事件
+
+    所有事件按start_time放进优先队列，到点就分派成独立的task，阻塞的Check不会推迟其他事件。
+    所有事件都结束、有Check报告发现bug，或者到达total_time时结束。
+    """
+    total_time: int
+    timings: list[EventTiming]
+
+    def __init__(self, event_list: list, total_time: int):
+        self.event_list = event_list
+        self.total_time = total_time
+        self.timings = []
+        self.bug_found = asyncio.Event()
+        self.tasks: set[asyncio.Task] = set()
+
+    @staticmethod
+    async def start_event(event) -> Any:
+        if isinstance(event, Nemesis):
+            return await event.inject()
+        if isinstance(event, Workload) and worker_pool.shard_count(event) > 1:
+            return await worker_pool.run(event)
+        return await event.start()
+
+    async def run_event(self, event, timing: EventTiming, origin: float, event_id: str):
+        loop = asyncio.get_running_loop()
+        try:
+            # 事件里产生的日志（包括它创建的task）都带上event_id
+            with log_context(event_id=event_id):
+                timing.result = await self.start_event(event)
+            if isinstance(event, Check) and timing.result == True:
+                logging.info(f"BUG FOUND by {event.name}!")
+                self.bug_found.set()
+        except Exception as e:
+            logging.error(f"Event {event.name} failed: {e}")
+        finally:
+            timing.finished = loop.time() - origin
+
+    def dispatch(self, event, timing: EventTiming, origin: float, seq: int):
+        loop = asyncio.get_running_loop()
+        timing.actual = loop.time() - origin
+        history.record(INFO, SCHEDULER_PROCESS, "dispatch", timing.name, [timing.planned, timing.actual])
+        if timing.drift > 0.1:
+            logging.warning(f"{timing.name} started {timing.drift * 1000:.1f}ms later than planned.")
+        task = asyncio.create_task(self.run_event(event, timing, origin, f"{seq}:{timing.name}"))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def wait_for_bug(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.bug_found.wait(), max(timeout, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self) -> bool:
+        """执行整个计划，返回是否发现了bug"""
+        loop = asyncio.get_running_loop()
+        origin = loop.time()
+        end = origin + self.total_time
+        queue: list[tuple[float, int, Any, EventTiming]] = []
+        for seq, event in enumerate(self.event_list):
+            timing = EventTiming(event.name, event.start_time)
+            self.timings.append(timing)
+            heapq.heappush(queue, (origin + event.start_time, seq, event, timing))
+
+        try:
+            while queue and loop.time() < end:
+                deadline = queue[0][0]
+                if await self.wait_for_bug(deadline - loop.time()):
+                    break
+                # 事件循环按时钟精度判断定时器到期，醒来时loop.time()可能还差一点点没到deadline
+                while queue and queue[0][0] <= max(deadline, loop.time()):
+                    _, seq, event, timing = heapq.heappop(queue)
+                    self.dispatch(event, timing, origin, seq)
+
+            # 所有事件都已分派，等它们结束（或者发现bug、到达total_time）
+            while self.tasks and not self.bug_found.is_set() and loop.time() < end:
+                waiter = asyncio.create_task(self.bug_found.wait())
+                try:
+                    await asyncio.wait(self.tasks | {waiter}, timeout=end - loop.time(),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.report(loop.time() - origin)
+        return self.bug_found.is_set()
+
+    def report(self, elapsed: float):
+        drifts = [timing.drift for timing in self.timings if timing.drift is not None]
+        max_drift = max(drifts) * 1000 if drifts else 0.0
+        logging.info(f"Plan finished in {elapsed:.2f}s, {len(drifts)}/{len(self.timings)} events dispatched, "
+                     f"max start drift {max_drift:.2f}ms.")
+        for timing in self.timings:
+            logging.debug(f"Event timing: {timing.to_dict()}")
@@ -1,95 +1,227 @@
-import json
 import random
-import requests
+import asyncio
 import logging
-from typing import Union
+from collections import Counter
+from typing import Optional
 
-from .config import alias_host_dict, host_alias_dict, injected_host_list
+from .config import host_alias_dict, injected_host_list
 from .fault_injector import FaultInjector, alias_injector_dict
-from .db import Database, alias_database_dict
+from .db import Database, alias_database_dict, topology_listeners
+
+
+class ClusterTopology:
+    """集群拓扑的缓存视图：后台轮询所有节点的/status，并按角色预先建好host集合"""
+    ttl: float
+    refresh_interval: float
+    leader_hosts: tuple[str, ...]
+    follower_hosts: tuple[str, ...]
+    node_hosts: tuple[str, ...]
+
+    def __init__(self, ttl: float = 2.0, refresh_interval: float = 0.5):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.leader_hosts = ()
+        self.follower_hosts = ()
+        self.node_hosts = ()
+        self.updated_at = float("-inf")
+        self.refresh_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    def reset(self):
+        """清空缓存并重建同步原语，在新的事件循环里复用这个全局对象之前调用（例如模拟模式）"""
+        self.leader_hosts = ()
+        self.follower_hosts = ()
+        self.node_hosts = ()
+        self.updated_at = float("-inf")
+        self.refresh_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.refresh_task = None
+
+    @staticmethod
+    def now() -> float:
+        return asyncio.get_running_loop().time()
+
+    def is_fresh(self) -> bool:
+        return self.now() - self.updated_at < self.ttl
+
+    def invalidate(self):
+        """写请求被重定向、发现leader变更时调用，下一次查询scope会强制刷新"""
+        self.updated_at = float("-inf")
+        self.wakeup.set()
+
+    @staticmethod
+    def parse_status(status: dict) -> tuple[str, list[str]]:
+        store = status["store"]
+        leader_host = store["leader"]["addr"].split(":")[0]  # 去掉端口
+        node_host_list = [node["addr"].split(":")[0] for node in store["nodes"]]
+        return leader_host, node_host_list
+
+    async def refresh(self, force: bool = False):
+        async with self.refresh_lock:
+            # 等锁期间可能已经有别的协程刷新过了
+            if not force and self.is_fresh():
+                return
+            databases = list(alias_database_dict.values())
+            results = await asyncio.gather(*(db.status() for db in databases), return_exceptions=True)
+
+            votes: Counter = Counter()
+            node_host_list: list[str] = []
+            for db, result in zip(databases, results):
+                if isinstance(result, BaseException):
+                    logging.debug(f"Query status of {db.config.host} failed: {result}")
+                    continue
+                try:
+                    leader_host, hosts = self.parse_status(result)
+                except (KeyError, TypeError, AttributeError) as e:
+                    logging.debug(f"Unexpected status from {db.config.host}: {e}")
+                    continue
+                if not leader_host:
+                    continue
+                # leader自己的回答最可信，多算一票
+                votes[leader_host] += 2 if leader_host == db.config.host else 1
+                if len(hosts) > len(node_host_list):
+                    node_host_list = hosts
+            if not votes:
+                raise Exception("Query node info failed: no node reports a leader.")
+
+            leader_host = votes.most_common(1)[0][0]
+            if self.leader_hosts and self.leader_hosts[0] != leader_host:
+                logging.info(f"Leader changed from {self.leader_hosts[0]} to {leader_host}.")
+            self.leader_hosts = (leader_host,)
+            self.node_hosts = tuple(node_host_list)
+            self.follower_hosts = tuple(host for host in node_host_list if host != leader_host)
+            self.updated_at = self.now()
+
+    async def get_view(self) -> tuple[tuple[str, ...], tuple[str, ...], tuple[str, ...]]:
+        """返回(leader, followers, all nodes)；缓存过期时才会走网络"""
+        if not self.is_fresh():
+            await self.refresh()
+        return self.leader_hosts, self.follower_hosts, self.node_hosts
+
+    async def wait_until_ready(self, timeout: float, interval: float = 0.2):
+        """等到每个节点都报告了同一个Raft leader为止，用来代替启动后固定sleep"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        databases = list(alias_database_dict.values())
+        while True:
+            results = await asyncio.gather(*(db.status(interval * 5) for db in databases), return_exceptions=True)
+            leaders = set()
+            for result in results:
+                if isinstance(result, BaseException):
+                    leaders.add(None)
+                    continue
+                try:
+                    leaders.add(self.parse_status(result)[0] or None)
+                except (KeyError, TypeError, AttributeError):
+                    leaders.add(None)
+            if len(leaders) == 1 and None not in leaders:
+                self.invalidate()
+                logging.info(f"All {len(databases)} nodes report leader {leaders.pop()}.")
+                return
+            if loop.time() >= deadline:
+                raise Exception(f"Cluster is not ready after {timeout}s, leaders reported: {leaders}")
+            await asyncio.sleep(interval)
+
+    async def run_refresher(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.refresh(force=True)
+            except Exception as e:
+                logging.warning(f"Refresh cluster topology failed: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.run_refresher())
+
+    async def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+            self.refresh_task = None
+
+
+cluster_topology = ClusterTopology()
+topology_listeners.append(cluster_topology.invalidate)
+
+
+# 可能包含多个节点的数据库scope
+MULTI_NODE_SCOPES = ("all_nodes", "all_followers", "all_fault_injected_nodes")
+
 
 class ScopeCalculator:
 
     @staticmethod
-    def query_nodes() -> Union[list[str], list[str]]:
-        '''返回leader的host（但用列表装着）以及所有节点的host'''
-        try:
-            host = list(alias_host_dict.values())[0]  # Any database
-            api_port = list(alias_database_dict.values())[0].config.api_port
-            status_query_url = f"http://{host}:{api_port}/status?pretty"
-            
-            response = requests.get(status_query_url)
-            if response.status_code == 200:
-                logging.debug("Query executed successfully.")
-                node_data = response.json()
-                data = response.json()
-                leader_info = data["store"]["leader"]
-                node_info = data["store"]["nodes"]
-                leader_host: list[str] = [leader_info["addr"].split(":")[0]]  # 去掉端口
-                node_host_list: list[str] = []
-                for node in node_info:
-                    node_host_list.append(node["addr"].split(":")[0])
-                return leader_host, node_host_list
-            else:
-                raise Exception(str(response.text))
-        except Exception as e:
-            logging.error(f"Query node info failed: {e}")
-            raise Exception(f"Query node info failed: {e}")
-    
+    async def query_nodes() -> tuple[tuple[str, ...], tuple[str, ...]]:
+        '''返回leader的host（用元组装着）以及所有节点的host'''
+        leader_hosts, _, node_hosts = await cluster_topology.get_view()
+        return leader_hosts, node_hosts
+
     @staticmethod
-    def get_injectors_from_scope(scope: str) -> list[FaultInjector]:
-        leader_host, node_host_list = ScopeCalculator.query_nodes()
+    async def get_injectors_from_scope(scope: str) -> list[FaultInjector]:
+        leader_hosts, follower_hosts, node_hosts = await cluster_topology.get_view()
         host_list = []
         try:
             if scope == "all_nodes":
-                host_list = node_host_list
+                host_list = node_hosts
             elif scope == "half_nodes":
-                host_list = random.sample(node_host_list, len(node_host_list) // 2 + 1)
+                host_list = random.sample(node_hosts, len(node_hosts) // 2 + 1)
             elif scope == "any_node":
-                host_list = random.sample(node_host_list, 1)
+                host_list = [random.choice(node_hosts)]
             elif scope == "leader":
-                host_list = leader_host
+                host_list = leader_hosts
             elif scope == "all_followers":
-                host_list = list(set(node_host_list) - set(leader_host))
+                host_list = follower_hosts
             elif scope == "any_follower":
-                follower_list = list(set(node_host_list) - set(leader_host))
-                host_list = random.sample(follower_list, 1)
-        except ValueError as e:
+                host_list = [random.choice(follower_hosts)]
+        except (ValueError, IndexError) as e:
             logging.warning(f"The candidate list may be empty, please examine the scope you offer.")
-             
+
         if len(host_list) == 0:
             logging.warning(f"The scope {scope} is empty, please examine the scope you offer.")
         injector_list: list[FaultInjector] = []
         for host in host_list:
             injector_list.append(alias_injector_dict[host_alias_dict[host]])
         return injector_list
-    
+
     @staticmethod
-    def get_databases_from_scope(scope: str) -> list[Database]:
-        leader_host, node_host_list = ScopeCalculator.query_nodes()
+    async def get_databases_from_scope(scope: str) -> list[Database]:
+        leader_hosts, follower_hosts, node_hosts = await cluster_topology.get_view()
         host_list = []
         try:
-            if scope == "any_node":
-                host_list = random.sample(node_host_list, 1)
+            if scope == "all_nodes":
+                host_list = node_hosts
+            elif scope == "any_node":
+                host_list = [random.choice(node_hosts)]
             elif scope == "leader":
-                host_list = leader_host
+                host_list = leader_hosts
+            elif scope == "all_followers":
+                host_list = follower_hosts
             elif scope == "any_follower":
-                follower_list = list(set(node_host_list) - set(leader_host))
-                host_list = random.sample(follower_list, 1)
+                host_list = [random.choice(follower_hosts)]
+            elif scope == "all_fault_injected_nodes":
+                host_list = [host for host in node_hosts if host in injected_host_list]
             elif scope == "any_fault_injected_node":
-                host_list = random.sample(injected_host_list, 1)
+                host_list = [random.choice(sorted(injected_host_list))]
             elif scope == "fault_injected_leader":
-                host_list = list(set(leader_host) & set(injected_host_list))
+                host_list = [host for host in leader_hosts if host in injected_host_list]
             elif scope == "any_fault_injected_follower":
-                follower_list = list(set(node_host_list) - set(leader_host))
-                injected_follower_list = list(set(follower_list) & set(injected_host_list))
-                host_list = random.sample(injected_follower_list, 1)
-        except ValueError as e:
+                injected_follower_list = [host for host in follower_hosts if host in injected_host_list]
+                host_list = [random.choice(injected_follower_list)]
+        except (ValueError, IndexError) as e:
             logging.warning(f"The candidate list may be empty, please examine the scope you offer.")
-             
+
         if len(host_list) == 0:
             logging.warning(f"The scope {scope} is empty, please examine the scope you offer.")
         database_list: list[Database] = []
         for host in host_list:
             database_list.append(alias_database_dict[host_alias_dict[host]])
-        return database_list
\ No newline at end of file
+        return database_list
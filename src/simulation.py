@@ -0,0 +1,413 @@
+import json
+import time
+import random
+import shlex
+import asyncio
+import logging
+import sqlite3
+import selectors
+import threading
+from pathlib import Path
+from typing import Any, Optional, Union
+from urllib.parse import urlsplit, parse_qs
+
+from .config import DatabaseConfig, ChaosConfig, alias_host_dict, host_alias_dict
+from .http_client import HttpResponse, response_outcome
+from .db import Database, alias_database_dict
+from .fault_injector import FaultInjector, alias_injector_dict
+from .scope_calculator import cluster_topology
+from .router import leader_router
+from .fault_registry import fault_registry
+from .workload import reset_insert_counter
+from .history import history
+from .metrics import metrics
+from .scheduler import TimelineScheduler
+from .parser import PlanParser
+from .telemetry import telemetry_sampler
+
+RAFT_PORT = 4002
+
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    """事件循环空闲时不真正阻塞，而是把虚拟时钟直接拨到下一个定时器"""
+
+    def __init__(self):
+        super().__init__()
+        self.loop: Optional["VirtualClockEventLoop"] = None
+
+    def select(self, timeout: Optional[float] = None):
+        loop = self.loop
+        # 还有线程池/进程池里的任务没完成时（例如线性一致性检查），只能真正等待，虚拟时间不流逝
+        if loop is None or timeout is None or timeout <= 0 or loop.executor_jobs:
+            return super().select(timeout)
+        events = super().select(0)
+        if not events:
+            loop.advance(timeout)
+        return events
+
+
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    """time()返回虚拟时间的事件循环，asyncio.sleep / wait_for / call_later都按虚拟时间计算"""
+
+    def __init__(self):
+        selector = VirtualClockSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self.virtual_time = 0.0
+        self.executor_jobs = 0
+
+    def time(self) -> float:
+        return self.virtual_time
+
+    def advance(self, seconds: float):
+        # 直接拨到最近的定时器，避免浮点舍入让时钟停在定时器前一点点的地方
+        target = self.virtual_time + seconds
+        if self._scheduled:
+            target = max(target, self._scheduled[0].when())
+        self.virtual_time = target
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.executor_jobs += 1
+
+        def done(_):
+            self.executor_jobs -= 1
+
+        future.add_done_callback(done)
+        return future
+
+
+class SimulatedCluster:
+    """进程内模拟的rqlite集群：所有副本共用一个sqlite3数据库，leader和网络故障都是模拟的
+
+    节点上的故障由FakeFaultInjector创建：loss按比例让请求超时，delay给请求加上延迟，
+    100%丢包会让节点被隔离，leader被隔离后经过election_timeout在剩余节点中重新选主。
+    """
+    hosts: list[str]
+    leader: Optional[str]
+
+    def __init__(self, hosts: list[str], latency: float = 0.001, election_timeout: float = 1.0, seed: int = 0):
+        self.hosts = list(hosts)
+        self.leader = self.hosts[0] if self.hosts else None
+        self.latency = latency
+        self.election_timeout = election_timeout
+        self.random = random.Random(seed)
+        self.connection = sqlite3.connect(":memory:", isolation_level=None)
+        self.sequence_number = 0
+        self.experiments: dict[str, tuple[str, str, dict]] = {}
+        self.expire_handles: dict[str, asyncio.TimerHandle] = {}
+        self.uid_counter = 0
+        # 模拟的Raft状态：每次选主term加一，每次写入commit_index加一，被隔离的节点的applied_index停止前进
+        self.term = 1
+        self.commit_index = 0
+        self.applied_index = {host: 0 for host in self.hosts}
+
+    def faults(self, host: str) -> list[tuple[str, dict]]:
+        return [(action, flags) for fault_host, action, flags in self.experiments.values() if fault_host == host]
+
+    def is_isolated(self, host: str) -> bool:
+        return any(action == "loss" and int(flags.get("percent", 100)) >= 100 for action, flags in self.faults(host))
+
+    def has_quorum(self) -> bool:
+        healthy = sum(1 for host in self.hosts if not self.is_isolated(host))
+        return healthy > len(self.hosts) // 2
+
+    def elect(self):
+        if self.leader is not None and not self.is_isolated(self.leader):
+            return
+        candidates = [host for host in self.hosts if not self.is_isolated(host)]
+        if len(candidates) > len(self.hosts) // 2:
+            old_leader, self.leader = self.leader, self.random.choice(candidates)
+            self.term += 1
+            logging.info(f"[SIMULATION] Leader changed from {old_leader} to {self.leader}.")
+
+    def create_experiment(self, host: str, action: str, flags: dict) -> str:
+        self.uid_counter += 1
+        uid = f"sim{self.uid_counter:08d}"
+        self.experiments[uid] = (host, action, flags)
+        loop = asyncio.get_running_loop()
+        if "timeout" in flags:
+            self.expire_handles[uid] = loop.call_later(float(flags["timeout"]), self.destroy_experiment, uid)
+        if host == self.leader and self.is_isolated(host):
+            loop.call_later(self.election_timeout, self.elect)
+        return uid
+
+    def destroy_experiment(self, uid: str) -> bool:
+        if uid not in self.experiments:
+            return False
+        del self.experiments[uid]
+        if handle := self.expire_handles.pop(uid, None):
+            handle.cancel()
+        return True
+
+    async def pass_network(self, host: str, timeout: float):
+        """模拟一次经过host网卡的请求：按故障加延迟或者丢包（丢包表现为一直等到超时）"""
+        delay = self.latency
+        for action, flags in self.faults(host):
+            if action == "delay":
+                delay += int(flags.get("time", 0)) / 1000
+            elif action in ("loss", "corrupt") and self.random.random() * 100 < int(flags.get("percent", 100)):
+                await asyncio.sleep(timeout)
+                raise asyncio.TimeoutError()
+        await asyncio.sleep(delay)
+
+    def commit(self):
+        self.commit_index += 1
+        for host in self.hosts:
+            if not self.is_isolated(host):
+                self.applied_index[host] = self.commit_index
+
+    def status(self, host: str) -> dict:
+        leader = self.leader if not self.is_isolated(host) else None
+        if leader is not None:
+            # 恢复连通的节点追上leader
+            self.applied_index[host] = self.commit_index
+        state = "Leader" if host == leader else "Follower"
+        return {"store": {
+            "leader": {"addr": f"{leader}:{RAFT_PORT}" if leader else "", "node_id": host_alias_dict.get(leader, "")},
+            "nodes": [{"addr": f"{node}:{RAFT_PORT}", "id": host_alias_dict.get(node, node)} for node in self.hosts],
+            "raft": {"state": state, "term": str(self.term), "commit_index": str(self.commit_index),
+                     "applied_index": str(self.applied_index[host]), "last_log_index": str(self.commit_index),
+                     "fsm_pending": "0", "last_contact": "0" if state == "Leader" else f"{self.latency * 1000:g}ms"},
+        }}
+
+    def run_statement(self, statement: Union[str, list]) -> dict:
+        sql, parameters = (statement, []) if isinstance(statement, str) else (statement[0], statement[1:])
+        try:
+            cursor = self.connection.execute(sql, parameters)
+        except sqlite3.Error as e:
+            return {"error": str(e)}
+        if cursor.description is None:
+            return {"last_insert_id": cursor.lastrowid, "rows_affected": cursor.rowcount}
+        return {"columns": [column[0] for column in cursor.description], "values": [list(row) for row in cursor.fetchall()]}
+
+    def execute(self, statements: list, transaction: bool) -> list[dict]:
+        results: list[dict] = []
+        if transaction:
+            self.connection.execute("BEGIN")
+        for statement in statements:
+            result = self.run_statement(statement)
+            results.append(result)
+            if "error" in result and transaction:
+                # 事务里遇到出错的语句就停止执行后面的语句并整体回滚
+                break
+        if transaction:
+            self.connection.execute("ROLLBACK" if results and "error" in results[-1] else "COMMIT")
+        return results
+
+    def handle(self, host: str, method: str, path: str, payload: Any) -> HttpResponse:
+        url = urlsplit(path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        if url.path == "/status" and method == "GET":
+            return self.respond(200, self.status(host))
+        if url.path == "/debug/vars" and method == "GET":
+            return self.respond(200, {"cmdline": ["rqlited"], "memstats": {"HeapAlloc": 0, "NumGC": 0, "PauseTotalNs": 0}})
+        if (url.path, method) in (("/db/backup", "GET"), ("/db/load", "POST")):
+            # 备份和恢复整个数据库都只能在leader上做
+            if self.leader is None or self.is_isolated(host) or not self.has_quorum():
+                return self.respond(503, {"error": "leader not found"})
+            if host != self.leader:
+                return HttpResponse(301, "", {"Location": f"http://{self.leader}:4001{path}"})
+            if url.path == "/db/backup":
+                return HttpResponse(200, "", {"Content-Type": "application/octet-stream"}, self.connection.serialize())
+            self.connection.deserialize(payload)
+            self.commit()
+            return self.respond(200, {"results": []})
+        if url.path not in ("/db/execute", "/db/query", "/db/request") or method != "POST":
+            return self.respond(404, {"error": f"unknown endpoint {url.path}"})
+        # level=none的读直接读本地数据，其余请求都要经过leader
+        if url.path != "/db/query" or params.get("level", ["weak"])[0] != "none":
+            if self.leader is None or self.is_isolated(host) or not self.has_quorum():
+                return self.respond(503, {"error": "leader not found"})
+            # 和rqlite一样，默认由follower把请求转发给leader，带上redirect参数时才返回301
+            if host != self.leader and "redirect" in params:
+                return HttpResponse(301, "", {"Location": f"http://{self.leader}:4001{path}"})
+        if url.path == "/db/request":
+            # 读写混合的请求，和/db/execute一样可以放在一个事务里
+            self.commit()
+            return self.respond(200, {"results": self.execute(payload, "transaction" in params)})
+        if url.path == "/db/execute":
+            self.commit()
+            if "queue" in params:
+                self.execute(payload, "transaction" in params)
+                self.sequence_number += 1
+                return self.respond(200, {"results": [], "sequence_number": self.sequence_number})
+            return self.respond(200, {"results": self.execute(payload, "transaction" in params)})
+        return self.respond(200, {"results": [self.run_statement(statement) for statement in payload]})
+
+    @staticmethod
+    def respond(status: int, body: dict) -> HttpResponse:
+        return HttpResponse(status, json.dumps(body), {"Content-Type": "application/json"})
+
+    def close(self):
+        for handle in self.expire_handles.values():
+            handle.cancel()
+        self.expire_handles = {}
+        self.connection.close()
+
+
+class FakeHttpClient:
+    """和HttpClient接口相同，请求直接交给SimulatedCluster处理"""
+
+    def __init__(self, cluster: SimulatedCluster, host: str, timeout: float = 3, name: Optional[str] = None):
+        self.cluster = cluster
+        self.host = host
+        self.name = name or host
+        self.timeout = timeout
+
+    async def request(self, method: str, path: str, payload: Any = None, timeout: Optional[float] = None,
+                      data: Optional[bytes] = None, content_type: Optional[str] = None,
+                      binary: bool = False) -> HttpResponse:
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        outcome = "error"
+        try:
+            async with asyncio.timeout(timeout):
+                await self.cluster.pass_network(self.host, timeout)
+                response = self.cluster.handle(self.host, method, path, payload if data is None else data)
+                outcome = response_outcome(response.status)
+                return response
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            metrics.record_operation("http_request", loop.time() - begin, outcome, node=self.name,
+                                     op=path.split("?")[0])
+
+    async def get(self, path: str, timeout: Optional[float] = None) -> HttpResponse:
+        return await self.request("GET", path, timeout=timeout)
+
+    async def post(self, path: str, payload: Any, timeout: Optional[float] = None) -> HttpResponse:
+        return await self.request("POST", path, payload, timeout)
+
+    async def close(self):
+        pass
+
+
+class FakeDatabase(Database):
+    """HTTP层换成模拟集群的Database，重试、错误处理等逻辑和真实节点完全一样"""
+
+    def __init__(self, config: DatabaseConfig, cluster: SimulatedCluster):
+        super().__init__(config)
+        self.http_client = FakeHttpClient(cluster, config.host, config.timeout, config.name)
+
+    def setupDB(self):
+        logging.debug(f"[SIMULATION] Database on {self.config.host} is activated.")
+
+    def teardownDB(self):
+        logging.debug(f"[SIMULATION] Database on {self.config.host} has stopped.")
+
+
+class FakeFaultInjector(FaultInjector):
+    """模拟的blade：解析blade命令并在SimulatedCluster上创建/销毁故障，返回和chaosblade相同格式的JSON"""
+
+    def __init__(self, config: ChaosConfig, cluster: SimulatedCluster):
+        super().__init__(config)
+        self.cluster = cluster
+
+    def connect(self):
+        pass
+
+    async def execute_command_async(self, command, barrier: Optional[threading.Barrier] = None) -> tuple[str, float]:
+        # 单线程里不能等threading.Barrier，模拟模式下各节点的命令本来就是同时发出的
+        await asyncio.sleep(self.cluster.latency)
+        sent_at = asyncio.get_running_loop().time()
+        # 多条命令用;连接时依次执行，每条命令输出一个JSON对象
+        outputs = [json.dumps(self.run_blade(shlex.split(part))) for part in command.split(";") if part.strip()]
+        return "\n".join(outputs), sent_at
+
+    def run_blade(self, args: list[str]) -> dict:
+        if args[:2] == ["blade", "create"] and len(args) >= 4:
+            flags: dict[str, str] = {}
+            for i, arg in enumerate(args):
+                if arg.startswith("--") and i + 1 < len(args):
+                    flags[arg[2:]] = args[i + 1]
+            uid = self.cluster.create_experiment(self.config.host, args[3], flags)
+            return {"code": 200, "success": True, "result": uid}
+        if args[:2] == ["blade", "destroy"] and len(args) >= 3:
+            if self.cluster.destroy_experiment(args[2]):
+                return {"code": 200, "success": True, "result": args[2]}
+            return {"code": 406, "success": False, "error": f"the experiment {args[2]} not found"}
+        if args[:2] == ["blade", "status"]:
+            experiments = [{"Uid": uid, "Command": "network", "SubCommand": action, "Status": "Success"}
+                           for uid, (host, action, _) in self.cluster.experiments.items() if host == self.config.host]
+            return {"code": 200, "success": True, "result": experiments}
+        return {"code": 400, "success": False, "error": f"unsupported command: {' '.join(args)}"}
+
+
+def install_simulated_cluster(cluster: SimulatedCluster):
+    """用模拟的Database和FaultInjector填充全局的节点映射"""
+    for i, host in enumerate(cluster.hosts, start=1):
+        node_name = f"node{i}"
+        alias_host_dict[node_name] = host
+        host_alias_dict[host] = node_name
+        alias_database_dict[node_name] = FakeDatabase(DatabaseConfig(node_name, host, 4001), cluster)
+        alias_injector_dict[node_name] = FakeFaultInjector(ChaosConfig(node_name, host), cluster)
+
+
+def uninstall_simulated_cluster():
+    alias_host_dict.clear()
+    host_alias_dict.clear()
+    alias_database_dict.clear()
+    alias_injector_dict.clear()
+    fault_registry.reset()
+
+
+async def simulate(plan_data: dict, cluster_size: int = 3, history_path: Optional[Union[str, Path]] = None,
+                   seed: int = 0, telemetry_interval: float = 0) -> dict:
+    """在虚拟时钟和模拟集群上执行一个计划，返回执行摘要；telemetry_interval>0时同时按这个间隔采样集群状态"""
+    loop = asyncio.get_running_loop()
+    begin = time.perf_counter()
+    plan_parser = PlanParser(plan_data)
+    cluster = SimulatedCluster([f"10.0.0.{i}" for i in range(1, cluster_size + 1)], seed=seed)
+    install_simulated_cluster(cluster)
+    reset_insert_counter()
+    cluster_topology.reset()
+    leader_router.reset()
+    fault_registry.reset()
+    clock = history.clock
+    history.clock = lambda: int(loop.time() * 1e9)
+    metrics_clock = metrics.clock
+    metrics.clock = loop.time
+    metrics.reset()
+    if history_path is not None:
+        history.open(history_path)
+    try:
+        await list(alias_database_dict.values())[0].init_table_tc()
+        await list(alias_database_dict.values())[0].init_table_registers()
+        await list(alias_database_dict.values())[0].init_table_lists()
+        await cluster_topology.wait_until_ready(30)
+        cluster_topology.start()
+        telemetry_sampler.interval = telemetry_interval
+        telemetry_sampler.start()
+        scheduler = TimelineScheduler(plan_parser.event_list, plan_parser.total_time)
+        start = loop.time()
+        bug_found = await scheduler.run()
+        summary = {
+            "bug_found": bug_found,
+            "virtual_time": loop.time() - start,
+            "real_time": time.perf_counter() - begin,
+            "events": [timing.to_dict() for timing in scheduler.timings],
+            "phases": metrics.phase_summary(),
+        }
+        if telemetry_interval > 0:
+            summary["telemetry"] = telemetry_sampler.summary()
+    finally:
+        await telemetry_sampler.stop()
+        await fault_registry.recover_all()
+        await cluster_topology.stop()
+        history.close()
+        history.clock = clock
+        metrics.clock = metrics_clock
+        uninstall_simulated_cluster()
+        cluster.close()
+    logging.info(f"[SIMULATION] Plan finished: {summary['virtual_time']:.2f}s of virtual time "
+                 f"in {summary['real_time'] * 1000:.1f}ms, bug found: {bug_found}.")
+    return summary
+
+
+def run_simulation(plan_data: dict, cluster_size: int = 3, history_path: Optional[Union[str, Path]] = None,
+                   seed: int = 0, telemetry_interval: float = 0) -> dict:
+    with asyncio.Runner(loop_factory=VirtualClockEventLoop) as runner:
+        return runner.run(simulate(plan_data, cluster_size, history_path, seed, telemetry_interval))
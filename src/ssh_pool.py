@@ -0,0 +1,133 @@
+import time
+import logging
+import threading
+import paramiko
+from typing import Optional
+
+
+class CommandResult:
+    """一次远程命令的结果，sent_at是命令真正发出的时刻（time.monotonic）"""
+    __slots__ = ("stdout", "stderr", "exit_status", "sent_at")
+
+    def __init__(self, stdout: str, stderr: str, exit_status: int, sent_at: float):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_status = exit_status
+        self.sent_at = sent_at
+
+
+class SSHSession:
+    """一个已认证的SSH transport，命令都在它上面开新的channel执行，transport断了会自动重连"""
+    host: str
+    port: int
+    username: str
+    max_channels: int
+    keepalive: int
+    timeout: float
+
+    def __init__(self, host: str, port: int, username: str, password: str, max_channels: int = 8,
+                 keepalive: int = 15, timeout: float = 3):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_channels = max_channels
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.client: Optional[paramiko.SSHClient] = None
+        self.lock = threading.Lock()
+        self.channel_slots = threading.BoundedSemaphore(max_channels)
+
+    def is_alive(self) -> bool:
+        return self.client is not None and self.client.get_transport() is not None \
+            and self.client.get_transport().is_active()
+
+    def get_transport(self) -> paramiko.Transport:
+        with self.lock:
+            if not self.is_alive():
+                if self.client is not None:
+                    logging.warning(f"SSH transport to {self.username}@{self.host} is dead, reconnecting...")
+                    self.client.close()
+                self.client = self.connect()
+            return self.client.get_transport()
+
+    def connect(self) -> paramiko.SSHClient:
+        logging.debug(f"Connecting to {self.username}@{self.host}...")
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # 自动接受主机密钥
+        client.connect(self.host, port=self.port, username=self.username, password=self.password,
+                       timeout=self.timeout, banner_timeout=self.timeout, auth_timeout=self.timeout)
+        client.get_transport().set_keepalive(self.keepalive)
+        logging.info(f"SSH connection to {self.username}@{self.host} has established.")
+        return client
+
+    def run(self, command: str, barrier: Optional[threading.Barrier] = None,
+            timeout: Optional[float] = None) -> CommandResult:
+        """在一个新channel上执行命令；同一host上同时打开的channel数不超过max_channels
+
+        传入barrier时，会在channel准备好之后、发出命令之前等待barrier。
+        """
+        with self.channel_slots:
+            try:
+                channel = self.get_transport().open_session(timeout=self.timeout)
+            except Exception:
+                if barrier is not None:
+                    # 还没到达barrier就失败了，别让其他节点一直等到超时
+                    barrier.abort()
+                raise
+            try:
+                if barrier is not None:
+                    try:
+                        barrier.wait(timeout=self.timeout)
+                    except threading.BrokenBarrierError:
+                        logging.warning(f"Barrier broken before executing {command} on {self.host}, sending without sync.")
+                channel.settimeout(timeout)
+                sent_at = time.monotonic()
+                channel.exec_command(command)
+                stdout = channel.makefile("rb").read().decode()
+                stderr = channel.makefile_stderr("rb").read().decode()
+                exit_status = channel.recv_exit_status()
+            finally:
+                channel.close()
+        return CommandResult(stdout, stderr, exit_status, sent_at)
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+                logging.info(f"SSH connection to {self.username}@{self.host} has already closed.")
+
+
+class SSHPool:
+    """按(host, port, username)共享SSH会话，FaultInjector和Database都从这里拿连接"""
+    max_channels: int
+    keepalive: int
+
+    def __init__(self, max_channels: int = 8, keepalive: int = 15):
+        self.max_channels = max_channels
+        self.keepalive = keepalive
+        self.sessions: dict[tuple[str, int, str], SSHSession] = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, host: str, port: int, username: str, password: str, timeout: float = 3) -> SSHSession:
+        key = (host, port, username)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = SSHSession(host, port, username, password, self.max_channels, self.keepalive, timeout)
+                self.sessions[key] = session
+            return session
+
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            try:
+                session.close()
+            except Exception as e:
+                logging.error(f"Error occured when closing SSH connection to {session.host}: {e}")
+
+
+ssh_pool = SSHPool()
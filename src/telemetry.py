@@ -0,0 +1,260 @@
+import re
+import json
+import math
+import asyncio
+import logging
+from array import array
+from pathlib import Path
+from typing import Any, Optional, Union
+
+from .db import Database, alias_database_dict
+from .history import history, load_history, NEMESIS_PROCESS
+
+NAN = float("nan")
+
+# /status里store.raft下的数值字段（rqlite以字符串形式返回）
+RAFT_FIELDS = ("term", "commit_index", "applied_index", "last_log_index", "fsm_pending")
+# state: Follower=0, Candidate=1, Leader=2；leader: 节点认为的leader在节点列表里的序号
+DERIVED_FIELDS = ("last_contact", "state", "leader", "status_latency")
+RAFT_STATES = {"Follower": 0, "Candidate": 1, "Leader": 2}
+DEFAULT_EXPVAR_FIELDS = ("memstats.HeapAlloc", "memstats.NumGC", "memstats.PauseTotalNs")
+
+# Go的time.Duration字符串，例如"1m2.5s"、"23.6µs"
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ns|us|µs|μs|ms|s|m|h)")
+DURATION_UNITS = {"ns": 1e-9, "us": 1e-6, "µs": 1e-6, "μs": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(text: Any) -> float:
+    """把Go的Duration字符串转换成秒，"never"等无法解析的值返回NaN"""
+    if isinstance(text, (int, float)):
+        return float(text)
+    parts = DURATION_PART.findall(str(text))
+    if not parts:
+        return NAN
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def to_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def lookup(data: Any, path: str) -> Any:
+    """按点分隔的路径取嵌套字典里的值，例如"memstats.HeapAlloc" """
+    for part in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+class RingBuffer:
+    """定长的环形缓冲区，每个字段一个array('d')，写满后覆盖最旧的样本，内存占用和运行时长无关"""
+    __slots__ = ("capacity", "times", "columns", "head", "size")
+
+    def __init__(self, capacity: int, fields: tuple[str, ...]):
+        self.capacity = max(int(capacity), 1)
+        self.times = array("d", bytes(8 * self.capacity))
+        self.columns = {field: array("d", bytes(8 * self.capacity)) for field in fields}
+        self.head = 0
+        self.size = 0
+
+    def append(self, time: float, sample: dict[str, float]):
+        slot = self.head
+        self.times[slot] = time
+        for field, column in self.columns.items():
+            column[slot] = sample.get(field, NAN)
+        self.head = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def ordered(self, column: array) -> list[float]:
+        """按时间从旧到新返回一列"""
+        start = (self.head - self.size) % self.capacity
+        if start + self.size <= self.capacity:
+            return column[start:start + self.size].tolist()
+        return column[start:].tolist() + column[:self.head].tolist()
+
+    def series(self, field: str) -> list[float]:
+        return self.ordered(self.times if field == "time" else self.columns[field])
+
+    def to_dict(self) -> dict[str, list]:
+        result: dict[str, list] = {"time": self.series("time")}
+        for field in self.columns:
+            result[field] = [None if math.isnan(value) else value for value in self.series(field)]
+        return result
+
+
+class TelemetrySampler:
+    """后台定时并发轮询每个节点的/status（以及较低频率的/debug/vars），把Raft的term、commit/applied index、
+    leader和last_contact等字段记进每个节点的环形缓冲区
+
+    每一轮所有节点同时取样、记在同一个时刻（history时间线上的秒数），请求的超时不超过取样间隔，
+    所以每个节点最多只有一个在途请求；被分区的节点这一轮记为NaN。运行结束后和故障时间线一起导出。
+    """
+    interval: float
+    capacity: int
+    expvar_interval: float
+    expvar_fields: tuple[str, ...]
+
+    def __init__(self, interval: float = 0.2, capacity: int = 9000, expvar_interval: float = 1.0,
+                 expvar_fields: tuple[str, ...] = DEFAULT_EXPVAR_FIELDS):
+        self.interval = interval
+        self.capacity = capacity
+        self.expvar_interval = expvar_interval
+        self.expvar_fields = tuple(expvar_fields)
+        self.buffers: dict[str, RingBuffer] = {}
+        self.node_index: dict[str, int] = {}
+        self.missed_ticks = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def fields(self) -> tuple[str, ...]:
+        return RAFT_FIELDS + DERIVED_FIELDS + self.expvar_fields
+
+    def parse_status(self, status: dict) -> dict[str, float]:
+        store = status.get("store") or {}
+        raft = store.get("raft") or {}
+        sample = {field: to_float(raft.get(field)) for field in RAFT_FIELDS}
+        sample["state"] = RAFT_STATES.get(raft.get("state"), NAN)
+        # leader自己的last_contact是0
+        sample["last_contact"] = 0.0 if raft.get("state") == "Leader" else parse_duration(raft.get("last_contact"))
+        leader_host = str(lookup(store, "leader.addr") or "").split(":")[0]
+        sample["leader"] = float(self.node_index.get(leader_host, NAN))
+        return sample
+
+    async def sample_node(self, database: Database, with_expvar: bool) -> dict[str, float]:
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        status = await database.status(self.interval)
+        sample = self.parse_status(status)
+        sample["status_latency"] = loop.time() - begin
+        if with_expvar and self.expvar_fields:
+            try:
+                debug_vars = await database.debug_vars(self.interval)
+                for field in self.expvar_fields:
+                    sample[field] = to_float(lookup(debug_vars, field))
+            except Exception as e:
+                logging.debug(f"Query /debug/vars of {database.name} failed: {e}")
+        return sample
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        databases = list(alias_database_dict.values())
+        expvar_every = max(round(self.expvar_interval / self.interval), 1) if self.expvar_interval > 0 else 0
+        next_tick = loop.time()
+        tick = 0
+        while True:
+            with_expvar = expvar_every > 0 and tick % expvar_every == 0
+            now = (history.clock() - history.origin) / 1e9
+            results = await asyncio.gather(*(self.sample_node(database, with_expvar) for database in databases),
+                                           return_exceptions=True)
+            for database, result in zip(databases, results):
+                if isinstance(result, BaseException):
+                    logging.debug(f"Sample telemetry of {database.name} failed: {result}")
+                    result = {}
+                self.buffers[database.name].append(now, result)
+            tick += 1
+            next_tick += self.interval
+            delay = next_tick - loop.time()
+            if delay < 0:
+                # 落后了就跳过错过的轮次，不补发请求
+                missed = math.ceil(-delay / self.interval)
+                self.missed_ticks += missed
+                next_tick += missed * self.interval
+                delay = next_tick - loop.time()
+            await asyncio.sleep(delay)
+
+    def start(self):
+        """为每个节点建立缓冲区并开始取样；interval不大于0时不取样"""
+        if self.interval <= 0 or (self.task is not None and not self.task.done()):
+            return
+        self.buffers = {database.name: RingBuffer(self.capacity, self.fields)
+                        for database in alias_database_dict.values()}
+        self.node_index = {database.config.host: index for index, database in enumerate(alias_database_dict.values())}
+        self.missed_ticks = 0
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def summary(self, include_series: bool = False) -> dict:
+        """从缓冲区里算出复制延迟、选举次数和leader切换次数，include_series为True时附带每个节点的复制延迟序列
+
+        每一轮所有节点各记一个样本，同一下标就是同一时刻。复制延迟是这一时刻所有节点里最大的commit_index
+        减去该节点的applied_index；选举次数是观察到的最大term增加的次数。
+        """
+        nodes = list(self.buffers)
+        if not nodes:
+            return {}
+        commits = [self.buffers[node].series("commit_index") for node in nodes]
+        applied = [self.buffers[node].series("applied_index") for node in nodes]
+        terms = [self.buffers[node].series("term") for node in nodes]
+        states = [self.buffers[node].series("state") for node in nodes]
+        samples = self.buffers[nodes[0]].size
+        lag: dict[str, list[Optional[float]]] = {node: [] for node in nodes}
+        elections = 0
+        leader_changes = 0
+        last_term = NAN
+        last_leader: Optional[int] = None
+        for i in range(samples):
+            known_commits = [column[i] for column in commits if not math.isnan(column[i])]
+            max_commit = max(known_commits) if known_commits else NAN
+            for j, node in enumerate(nodes):
+                value = max_commit - applied[j][i]
+                lag[node].append(None if math.isnan(value) else value)
+            known_terms = [column[i] for column in terms if not math.isnan(column[i])]
+            if known_terms:
+                term = max(known_terms)
+                if not math.isnan(last_term) and term > last_term:
+                    elections += 1
+                last_term = term if math.isnan(last_term) else max(last_term, term)
+            # 以自认为是leader、term最大的节点为准
+            leaders = [(terms[j][i], j) for j in range(len(nodes)) if states[j][i] == RAFT_STATES["Leader"]]
+            if leaders:
+                leader = max(leaders)[1]
+                if last_leader is not None and leader != last_leader:
+                    leader_changes += 1
+                last_leader = leader
+        result = {
+            "samples": samples,
+            "missed_ticks": self.missed_ticks,
+            "elections": elections,
+            "leader_changes": leader_changes,
+            "max_replication_lag": {node: max((value for value in lag[node] if value is not None), default=None)
+                                    for node in nodes},
+            "max_last_contact": {node: max((value for value in self.buffers[node].series("last_contact")
+                                            if not math.isnan(value)), default=None) for node in nodes},
+        }
+        if include_series:
+            result["replication_lag"] = lag
+        return result
+
+    def export(self, path: Union[str, Path], history_path: Optional[Union[str, Path]] = None) -> dict:
+        """把各节点的时间序列、派生的统计和history里的故障时间线写进同一个JSON文件，返回不含时间序列的摘要"""
+        summary = self.summary(include_series=True)
+        lag = summary.pop("replication_lag", {})
+        faults = []
+        if history_path is not None and Path(history_path).exists():
+            faults = [{"time": op.time / 1e9, "f": op.f, "name": op.key, "hosts": op.value}
+                      for op in load_history(history_path) if op.process == NEMESIS_PROCESS]
+        nodes = {}
+        for node, buffer in self.buffers.items():
+            nodes[node] = buffer.to_dict()
+            nodes[node]["replication_lag"] = lag.get(node, [])
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"interval": self.interval, "nodes_order": list(self.buffers), "summary": summary,
+                       "faults": faults, "nodes": nodes}, file)
+        logging.info(f"Telemetry of {len(nodes)} nodes ({summary.get('samples', 0)} samples each) "
+                     f"is written to {path}.")
+        return summary
+
+
+telemetry_sampler = TelemetrySampler()
@@ -0,0 +1,281 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+import multiprocessing
+from pathlib import Path
+from typing import Optional, Union
+from concurrent.futures import ProcessPoolExecutor
+
+from .config import alias_host_dict, host_alias_dict, injected_host_list
+from .db import Database, alias_database_dict
+from .fault_registry import fault_registry
+from .history import history
+from .metrics import metrics, PHASES
+from .load_generator import LoadStats
+from .logging_config import configure_logging, log_context, event_id_var
+from .parser import PlanParser, YamlParser
+from .retry import RetryPolicy
+from .router import leader_router
+from .scope_calculator import cluster_topology
+from .workload import Workload, set_insert_counter, tc_writes
+from . import workload as workload_module
+
+# 工作进程检查阶段切换和取消请求的间隔（秒）
+POLL_INTERVAL = 0.05
+# 最多同时有几个分片执行的workload不用排队，为它们预先启动processes * CONCURRENT_WORKLOADS个进程
+CONCURRENT_WORKLOADS = 2
+# 预热时等所有工作进程启动的最长时间（秒）
+WARM_UP_TIMEOUT = 60
+
+
+class SharedCounter:
+    """多个进程共享的计数器，可以代替itertools.count：每个值只会被一个进程取到一次"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> int:
+        with self.value.get_lock():
+            current = self.value.value
+            self.value.value += 1
+        return current
+
+
+# 工作进程里由init_worker设置的共享状态
+worker_config_path: Optional[str] = None
+worker_process_ids: Optional[SharedCounter] = None
+worker_phase = None
+worker_cancelled = None
+worker_ready = None
+worker_injected = None
+worker_hosts: list[str] = []
+
+
+def node_hosts(yaml_parser: YamlParser) -> list[str]:
+    """按配置文件里的节点顺序排列的host，协调进程和工作进程用它给共享的故障标记编号"""
+    return [yaml_parser.get_database_config(node_name).host for node_name in yaml_parser.get_nodes_name_list()]
+
+
+def init_worker(cluster_config_path: str, run_id: Optional[str], process_ids, insert_counts, phase, cancelled, ready,
+                injected):
+    global worker_config_path, worker_process_ids, worker_phase, worker_cancelled, worker_ready, worker_injected
+    global worker_hosts
+    worker_config_path = cluster_config_path
+    worker_injected = injected
+    tc_writes.visible = False
+    worker_ready = ready
+    worker_process_ids = SharedCounter(process_ids)
+    worker_phase = phase
+    worker_cancelled = cancelled
+    set_insert_counter(SharedCounter(insert_counts))
+    yaml_parser = YamlParser(cluster_config_path)
+    worker_hosts = node_hosts(yaml_parser)
+    configure_logging(yaml_parser.log_level, None, run_id, yaml_parser.log_rate_limit, yaml_parser.log_burst)
+
+
+def sync_injected_hosts():
+    """按协调进程共享的故障标记更新本进程的injected_host_list，故障相关的scope才能看到运行中注入和恢复的故障"""
+    with worker_injected.get_lock():
+        flags = worker_injected[:]
+    injected = {host for host, flag in zip(worker_hosts, flags) if flag}
+    if injected != injected_host_list:
+        injected_host_list.clear()
+        injected_host_list.update(injected)
+
+
+def warm_up(count: int) -> int:
+    """等count个工作进程都启动了才返回，这样count个预热任务一定落在不同的进程上"""
+    with worker_ready.get_lock():
+        worker_ready.value += 1
+    deadline = time.monotonic() + WARM_UP_TIMEOUT
+    while worker_ready.value < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return os.getpid()
+
+
+def connect_databases(yaml_parser: YamlParser):
+    """在工作进程里建立到各节点的连接，工作进程只发请求，不需要SSH和故障注入"""
+    for node_name in yaml_parser.get_nodes_name_list():
+        database_config = yaml_parser.get_database_config(node_name)
+        alias_host_dict[node_name] = database_config.host
+        host_alias_dict[database_config.host] = node_name
+        alias_database_dict[node_name] = Database(database_config)
+
+
+async def run_shard_async(plan_info: dict, index: int, count: int, seq: int, start_at: float, origin: int,
+                          path: Optional[str], event_id: Optional[str]) -> tuple:
+    yaml_parser = YamlParser(worker_config_path)
+    # 每个分片都在新的事件循环里运行，连接池和拓扑缓存都要重新建立
+    alias_database_dict.clear()
+    connect_databases(yaml_parser)
+    sync_injected_hosts()
+    cluster_topology.reset()
+    cluster_topology.ttl = yaml_parser.topology_ttl
+    cluster_topology.refresh_interval = yaml_parser.topology_refresh_interval
+    leader_router.reset()
+    leader_router.retry_policy = RetryPolicy(yaml_parser.query_retry_count, yaml_parser.retry_base_delay,
+                                             yaml_parser.retry_max_delay, yaml_parser.retry_deadline)
+    metrics.reset()
+    metrics.switch_phase(PHASES[worker_phase.value])
+    if path is not None:
+        history.open(path, origin)
+    history.process_ids = worker_process_ids
+    workload = PlanParser.parse_workload(plan_info)
+    workload.assign_shard(index, count)
+    stats = LoadStats()
+    with log_context(event_id=f"{event_id}/shard{index}" if event_id else f"shard{index}"):
+        try:
+            cluster_topology.start()
+            delay = start_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -0.1:
+                logging.warning(f"Shard {index} of {workload.name} started {-delay * 1000:.1f}ms later than planned.")
+            task = asyncio.create_task(workload.start())
+            while not task.done():
+                metrics.switch_phase(PHASES[worker_phase.value])
+                sync_injected_hosts()
+                if worker_cancelled.value >= seq:
+                    task.cancel()
+                await asyncio.wait({task}, timeout=POLL_INTERVAL)
+            if task.cancelled():
+                logging.info(f"Shard {index} of {workload.name} is cancelled.")
+            else:
+                stats = task.result()
+        finally:
+            await cluster_topology.stop()
+            for database in alias_database_dict.values():
+                await database.close()
+            history.close()
+    return stats, metrics.histograms, metrics.counters
+
+
+def run_shard(*args) -> tuple:
+    """在工作进程里执行一个分片，返回(LoadStats, 直方图, 计数器)"""
+    return asyncio.run(run_shard_async(*args))
+
+
+class WorkerPool:
+    """把workload的客户端分片到多个工作进程执行，每个进程有自己的事件循环和连接池，不再争用同一个GIL
+
+    协调进程（运行计划的进程）把计划里的workload事件和开始时刻发给各分片，分片结束后
+    把各自的history按时间归并进同一条时间线，指标合并进协调进程的metrics。
+    history的进程号和SingleInsert的count由各进程共享的计数器分配，仍然全局唯一、连续；
+    指标的阶段和当前有故障的节点由协调进程同步给工作进程，工作进程每POLL_INTERVAL秒检查一次。
+
+    工作进程在计划开始前全部启动好，同时运行的分片workload超过CONCURRENT_WORKLOADS个时，多出来的分片要排队。
+    """
+    processes: int
+
+    def __init__(self):
+        self.processes = 1
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.runs = itertools.count(1)
+
+    async def start(self, cluster_config_path: Union[str, Path], processes: int, run_id: Optional[str] = None):
+        """processes不超过1时不启动工作进程，所有workload都在当前事件循环里执行"""
+        self.processes = max(int(processes), 1)
+        if self.processes <= 1:
+            return
+        # fork会把事件循环、日志线程和SSH连接也复制过去，用spawn启动干净的进程
+        context = multiprocessing.get_context("spawn")
+        self.process_ids = context.Value("q", next(history.process_ids))
+        self.insert_counts = context.Value("q", next(workload_module.insert_counter))
+        self.phase = context.Value("i", PHASES.index(metrics.phase))
+        self.cancelled = context.Value("q", 0)
+        ready = context.Value("i", 0)
+        self.hosts = node_hosts(YamlParser(cluster_config_path))
+        self.injected = context.Array("b", len(self.hosts))
+        self.faults_changed(injected_host_list)
+        history.process_ids = SharedCounter(self.process_ids)
+        set_insert_counter(SharedCounter(self.insert_counts))
+        metrics.phase_listeners.append(self.phase_changed)
+        # 写入可能在其他进程里执行，SingleRead不再能判断一轮读期间有没有并发写入
+        tc_writes.visible = False
+        fault_registry.listeners.append(self.faults_changed)
+        workers = self.processes * CONCURRENT_WORKLOADS
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                            initargs=(str(cluster_config_path), run_id, self.process_ids,
+                                                      self.insert_counts, self.phase, self.cancelled, ready,
+                                                      self.injected))
+        # 预先启动所有工作进程，避免workload开始时才去导入模块
+        begin = time.monotonic()
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(loop.run_in_executor(self.executor, warm_up, workers) for _ in range(workers)))
+        logging.info(f"Started {len(set(pids))} workload worker processes in {time.monotonic() - begin:.2f}s.")
+
+    def phase_changed(self, phase: str):
+        self.phase.value = PHASES.index(phase)
+
+    def faults_changed(self, hosts: set[str]):
+        with self.injected.get_lock():
+            for i, host in enumerate(self.hosts):
+                self.injected[i] = host in hosts
+
+    def shard_count(self, workload: Workload) -> int:
+        if self.executor is None or workload.plan_info is None:
+            return 1
+        count = min(workload.processes or self.processes, self.processes, workload.clients)
+        if workload.times > 0:
+            count = min(count, workload.times)
+        return max(count, 1)
+
+    async def run(self, workload: Workload) -> LoadStats:
+        """把workload分成shard_count个分片并发执行，返回合并后的统计"""
+        count = self.shard_count(workload)
+        seq = next(self.runs)
+        loop = asyncio.get_running_loop()
+        paths = [None if history.path is None else
+                 str(history.path.with_name(f"{history.path.stem}.run{seq}.shard{index}.jsonl"))
+                 for index in range(count)]
+        logging.info(f"Starting {workload} in {count} worker processes...")
+        start_at = time.monotonic()
+        futures = [loop.run_in_executor(self.executor, run_shard, workload.plan_info, index, count, seq, start_at,
+                                        history.origin, paths[index], event_id_var.get())
+                   for index in range(count)]
+        try:
+            results = await asyncio.shield(asyncio.gather(*futures, return_exceptions=True))
+        except asyncio.CancelledError:
+            # 通知工作进程停下来，等它们写完各自的history再合并
+            self.cancelled.value = max(self.cancelled.value, seq)
+            await self.merge(workload, await asyncio.gather(*futures, return_exceptions=True), paths)
+            raise
+        return await self.merge(workload, results, paths)
+
+    async def merge(self, workload: Workload, results: list, paths: list[Optional[str]]) -> LoadStats:
+        stats = LoadStats()
+        for index, result in enumerate(results):
+            if isinstance(result, BaseException):
+                logging.error(f"Shard {index} of {workload.name} failed: {result}")
+                continue
+            shard_stats, histograms, counters = result
+            stats.merge(shard_stats)
+            metrics.merge(histograms, counters)
+        begin = time.monotonic()
+        shard_paths = [path for path in paths if path is not None]
+        await history.merge(shard_paths)
+        for path in shard_paths:
+            Path(path).unlink(missing_ok=True)
+        logging.info(f"{workload.name} finished in {len(paths)} worker processes: {stats} "
+                     f"(history merged in {time.monotonic() - begin:.2f}s)")
+        return stats
+
+    def stop(self):
+        if self.executor is None:
+            return
+        self.executor.shutdown(cancel_futures=True)
+        self.executor = None
+        metrics.phase_listeners.remove(self.phase_changed)
+        fault_registry.listeners.remove(self.faults_changed)
+        tc_writes.visible = True
+        # 之后在当前进程里继续分配，不和已经用过的值重复
+        history.process_ids = itertools.count(self.process_ids.value)
+        set_insert_counter(itertools.count(self.insert_counts.value))
+
+
+worker_pool = WorkerPool()
@@ -1,14 +1,73 @@
 import json
+import random
 import logging
 import asyncio
-from typing import Type
+import itertools
+from typing import Any, Awaitable, Callable, Iterator, Optional, Type, Union
 from abc import ABC, abstractmethod
 
-from .db import Database
+from .db import Database, StatementError
+from .retry import DefiniteError
+from .router import LeaderRouter, leader_router
+from .batcher import WriteBatcher
+from .generator import create_key_distribution, register_ops, list_append_txns
 from .tools import time_string_to_seconds, seconds_to_time_string
 from .scope_calculator import ScopeCalculator
+from .load_generator import LoadGenerator, LoadStats
+from .history import history
+from .metrics import metrics
+
+# rqlite的读一致性级别
+READ_LEVELS = ("none", "weak", "strong", "linearizable")
+
+# 所有SingleInsert共享的计数器，保证count列在整个进程内唯一且连续（IntegrityCheck依赖这一点）
+insert_counter: Iterator[int] = itertools.count(1)
+
+
+def reset_insert_counter(start: int = 1):
+    """tc表被清空后重新开始计数（同一个进程里执行多个计划时使用）"""
+    set_insert_counter(itertools.count(start))
+
+
+def set_insert_counter(counter: Iterator[int]):
+    """换成其他计数器，例如分片执行时各进程共享的计数器"""
+    global insert_counter
+    insert_counter = counter
+
+
+def share(total: int, index: int, count: int) -> int:
+    """把total尽量均匀地分成count份，返回第index份的大小"""
+    return total // count + (1 if index < total % count else 0)
+
+
+class WriteTracker:
+    """本进程里对tc表的写入：发出过多少次、还有几个在途，SingleRead用它判断一轮读期间有没有并发写入
+
+    写入分到多个工作进程时本进程看不到其他进程的写入，visible为False，这时无法判断。
+    """
+
+    def __init__(self):
+        self.started = 0
+        self.in_flight = 0
+        self.visible = True
+
+    def begin(self):
+        self.started += 1
+        self.in_flight += 1
+
+    def end(self):
+        self.in_flight -= 1
+
+    def quiet_mark(self) -> Optional[int]:
+        """没有在途写入时返回当前的写入次数，之后用is_quiet检查期间有没有新的写入"""
+        return self.started if self.visible and self.in_flight == 0 else None
+
+    def is_quiet(self, mark: Optional[int]) -> bool:
+        return mark is not None and self.started == mark
+
+
+tc_writes = WriteTracker()
 
-count = 0
 
 class Workload(ABC):
     """所有workload的基类"""
@@ -16,43 +75,377 @@ class Workload(ABC):
     target_scope: str
     start_time: int
     times: int
-    
-    def __init__(self, name: str, scope: str, start_time: str, times: int):
+    clients: int
+    rate: float
+    mode: str
+    duration: int
+    max_outstanding: int
+    batch_size: int
+    linger: float
+    write_mode: str
+    processes: int
+    plan_info: Optional[dict]
+    # 每次写入是否发给scope内的所有节点，这样的workload不能用多节点的scope，否则每次写入会产生多行
+    writes_every_target: bool = False
+
+    def __init__(self, name: str, scope: str, start_time: str, times: int, clients: int = 1, rate: float = 0,
+                 mode: str = "closed", duration: str = "0s", max_outstanding: int = 1000, batch_size: int = 0,
+                 linger: float = 0.005, write_mode: str = "none", processes: int = 0):
         self.name = name
         self.target_scope = scope
         self.start_time = time_string_to_seconds(start_time)
-        self.times = times
-        
+        self.times = int(times)
+        self.clients = max(int(clients), 1)
+        self.rate = float(rate)
+        self.mode = mode
+        self.duration = time_string_to_seconds(duration)
+        self.max_outstanding = int(max_outstanding)
+        self.batch_size = int(batch_size)
+        self.linger = float(linger)
+        self.write_mode = write_mode
+        # 分片到几个工作进程执行，0表示使用配置里的workload_processes
+        self.processes = int(processes)
+        # 计划里这个事件的原始描述，工作进程据此重建同样的workload
+        self.plan_info = None
+        self.batchers: dict[Union[Database, LeaderRouter], WriteBatcher] = {}
+        if self.mode not in ("open", "closed"):
+            raise ValueError(f"Unknown load mode: {mode}")
+        if self.times <= 0 and self.duration <= 0:
+            self.times = 1
+
+    def assign_shard(self, index: int, count: int):
+        """只执行共count个分片中第index个分片的负载：客户端数、次数、速率和在途上限按分片均分"""
+        self.clients = share(self.clients, index, count)
+        if self.times > 0:
+            self.times = share(self.times, index, count)
+        self.rate /= count
+        self.max_outstanding = max(self.max_outstanding // count, 1)
+
+    async def start(self) -> LoadStats:
+        try:
+            return await LoadGenerator(self).run()
+        finally:
+            await asyncio.gather(*(batcher.close() for batcher in self.batchers.values()))
+
     @abstractmethod
-    async def start(self):
+    async def operation(self, process: int, seq: int):
+        """一个虚拟客户端（history中的process）执行的一次操作"""
         pass
-    
-    async def execute_sql(self, sql: str):
-        target_databases = ScopeCalculator.get_databases_from_scope(self.target_scope)
-        for database in target_databases:
-            await database.execute(sql)
-    
-    async def query_sql(self, sql: str):
-        target_databases = ScopeCalculator.get_databases_from_scope(self.target_scope)
-        for database in target_databases:
-            await database.query(sql)
-        
+
+    async def record(self, process: int, f: str, key: Any, value: Any, action: Awaitable,
+                     output: Optional[Callable[[Any], Any]] = None) -> Any:
+        """执行action并把它记录到history：先记invoke，成功记ok，确定没有生效（语句被拒绝、请求没有发出等）记fail，
+        其余异常（超时、连接中断等）结果不确定，记info
+
+        output用来从action的结果中取出ok事件记录的值（例如读到的值），默认记录输入的value。
+        """
+        op = history.invoke(process, f, key, value)
+        try:
+            result = await action
+        except DefiniteError as e:
+            history.fail(op, str(e))
+            raise
+        except Exception as e:
+            history.info(op, str(e))
+            raise
+        history.ok(op, value if output is None else output(result))
+        return result
+
+    async def get_targets(self) -> list[Union[Database, LeaderRouter]]:
+        """scope为leader时交给LeaderRouter，它会跟随leader的变化，不必每次先查拓扑"""
+        if self.target_scope == "leader":
+            return [leader_router]
+        return await ScopeCalculator.get_databases_from_scope(self.target_scope)
+
+    async def get_write_targets(self) -> list[Union[Database, LeaderRouter]]:
+        """scope内没有节点时写入根本没有发出，抛出DefiniteError让history记为fail"""
+        target_databases = await self.get_targets()
+        if not target_databases:
+            raise self.no_target_error()
+        return target_databases
+
+    def no_target_error(self) -> DefiniteError:
+        return DefiniteError(f"No database in scope {self.target_scope}")
+
+    async def record_no_target(self, process: int, f: str, key: Any, value: Any):
+        """scope内没有节点时读和事务也根本没有发出，和写入一样在history里记为invoke/fail，再抛出DefiniteError"""
+        async def no_target():
+            raise self.no_target_error()
+
+        await self.record(process, f, key, value, no_target())
+
+    async def execute_sql(self, sql: list[str]):
+        target_databases = await self.get_write_targets()
+        await asyncio.gather(*(database.execute(sql) for database in target_databases))
+
+    def get_batcher(self, database: Union[Database, LeaderRouter]) -> WriteBatcher:
+        batcher = self.batchers.get(database)
+        if batcher is None:
+            batcher = WriteBatcher(database, self.batch_size, self.linger, self.write_mode)
+            self.batchers[database] = batcher
+        return batcher
+
+    async def write(self, statement: list):
+        """写入一条带参数的语句；batch_size>0时交给各节点的攒批管道，否则单独发送"""
+        target_databases = await self.get_write_targets()
+        if self.batch_size > 0:
+            return await asyncio.gather(*(self.get_batcher(database).submit(statement) for database in target_databases))
+        return await asyncio.gather(*(database.execute([statement]) for database in target_databases))
+
+    async def query_sql(self, sql: list, level: str = None) -> list:
+        """在scope内的每个节点上执行查询，按节点顺序返回各自的results"""
+        target_databases = await self.get_targets()
+        return await asyncio.gather(*(database.query(sql, level) for database in target_databases))
+
     def __str__(self):
-        return f"{self.name} on {str(self.target_hosts)} starts at {seconds_to_time_string(self.start_time)} for {self.times} times"
-    
+        load = f"{self.times} times" if self.times > 0 else f"{self.duration}s"
+        rate = f"{self.rate:g} ops/s" if self.rate > 0 else "unlimited rate"
+        return (f"{self.name} on {self.target_scope} starts at {seconds_to_time_string(self.start_time)} for {load} "
+                f"({self.clients} {self.mode}-loop clients, {rate})")
+
 
 class SingleInsert(Workload):
-    def __init__(self, scope, start_time, times):
-        super().__init__("Single Insert", scope, start_time, times)
-    
-    async def start(self):
-        await asyncio.sleep(self.start_time)
-        global count
-        count += 1
-        sql = [f'INSERT INTO tc VALUES("james", {count})']
-        await self.execute_sql(sql)
-        
-        
+    writes_every_target = True
+
+    def __init__(self, scope, start_time, times, **load_options):
+        super().__init__("Single Insert", scope, start_time, times, **load_options)
+
+    async def operation(self, process: int, seq: int):
+        count = next(insert_counter)
+        statement = ["INSERT INTO tc VALUES(?, ?)", f"client{process}", count]
+        tc_writes.begin()
+        try:
+            await self.record(process, "insert", "tc", count, self.write(statement))
+        finally:
+            tc_writes.end()
+
+
+class SingleRead(Workload):
+    """在scope内的每个节点上并发读tc表的行数和最大count，读到的值记入history
+
+    各节点的回答一到就和同一轮里先到的回答比较，只有这一轮期间没有并发写入时不一致才记为diverging
+    （有写入时follower落后几毫秒是正常的）；也和这一轮开始前已经读到过的最大行数比较（更小记为stale，tc表只增不减）。
+    """
+    READ_SQL = "SELECT COUNT(*), MAX(count) FROM tc"
+
+    def __init__(self, scope, start_time, times, level: str = "weak", **load_options):
+        super().__init__("Single Read", scope, start_time, times, **load_options)
+        if level not in READ_LEVELS:
+            raise ValueError(f"Unknown read consistency level: {level}")
+        self.level = level
+        self.node_processes: dict[tuple[int, str], int] = {}
+        self.high_water = 0
+        self.stale_reads = 0
+        self.diverging_reads = 0
+
+    async def start(self) -> LoadStats:
+        stats = await super().start()
+        logging.info(f"{self.name} at level {self.level}: {self.stale_reads} stale reads, "
+                     f"{self.diverging_reads} diverging reads.")
+        return stats
+
+    def get_process(self, process: int, database: Database) -> int:
+        # 同一个客户端对不同节点的读是并发的，history里每个(客户端, 节点)各用一个process
+        key = (process, database.config.name)
+        if key not in self.node_processes:
+            self.node_processes[key] = history.next_process()
+        return self.node_processes[key]
+
+    @staticmethod
+    def parse_read(results: list) -> list[int]:
+        result = results[0]
+        if error := result.get("error"):
+            raise StatementError(error)
+        rows, max_count = result["values"][0]
+        return [rows, max_count or 0]
+
+    async def read_node(self, process: int, database: Database) -> tuple[str, list[int]]:
+        async def read() -> list[int]:
+            return self.parse_read(await database.query([self.READ_SQL], self.level))
+
+        value = await self.record(self.get_process(process, database), "read_count", "tc", database.config.name,
+                                  read(), output=lambda value: value)
+        return database.config.name, value
+
+    def flag(self, kind: str, message: str):
+        metrics.increment("read_anomaly_total", kind=kind, level=self.level)
+        logging.warning(f"{kind.capitalize()} read at level {self.level}: {message}")
+
+    async def operation(self, process: int, seq: int):
+        target_databases = await ScopeCalculator.get_databases_from_scope(self.target_scope)
+        if not target_databases:
+            await self.record_no_target(process, "read_count", "tc", None)
+        high_water = self.high_water
+        quiet_mark = tc_writes.quiet_mark()
+        first: Optional[tuple[str, list[int]]] = None
+        errors: list[BaseException] = []
+        for read in asyncio.as_completed([self.read_node(process, database) for database in target_databases]):
+            try:
+                node, value = await read
+            except Exception as e:
+                errors.append(e)
+                continue
+            if value[0] < high_water:
+                self.stale_reads += 1
+                self.flag("stale", f"{node} returned {value[0]} rows after {high_water} rows had been read")
+            if first is None:
+                first = (node, value)
+            elif value != first[1] and tc_writes.is_quiet(quiet_mark):
+                self.diverging_reads += 1
+                self.flag("diverging", f"{node} returned {value} while {first[0]} returned {first[1]}")
+            self.high_water = max(self.high_water, value[0])
+        if len(errors) == len(target_databases):
+            raise errors[0]
+
+
+class CasMismatch(DefiniteError):
+    """CAS的旧值和寄存器的当前值不一致，寄存器没有被修改"""
+    retryable = False
+
+
+class Register(Workload):
+    """多key的读写寄存器/CAS workload，history可以交给linearizability_check检查
+
+    操作由generator按read/write/cas的比例和key分布惰性产生，不会预先生成整个操作列表；
+    每个操作只发给scope内的一个节点（scope为leader时经由LeaderRouter）。
+    """
+    READ_SQL = "SELECT value FROM registers WHERE id = ?"
+    WRITE_SQL = "INSERT INTO registers(id, value) VALUES(?, ?) ON CONFLICT(id) DO UPDATE SET value = excluded.value"
+    CAS_SQL = "UPDATE registers SET value = ? WHERE id = ? AND value = ?"
+
+    def __init__(self, scope, start_time, times, keys: int = 10, distribution: str = "uniform",
+                 distribution_options: Optional[dict] = None, read: float = 0.5, write: float = 0.25,
+                 cas: float = 0.25, values: int = 5, level: str = "strong", seed: Optional[int] = None,
+                 **load_options):
+        super().__init__("Register", scope, start_time, times, **load_options)
+        if level not in READ_LEVELS:
+            raise ValueError(f"Unknown read consistency level: {level}")
+        self.level = level
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.keys = create_key_distribution(distribution, int(keys), self.rng, **(distribution_options or {}))
+        self.operations = register_ops(self.keys, {"read": read, "write": write, "cas": cas}, int(values), self.rng)
+        self.cas_mismatches = 0
+
+    def assign_shard(self, index: int, count: int):
+        super().assign_shard(index, count)
+        # 各分片用不同的种子，否则会发出完全相同的操作序列
+        if self.seed is not None:
+            self.rng.seed(int(self.seed) * count + index)
+
+    async def start(self) -> LoadStats:
+        stats = await super().start()
+        logging.info(f"{self.name}: {self.cas_mismatches} cas operations did not match the current value.")
+        return stats
+
+    @staticmethod
+    def first_result(results: list) -> dict:
+        result = results[0]
+        if error := result.get("error"):
+            raise StatementError(error)
+        return result
+
+    async def read(self, target: Union[Database, LeaderRouter], key: int) -> Optional[int]:
+        rows = self.first_result(await target.query([[self.READ_SQL, key]], self.level)).get("values")
+        return rows[0][0] if rows else None
+
+    async def write_register(self, target: Union[Database, LeaderRouter], key: int, value: int):
+        # 重复写入同一个值结果不变，可以放心重试
+        self.first_result(await target.execute([[self.WRITE_SQL, key, value]]))
+
+    async def cas(self, target: Union[Database, LeaderRouter], key: int, old: int, new: int):
+        # 结果不确定时重发可能在第一次已经生效之后再比较一次，从而把成功的cas误报为不匹配
+        result = self.first_result(await target.execute([[self.CAS_SQL, new, key, old]], idempotent=False))
+        if result.get("rows_affected") != 1:
+            raise CasMismatch(f"Register {key} is not {old}")
+
+    async def operation(self, process: int, seq: int):
+        f, key, value = next(self.operations)
+        targets = await self.get_targets()
+        if not targets:
+            await self.record_no_target(process, f, key, value)
+        target = self.rng.choice(targets)
+        if f == "read":
+            await self.record(process, f, key, value, self.read(target, key), output=lambda result: result)
+        elif f == "write":
+            await self.record(process, f, key, value, self.write_register(target, key, value))
+        else:
+            try:
+                await self.record(process, f, key, value, self.cas(target, key, *value))
+            except CasMismatch:
+                # 不匹配是cas的正常结果，history里已经记为fail
+                self.cas_mismatches += 1
+
+
+class ListAppend(Workload):
+    """list-append事务workload，history可以交给list_append_check检查事务隔离异常
+
+    每个事务由若干个追加和读组成，整个事务用一次/db/request在rqlite的事务里执行；
+    每个key是lists表里的一行，value是逗号分隔的列表，追加的值在整个workload内唯一。
+    """
+    APPEND_SQL = ("INSERT INTO lists(id, value) VALUES(?, ?) "
+                  "ON CONFLICT(id) DO UPDATE SET value = value || ',' || excluded.value")
+    READ_SQL = "SELECT value FROM lists WHERE id = ?"
+
+    def __init__(self, scope, start_time, times, keys: int = 10, distribution: str = "uniform",
+                 distribution_options: Optional[dict] = None, min_length: int = 1, max_length: int = 4,
+                 append: float = 0.5, level: str = "strong", seed: Optional[int] = None, **load_options):
+        super().__init__("List Append", scope, start_time, times, **load_options)
+        if level not in READ_LEVELS:
+            raise ValueError(f"Unknown read consistency level: {level}")
+        self.level = level
+        self.seed = seed
+        self.min_length = int(min_length)
+        self.max_length = int(max_length)
+        self.append = float(append)
+        self.rng = random.Random(seed)
+        self.keys = create_key_distribution(distribution, int(keys), self.rng, **(distribution_options or {}))
+        self.transactions = self.generate(itertools.count(1))
+
+    def generate(self, values: Iterator[int]) -> Iterator[list[list]]:
+        return list_append_txns(self.keys, self.min_length, self.max_length, self.append, values, self.rng)
+
+    def assign_shard(self, index: int, count: int):
+        super().assign_shard(index, count)
+        if self.seed is not None:
+            self.rng.seed(int(self.seed) * count + index)
+        # 追加的值按分片交错取，整个workload内仍然唯一
+        self.transactions = self.generate(itertools.count(1 + index, count))
+
+    def statements(self, txn: list[list]) -> list[list]:
+        return [[self.APPEND_SQL, key, str(value)] if f == "append" else [self.READ_SQL, key]
+                for f, key, value in txn]
+
+    @staticmethod
+    def parse_list(rows: Optional[list]) -> list[int]:
+        if not rows or rows[0][0] is None:
+            return []
+        return [int(value) for value in str(rows[0][0]).split(",")]
+
+    async def transact(self, target: Union[Database, LeaderRouter], txn: list[list]) -> list[list]:
+        # 追加不是幂等的，结果不确定时不能重发
+        results = await target.request(self.statements(txn), transaction=True, level=self.level, idempotent=False)
+        if len(results) < len(txn):
+            raise StatementError(f"Transaction rolled back after {len(results)} of {len(txn)} statements")
+        completed: list[list] = []
+        for (f, key, value), result in zip(txn, results):
+            if error := result.get("error"):
+                raise StatementError(f"Transaction rolled back: {error}")
+            completed.append([f, key, value if f == "append" else self.parse_list(result.get("values"))])
+        return completed
+
+    async def operation(self, process: int, seq: int):
+        txn = next(self.transactions)
+        targets = await self.get_targets()
+        if not targets:
+            await self.record_no_target(process, "txn", None, txn)
+        target = self.rng.choice(targets)
+        await self.record(process, "txn", None, txn, self.transact(target, txn), output=lambda result: result)
+
+
 WORKLOAD_MAPPING: dict[str, Type[Workload]] = {
-    "single_insert": SingleInsert
-}
\ No newline at end of file
+    "single_insert": SingleInsert,
+    "single_read": SingleRead,
+    "register": Register,
+    "list_append": ListAppend
+}
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from src.batcher import WriteBatcher
+from src.db import StatementError
+
+
+class RecordingDatabase:
+    """记录每次/db/execute请求的假节点，VALUES为-1的语句返回错误"""
+    name = "node1"
+
+    def __init__(self):
+        self.batches: list[tuple[list, bool, bool]] = []
+
+    async def execute_batch(self, statements: list, transaction: bool = False, queue: bool = False) -> list[dict]:
+        self.batches.append((statements, transaction, queue))
+        results = []
+        for statement in statements:
+            if statement[-1] == -1:
+                results.append({"error": "constraint failed"})
+                if transaction:
+                    break
+            else:
+                results.append({"last_insert_id": statement[-1], "rows_affected": 1})
+        return results
+
+
+def statement(value: int) -> list:
+    return ["INSERT INTO tc VALUES(?, ?)", "client0", value]
+
+
+def submit_all(batcher: WriteBatcher, values: list[int]) -> list:
+    """并发提交，按提交顺序返回每条语句的结果或异常"""
+    async def run():
+        results = await asyncio.gather(*(batcher.submit(statement(value)) for value in values), return_exceptions=True)
+        await batcher.close()
+        return results
+
+    return asyncio.run(run())
+
+
+def test_full_batch_is_sent_in_one_request():
+    database = RecordingDatabase()
+    results = submit_all(WriteBatcher(database, batch_size=3, linger=10), [1, 2, 3])
+    assert len(database.batches) == 1
+    assert [result["last_insert_id"] for result in results] == [1, 2, 3]
+
+
+def test_partial_batch_is_sent_after_linger():
+    database = RecordingDatabase()
+    results = submit_all(WriteBatcher(database, batch_size=100, linger=0.01), [1, 2, 3, 4, 5])
+    assert [len(statements) for statements, _, _ in database.batches] == [5]
+    assert [result["rows_affected"] for result in results] == [1] * 5
+
+
+def test_batches_split_at_batch_size():
+    database = RecordingDatabase()
+    submit_all(WriteBatcher(database, batch_size=2, linger=0.01), [1, 2, 3, 4, 5])
+    assert [[s[-1] for s in statements] for statements, _, _ in database.batches] == [[1, 2], [3, 4], [5]]
+
+
+def test_statement_error_only_fails_its_own_statement():
+    database = RecordingDatabase()
+    results = submit_all(WriteBatcher(database, batch_size=3, linger=10), [1, -1, 3])
+    assert results[0]["last_insert_id"] == 1
+    assert isinstance(results[1], StatementError)
+    assert results[2]["last_insert_id"] == 3
+
+
+def test_transaction_mode_fails_the_whole_batch():
+    database = RecordingDatabase()
+    results = submit_all(WriteBatcher(database, batch_size=3, linger=10, write_mode="transaction"), [1, -1, 3])
+    assert database.batches[0][1]
+    assert all(isinstance(result, StatementError) for result in results)
+
+
+def test_unknown_write_mode():
+    with pytest.raises(ValueError):
+        WriteBatcher(RecordingDatabase(), write_mode="bulk")
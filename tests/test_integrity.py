@@ -0,0 +1,50 @@
+import numpy as np
+
+from src.integrity import IntegrityReport, diff_reports
+
+
+def scan(node: str, pages: list[list[int]], expected_start: int = 1) -> IntegrityReport:
+    """pages里每一项是一页按count排好序的值，模拟分页扫描"""
+    report = IntegrityReport(node)
+    for page in pages:
+        report.add_page(np.array(page, dtype=np.int64), expected_start)
+    report.finish()
+    return report
+
+
+def test_complete_table():
+    report = scan("node1", [[1, 2, 3], [4, 5]])
+    assert not report.has_anomaly
+    assert report.rows == 5
+    assert (report.first, report.last) == (1, 5)
+
+
+def test_lost_rows():
+    # 开头缺了1，中间缺了4~6，其中5和6跨了页边界
+    report = scan("node1", [[2, 3, 4], [7, 8]])
+    assert report.has_anomaly
+    assert report.missing == [(1, 1), (5, 6)]
+    assert report.duplicated == []
+
+
+def test_duplicated_rows():
+    # 3重复了两次，4和5各重复一次，5的重复在下一页开头
+    report = scan("node1", [[1, 2, 3, 3, 3, 4, 4, 5], [5, 6]])
+    assert report.has_anomaly
+    assert report.missing == []
+    assert report.duplicated == [(3, 5)]
+    assert report.duplicate_rows == 4
+    assert report.rows == 10
+
+
+def test_empty_table_is_an_anomaly():
+    assert scan("node1", []).has_anomaly
+
+
+def test_diff_reports_between_replicas():
+    leader = scan("node1", [[1, 2, 3, 4]])
+    follower = scan("node2", [[1, 3, 3, 4]])
+    differences = diff_reports([leader, follower])
+    assert any("node2 is missing [(2, 2)]" in difference for difference in differences), differences
+    assert any("duplicated values differ" in difference for difference in differences), differences
+    assert diff_reports([leader, scan("node3", [[1, 2, 3, 4]])]) == []
@@ -0,0 +1,61 @@
+from src.history import Operation
+from src.linearizability import check_partition, partition_history
+
+
+def check(rows: list[tuple]) -> dict:
+    """rows里每一项是(process, type, f, value)，都是key 0上的操作，按顺序编号"""
+    ops = [Operation(i, i, process, type, f, 0, value) for i, (process, type, f, value) in enumerate(rows)]
+    partitions = partition_history(ops)
+    return check_partition(0, partitions[0], float("inf"), 1_000_000, 2000)
+
+
+def test_linearizable_register():
+    # 并发的写和读：读到的1可以线性化在写之后
+    result = check([
+        (0, "invoke", "write", 1),
+        (1, "invoke", "read", None),
+        (0, "ok", "write", 1),
+        (1, "ok", "read", 1),
+        (0, "invoke", "cas", [1, 2]),
+        (0, "ok", "cas", [1, 2]),
+        (1, "invoke", "read", None),
+        (1, "ok", "read", 2),
+    ])
+    assert result["valid"], result
+
+
+def test_stale_read_is_not_linearizable():
+    # 写2完成之后开始的读却读到了旧值1
+    result = check([
+        (0, "invoke", "write", 1),
+        (0, "ok", "write", 1),
+        (0, "invoke", "write", 2),
+        (0, "ok", "write", 2),
+        (1, "invoke", "read", None),
+        (1, "ok", "read", 1),
+    ])
+    assert result["valid"] is False
+    assert result["failed_op"]["f"] == "read"
+    assert result["failed_op"]["output"] == 1
+
+
+def test_indeterminate_write_may_take_effect():
+    # 结果不确定的写可能在之后生效，读到它写的值不算异常；确定失败的写不能被读到
+    result = check([
+        (0, "invoke", "write", 1),
+        (0, "ok", "write", 1),
+        (1, "invoke", "write", 2),
+        (1, "info", "write", "timeout"),
+        (2, "invoke", "read", None),
+        (2, "ok", "read", 2),
+    ])
+    assert result["valid"], result
+    result = check([
+        (0, "invoke", "write", 1),
+        (0, "ok", "write", 1),
+        (1, "invoke", "write", 2),
+        (1, "fail", "write", "rejected"),
+        (2, "invoke", "read", None),
+        (2, "ok", "read", 2),
+    ])
+    assert result["valid"] is False
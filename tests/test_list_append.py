@@ -0,0 +1,47 @@
+from src.list_append import ListAppendAnalysis, Transaction
+
+
+def analyze(txns: list[list], failed_appends: set = frozenset()) -> dict:
+    """txns里每一项是一个已提交事务的微操作列表"""
+    transactions = [Transaction(i, i, i, ops, True) for i, ops in enumerate(txns)]
+    return ListAppendAnalysis(transactions, set(failed_appends)).run()
+
+
+def test_empty_reads_are_valid():
+    # 所有读都返回空列表的key没有版本记录，不应该让分析出错
+    result = analyze([
+        [["r", 0, []], ["r", 1, []]],
+        [["append", 2, 1]],
+        [["r", 2, [1]], ["r", 3, []]],
+    ])
+    assert result["valid"], result
+    assert result["transactions"] == 3
+
+
+def test_g0():
+    result = analyze([
+        [["append", 0, 1], ["append", 1, 1]],
+        [["append", 0, 2], ["append", 1, 2]],
+        [["r", 0, [1, 2]], ["r", 1, [2, 1]]],
+    ])
+    assert not result["valid"]
+    assert "G0" in result["anomaly_counts"]
+
+
+def test_g1c():
+    result = analyze([
+        [["append", 0, 1], ["r", 1, [1]]],
+        [["append", 1, 1], ["r", 0, [1]]],
+    ])
+    assert not result["valid"]
+    assert "G1c" in result["anomaly_counts"]
+
+
+def test_g2_write_skew():
+    result = analyze([
+        [["r", 0, []], ["append", 1, 1]],
+        [["r", 1, []], ["append", 0, 1]],
+        [["r", 0, [1]], ["r", 1, [1]]],
+    ])
+    assert not result["valid"]
+    assert "G2" in result["anomaly_counts"]
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from src.retry import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, DefiniteError, RetryPolicy
+
+
+class Flaky:
+    """前failures次调用抛出error，之后返回"ok"，记录调用次数"""
+
+    def __init__(self, failures: int, error: Exception):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self, *args) -> str:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return "ok"
+
+
+def test_breaker_opens_half_opens_and_closes():
+    async def run():
+        breaker = CircuitBreaker("node1", threshold=2, reset_timeout=0.05)
+        failing = Flaky(3, ConnectionError("refused"))
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await breaker.call(failing)
+        assert breaker.state == OPEN
+        # 打开期间请求根本不发出
+        with pytest.raises(CircuitOpenError):
+            await breaker.call(failing)
+        assert failing.calls == 2
+
+        # 半开时只放行一个探测请求，探测失败重新打开
+        await asyncio.sleep(0.06)
+        breaker.check()
+        assert breaker.state == HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            breaker.check()
+        breaker.record_failure()
+        assert breaker.state == OPEN
+
+        # 下一次探测成功后关闭
+        await asyncio.sleep(0.06)
+        with pytest.raises(ConnectionError):
+            await breaker.call(failing)
+        assert breaker.state == OPEN
+        await asyncio.sleep(0.06)
+        assert await breaker.call(failing) == "ok"
+        assert breaker.state == CLOSED
+        assert breaker.failures == 0
+
+    asyncio.run(run())
+
+
+def test_definite_rejection_does_not_open_breaker():
+    class Rejected(DefiniteError):
+        retryable = False
+
+    async def run():
+        breaker = CircuitBreaker("node1", threshold=1)
+        with pytest.raises(Rejected):
+            await breaker.call(Flaky(1, Rejected("not leader")))
+        assert breaker.state == CLOSED
+
+    asyncio.run(run())
+
+
+def retry(action: Flaky, idempotent: bool, attempts: int = 5) -> str:
+    policy = RetryPolicy(attempts=attempts, base_delay=0, max_delay=0, deadline=5)
+    return asyncio.run(policy.run(action, "execute", "node1", idempotent=idempotent))
+
+
+def test_idempotent_call_is_retried():
+    action = Flaky(2, TimeoutError("timed out"))
+    assert retry(action, idempotent=True) == "ok"
+    assert action.calls == 3
+
+
+def test_non_idempotent_call_is_not_retried_after_indeterminate_error():
+    # 超时之后不知道第一次是否已经生效，重发可能让CAS之类的操作执行两次
+    action = Flaky(2, TimeoutError("timed out"))
+    with pytest.raises(Exception) as info:
+        retry(action, idempotent=False)
+    assert not isinstance(info.value, DefiniteError)
+    assert action.calls == 1
+
+
+def test_non_idempotent_call_is_retried_after_definite_error():
+    # 请求确定没有发出，重发是安全的
+    action = Flaky(2, DefiniteError("connection refused"))
+    assert retry(action, idempotent=False) == "ok"
+    assert action.calls == 3
+
+
+def test_give_up_outcome():
+    # 每次都确定没有生效时放弃也是确定的失败，中间有过不确定的尝试就只能算不确定
+    with pytest.raises(DefiniteError):
+        retry(Flaky(5, DefiniteError("connection refused")), idempotent=True, attempts=3)
+    action = Flaky(5, TimeoutError("timed out"))
+    with pytest.raises(Exception) as info:
+        retry(action, idempotent=True, attempts=3)
+    assert not isinstance(info.value, DefiniteError)
+    assert action.calls == 3